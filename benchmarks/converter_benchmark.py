@@ -0,0 +1,331 @@
+"""Converter throughput benchmark
+
+Runs StreamConverter against synthetic test patterns, generated locally
+with PyAV at 720p, 1080p and 4K, with and without audio. Each input is
+converted from a file, as fast as possible, and through a local RTSP
+stand-in that publishes the same file at its own pace like a camera (the
+converter listens with libavformat's RTSP server mode). No network or GPU
+is needed.
+
+Every scenario runs in a fresh process and reports frames per second,
+realtime factor, CPU time per pipeline thread (one encode thread per
+rendition), peak RSS and the latency of the first segment per rendition.
+Results are written as JSON for comparison between commits.
+
+Usage:
+    python -m benchmarks.converter_benchmark [--resolutions 720p,1080p,4k] [--sources file,rtsp]
+        [--audio both|yes|no] [--duration SECONDS] [--output FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+import av
+import numpy as np
+from src.config import StreamConfig
+from src.converter import StreamConverter
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+FPS = 30
+AUDIO_RATE = 44100
+# Seconds the RTSP stand-in and the listening converter wait for each other
+CONNECT_TIMEOUT = 10
+
+
+def _pattern_frames(width: int, height: int, count: int):
+    """Yield frames of a seeded noise texture sliding diagonally, so every frame has detail and motion"""
+    rng = np.random.default_rng(0)
+    # Low resolution noise scaled up, encoders treat it like textured scenery rather than pure noise
+    texture = rng.integers(0, 256, (height // 8 + count, width // 8 + count, 3), dtype=np.uint8)
+    texture = texture.repeat(8, axis=0).repeat(8, axis=1)
+    for index in range(count):
+        offset = index * 8
+        image = np.ascontiguousarray(texture[offset:offset + height, offset:offset + width])
+        frame = av.VideoFrame.from_ndarray(image, format='rgb24')
+        frame.pts = index
+        yield frame
+
+
+def _generate_source(path: str, width: int, height: int, duration: float, audio: bool):
+    """Encode a test pattern with a camera-like GOP of two seconds, plus a tone when audio is on"""
+    frames = int(duration * FPS)
+    with av.open(path, 'w', format='mp4') as container:
+        video = container.add_stream('libx264', rate=FPS)
+        video.width, video.height, video.pix_fmt = width, height, 'yuv420p'
+        video.gop_size = 2 * FPS
+        video.options = {'preset': 'ultrafast', 'profile': 'main'}
+        audio_stream = None
+        if audio:
+            audio_stream = container.add_stream('aac', rate=AUDIO_RATE)
+            audio_stream.layout = 'stereo'
+
+        samples_per_frame = AUDIO_RATE // FPS
+        for index, frame in enumerate(_pattern_frames(width, height, frames)):
+            for packet in video.encode(frame):
+                container.mux(packet)
+            if audio_stream:
+                t = (np.arange(samples_per_frame) + index * samples_per_frame) / AUDIO_RATE
+                tone = (0.2 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+                audio_frame = av.AudioFrame.from_ndarray(np.stack([tone, tone]).reshape(1, -1),
+                                                         format='flt', layout='stereo')
+                audio_frame.sample_rate = AUDIO_RATE
+                audio_frame.pts = index * samples_per_frame
+                for packet in audio_stream.encode(audio_frame):
+                    container.mux(packet)
+        for packet in video.encode(None):
+            container.mux(packet)
+        if audio_stream:
+            for packet in audio_stream.encode(None):
+                container.mux(packet)
+
+
+def _source_path(cache_dir: str, resolution: str, duration: float, audio: bool) -> str:
+    """Get a synthetic source, generating it on first use"""
+    path = os.path.join(cache_dir, f'pattern_{resolution}_{duration:g}s_{"av" if audio else "v"}.mp4')
+    if not os.path.exists(path):
+        logger.warning(f"Generating {path}")
+        width, height = RESOLUTIONS[resolution]
+        _generate_source(path + '.tmp', width, height, duration, audio)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def _publish_rtsp(path: str, url: str):
+    """Send a file to the listening converter in real time, as a camera would (runs in its own process)"""
+    with av.open(path) as source:
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            sink = av.open(url, 'w', format='rtsp', options={'rtsp_transport': 'tcp'})
+            streams = {stream: sink.add_stream_from_template(stream) for stream in source.streams}
+            try:
+                # The RTSP muxer connects and announces the streams here
+                sink.start_encoding()
+                break
+            except ConnectionRefusedError:
+                sink.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        started = time.monotonic()
+        for packet in source.demux():
+            if packet.dts is None:
+                continue
+            delay = started + float(packet.dts * packet.time_base) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            packet.stream = streams[packet.stream]
+            sink.mux(packet)
+        sink.close()
+
+
+class SegmentClock:
+    """Stands in for the HLS server and notes when each rendition publishes its first segment
+
+    Audio renditions publish segments of their own, their first segment
+    is timed like the video renditions'.
+    """
+
+    def __init__(self):
+        self.converter = None
+        self.started = time.perf_counter()
+        self.first_segment = {}
+        self.audio = False
+
+    def set_audio(self, available: bool):
+        self.audio = available
+
+    def add_segment(self, segment: dict):
+        self.first_segment.setdefault(segment['rendition'], time.perf_counter() - self.started)
+
+    def add_part(self, part: dict):
+        pass
+
+
+class BenchmarkConverter(StreamConverter):
+    """StreamConverter recording the CPU time of its pipeline threads"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.thread_cpu = {}
+
+    def _open_input(self):
+        if self.config.input_url.startswith('rtsp://'):
+            # Act as the RTSP server the stand-in camera publishes to
+            return av.open(self.config.input_url,
+                           options={'rtsp_flags': 'listen', 'listen_timeout': str(CONNECT_TIMEOUT)})
+        return super()._open_input()
+
+    def _build_pipeline(self, input_container, loop):
+        pipeline = super()._build_pipeline(input_container, loop)
+        for stage in pipeline.stages:
+            finish = stage.finish
+
+            def timed_finish(stage=stage, finish=finish):
+                # Encode stages flush their encoders on finish, which is part of their work
+                finish()
+                self.thread_cpu[stage.name] = time.thread_time()
+            stage.finish = timed_finish
+        return pipeline
+
+
+async def _convert(config: StreamConfig, source_path: str) -> dict:
+    converter = BenchmarkConverter(config)
+    clock = SegmentClock()
+    converter.set_hls_server(clock)
+    publisher = None
+    if config.input_url.startswith('rtsp://'):
+        # The RTSP muxer holds the GIL while it connects, a thread would stall the listening converter
+        publisher = multiprocessing.get_context('spawn').Process(target=_publish_rtsp,
+                                                                 args=(source_path, config.input_url))
+        publisher.start()
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await converter.start_conversion()
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    if publisher:
+        publisher.join()
+
+    with av.open(source_path) as source:
+        media_duration = source.duration / av.time_base
+    frames = converter.stats['processed_video_frames']
+    return {
+        'wall_seconds': round(wall, 3),
+        'video_frames': frames,
+        'fps': round(frames / wall, 2),
+        'realtime_factor': round(media_duration / wall, 3),
+        'cpu_percent': round(100 * cpu / wall, 1),
+        'thread_cpu_seconds': {name: round(seconds, 3) for name, seconds in converter.thread_cpu.items()},
+        # ru_maxrss is in kilobytes on Linux, every scenario runs in a fresh process
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'first_segment_seconds': {name: round(seconds, 3) for name, seconds in clock.first_segment.items()},
+        'audio_listed': clock.audio,
+        'dropped_frames': converter.stats['dropped_frames'],
+        'encoding_errors': converter.stats['encoding_errors'],
+    }
+
+
+def run_scenario(scenario: dict, source_path: str, output_path: str, segment_duration: int) -> dict:
+    """Convert one synthetic source (runs in its own process)"""
+    logging.basicConfig(level=logging.WARNING)
+    av.logging.set_level(av.logging.ERROR)
+    input_url = source_path
+    if scenario['source'] == 'rtsp':
+        input_url = f'rtsp://127.0.0.1:{_free_port()}/benchmark'
+    config = StreamConfig(
+        input_url=input_url,
+        output_path=output_path,
+        segment_duration=segment_duration,
+        enable_reconnect=False,
+        enable_stats=False,
+    )
+    if scenario['source'] == 'file':
+        # Read as fast as possible, a file never runs ahead of its converter to drop frames for
+        config.max_encode_lag = 0
+    return dict(scenario, **asyncio.run(_convert(config, source_path)))
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _scenario_key(result: dict) -> tuple:
+    return result['resolution'], result['audio'], result['source']
+
+
+def _compare(results: list, baseline_path: str):
+    """Print the fps change of every scenario that also ran in the baseline"""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    previous = {_scenario_key(r): r for r in baseline['results']}
+    print(f"\nCompared with {baseline['commit']} ({baseline_path}):")
+    for result in results:
+        key = _scenario_key(result)
+        old = previous.get(key)
+        if old:
+            change = 100 * (result['fps'] / old['fps'] - 1)
+            print(f"{'/'.join(map(str, key)):>22}: {old['fps']:8.1f} -> {result['fps']:8.1f} fps "
+                  f"({change:+.1f}%)")
+
+
+def main(args):
+    cache_dir = args.cache_dir or os.path.join(tempfile.gettempdir(), 'converter_benchmark')
+    os.makedirs(cache_dir, exist_ok=True)
+    audio_options = {'both': [True, False], 'yes': [True], 'no': [False]}[args.audio]
+
+    results = []
+    # A fresh process per scenario keeps peak RSS and libav state apart
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        for resolution in args.resolutions.split(','):
+            for audio in audio_options:
+                source_path = _source_path(cache_dir, resolution, args.duration, audio)
+                for source in args.sources.split(','):
+                    scenario = {'resolution': resolution, 'audio': audio, 'source': source}
+                    with tempfile.TemporaryDirectory() as output_path:
+                        result = pool.submit(run_scenario, scenario, source_path, output_path,
+                                             args.segment_duration).result()
+                    results.append(result)
+                    first_segment = max(result['first_segment_seconds'].values(), default=float('nan'))
+                    print(f"{resolution:>6} {'audio' if audio else 'video':>5} {source:>4}: "
+                          f"{result['fps']:8.1f} fps {result['realtime_factor']:6.2f}x realtime "
+                          f"{result['cpu_percent']:6.1f}% CPU {result['peak_rss_mb']:7.1f} MB "
+                          f"first segment {first_segment:.2f}s")
+
+    report = {
+        'commit': _git_commit(),
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'pyav': av.__version__,
+            'cpus': os.cpu_count(),
+        },
+        'settings': {'duration': args.duration, 'segment_duration': args.segment_duration, 'fps': FPS},
+        'results': results,
+    }
+    output = args.output or f'converter_benchmark_{report["commit"]}.json'
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        _compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolutions', default='720p,1080p,4k')
+    parser.add_argument('--sources', default='file,rtsp')
+    parser.add_argument('--audio', choices=['both', 'yes', 'no'], default='both')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of synthetic input')
+    parser.add_argument('--segment-duration', type=int, default=2)
+    parser.add_argument('--cache-dir', help='where generated sources are kept between runs')
+    parser.add_argument('--output', help='JSON report path, converter_benchmark_<commit>.json by default')
+    parser.add_argument('--compare', help='earlier JSON report to compare fps with')
+    logging.basicConfig(level=logging.WARNING)
+    main(parser.parse_args())
@@ -0,0 +1,354 @@
+"""HLS serving load test
+
+Simulates many players against one HLSServer without transcoding. The
+server runs in a child process, so its CPU usage can be measured apart
+from the load generator. It publishes pre-generated segments of every
+rendition once per segment duration, like a live converter would.
+
+Each player loads the master playlist and polls its media playlist once per
+target duration. It downloads the segments it has not seen, starting three
+segments behind the live edge. Every player has a simulated link bandwidth.
+Downloads are stretched to that bandwidth, and the player switches to the
+highest rendition its measured throughput can sustain.
+
+Reports p50/p99 latency of playlist and segment requests, request and byte
+throughput, errors, rendition switches, segments that took longer than
+their duration to download, and the CPU usage of the server and of the
+load generator.
+
+Usage:
+    python -m benchmarks.hls_load_test [--players N] [--duration SECONDS] [--memory-segments]
+        [--bandwidth MIN-MAX] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socket
+import statistics
+import tempfile
+import time
+from collections import Counter
+import psutil
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from src.config import StreamConfig
+from src.server import HLSServer
+
+logger = logging.getLogger(__name__)
+
+# Segments behind the live edge a player starts at
+START_OFFSET = 3
+# Share of the measured throughput a player is willing to spend on a rendition
+ABR_SAFETY = 0.8
+# Weight of the newest sample in the throughput estimate
+ABR_SMOOTHING = 0.3
+REQUEST_TIMEOUT = 10
+
+BANDWIDTH_PATTERN = re.compile(r'BANDWIDTH=(\d+)')
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class LivePublisher:
+    """Publishes pre-generated segments to an HLSServer as a running converter would"""
+
+    def __init__(self, server: HLSServer):
+        self.server = server
+        self.config = server.config
+        self.next_id = 1
+        # One payload per rendition, sized by its bitrate, reused for every segment
+        self.payloads = {}
+        for rendition in server.renditions:
+            data = os.urandom(rendition.bitrate * self.config.segment_duration // 8)
+            if self.config.enable_memory_segments:
+                self.payloads[rendition.name] = memoryview(data)
+            else:
+                path = os.path.join(self.config.output_path, f'payload_{rendition.name}.ts')
+                with open(path, 'wb') as payload_file:
+                    payload_file.write(data)
+                self.payloads[rendition.name] = path
+
+    def publish(self):
+        """Publish the next segment of every rendition"""
+        for rendition in self.server.renditions:
+            segment = {'id': self.next_id, 'rendition': rendition.name,
+                       'duration': float(self.config.segment_duration)}
+            payload = self.payloads[rendition.name]
+            if self.config.enable_memory_segments:
+                segment['data'] = payload
+            else:
+                # Hard links make each segment a file of its own without copying the payload
+                path = os.path.join(self.config.output_path, f'segment_{rendition.name}_{self.next_id}.ts')
+                os.link(payload, path)
+                segment['path'] = path
+                segment['size'] = os.path.getsize(payload)
+            self.server.add_segment(segment)
+        self.next_id += 1
+
+
+async def _serve_live(config: StreamConfig, ready):
+    server = HLSServer(config)
+    publisher = LivePublisher(server)
+    await server.start()
+    # Start with a full live window, as if the converter had been running for a while
+    for _ in range(config.playlist_size):
+        publisher.publish()
+    ready.set()
+    try:
+        while True:
+            await asyncio.sleep(config.segment_duration)
+            publisher.publish()
+    finally:
+        await server.stop()
+
+
+def serve(config: StreamConfig, ready):
+    """Run the HLS server with a live segment feed until terminated (child process)"""
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(_serve_live(config, ready))
+
+
+class LoadStats:
+    """Latencies, volume and errors collected by all players"""
+
+    def __init__(self):
+        self.latencies = {'playlist': [], 'segment': []}
+        self.bytes = 0
+        self.errors = Counter()
+        self.switches = 0
+        self.late_segments = 0
+        self.renditions = Counter()
+
+    def report(self, wall: float) -> dict:
+        requests = sum(len(samples) for samples in self.latencies.values())
+        return {
+            'latency_ms': {kind: _percentiles(samples) for kind, samples in self.latencies.items()},
+            'requests': {kind: len(samples) for kind, samples in self.latencies.items()},
+            'requests_per_second': round(requests / wall, 1),
+            'megabits_per_second': round(self.bytes * 8 / wall / 1e6, 1),
+            'errors': dict(self.errors),
+            'rendition_switches': self.switches,
+            'late_segments': self.late_segments,
+            'segments_per_rendition': dict(self.renditions),
+        }
+
+
+def _percentiles(samples: list) -> dict:
+    if len(samples) < 2:
+        return {'p50': None, 'p99': None}
+    cuts = statistics.quantiles(samples, n=100)
+    return {'p50': round(cuts[49] * 1000, 2), 'p99': round(cuts[98] * 1000, 2)}
+
+
+def _parse_master_playlist(text: str) -> list:
+    """Get (bandwidth, uri) of every variant, lowest bandwidth first"""
+    variants = []
+    lines = text.splitlines()
+    for line, uri in zip(lines, lines[1:]):
+        if line.startswith('#EXT-X-STREAM-INF'):
+            variants.append((int(BANDWIDTH_PATTERN.search(line).group(1)), uri))
+    return sorted(variants)
+
+
+def _parse_media_playlist(text: str) -> tuple:
+    """Get the target duration, media sequence and segment URIs of a media playlist"""
+    target_duration, media_sequence, uris = 0, 0, []
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            media_sequence = int(line.split(':', 1)[1])
+        elif line and not line.startswith('#'):
+            uris.append(line)
+    return target_duration, media_sequence, uris
+
+
+class Player:
+    """A live HLS player with throughput based rendition switching"""
+
+    def __init__(self, session: ClientSession, base_url: str, bandwidth: float, stats: LoadStats):
+        self.session = session
+        self.base_url = base_url
+        # Bits per second of the simulated link, 0 for unlimited
+        self.bandwidth = bandwidth
+        self.stats = stats
+        self.variants = []
+        self.variant = 0
+        self.estimate = None
+
+    async def _get(self, path: str, kind: str):
+        """Fetch a URL, stretched to the link bandwidth, and return (body, seconds)"""
+        started = time.perf_counter()
+        try:
+            async with self.session.get(self.base_url + path) as response:
+                body = await response.read()
+                if response.status != 200:
+                    self.stats.errors[str(response.status)] += 1
+                    return None, 0.0
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.stats.errors[type(e).__name__] += 1
+            return None, 0.0
+        elapsed = time.perf_counter() - started
+        self.stats.latencies[kind].append(elapsed)
+        self.stats.bytes += len(body)
+        if self.bandwidth:
+            link_time = len(body) * 8 / self.bandwidth
+            if link_time > elapsed:
+                await asyncio.sleep(link_time - elapsed)
+                elapsed = link_time
+        return body, elapsed
+
+    def _adapt(self, size: int, seconds: float):
+        """Pick the highest variant the smoothed throughput can sustain"""
+        throughput = size * 8 / max(seconds, 1e-6)
+        if self.estimate is None:
+            self.estimate = throughput
+        else:
+            self.estimate += ABR_SMOOTHING * (throughput - self.estimate)
+        variant = 0
+        for index, (bandwidth, _) in enumerate(self.variants):
+            if bandwidth <= ABR_SAFETY * self.estimate:
+                variant = index
+        if variant != self.variant:
+            self.variant = variant
+            self.stats.switches += 1
+
+    async def run(self, deadline: float):
+        loop = asyncio.get_running_loop()
+        body, _ = await self._get('/stream.m3u8', 'playlist')
+        if body is None:
+            return
+        self.variants = _parse_master_playlist(body.decode())
+        last_downloaded = None
+
+        while loop.time() < deadline:
+            polled = loop.time()
+            bandwidth, uri = self.variants[self.variant]
+            body, _ = await self._get(uri, 'playlist')
+            if body is None:
+                await asyncio.sleep(1)
+                continue
+            target_duration, media_sequence, uris = _parse_media_playlist(body.decode())
+            if last_downloaded is None:
+                last_downloaded = media_sequence + len(uris) - START_OFFSET - 1
+
+            for sequence, segment in enumerate(uris, start=media_sequence):
+                if sequence <= last_downloaded or loop.time() >= deadline:
+                    continue
+                data, seconds = await self._get(segment, 'segment')
+                last_downloaded = sequence
+                if data is None:
+                    continue
+                self.stats.renditions[str(bandwidth)] += 1
+                if seconds > target_duration:
+                    self.stats.late_segments += 1
+                self._adapt(len(data), seconds)
+
+            await asyncio.sleep(max(0.0, min(polled + target_duration, deadline) - loop.time()))
+
+
+def _raise_file_limit():
+    """Allow one socket per player"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def run_load(base_url: str, server_process: psutil.Process, args) -> dict:
+    stats = LoadStats()
+    rng = random.Random(args.seed)
+    low, _, high = args.bandwidth.partition('-')
+    loop = asyncio.get_running_loop()
+
+    connector = TCPConnector(limit=0)
+    async with ClientSession(connector=connector, timeout=ClientTimeout(total=REQUEST_TIMEOUT)) as session:
+        server_cpu = server_process.cpu_times()
+        client_cpu = time.process_time()
+        started = loop.time()
+        deadline = started + args.duration
+
+        async def start_player():
+            # Players join spread over the ramp up instead of all at once
+            await asyncio.sleep(rng.uniform(0, args.ramp_up))
+            bandwidth = rng.uniform(float(low), float(high or low)) * 1e6
+            await Player(session, base_url, bandwidth, stats).run(deadline)
+
+        await asyncio.gather(*(start_player() for _ in range(args.players)))
+        wall = loop.time() - started
+        server_cpu_seconds = sum(server_process.cpu_times()[:2]) - sum(server_cpu[:2])
+        client_cpu_seconds = time.process_time() - client_cpu
+
+    return dict(stats.report(wall), wall_seconds=round(wall, 2),
+                server_cpu_percent=round(100 * server_cpu_seconds / wall, 1),
+                client_cpu_percent=round(100 * client_cpu_seconds / wall, 1))
+
+
+def _print_report(result: dict, args):
+    source = 'memory' if args.memory_segments else 'files'
+    print(f"{args.players} players for {result['wall_seconds']}s, segments from {source}")
+    for kind, latency in result['latency_ms'].items():
+        print(f"{kind:>10}: {result['requests'][kind]:8d} requests  "
+              f"p50 {latency['p50'] or 0:8.2f} ms  p99 {latency['p99'] or 0:8.2f} ms")
+    print(f"throughput: {result['requests_per_second']:.1f} requests/s, "
+          f"{result['megabits_per_second']:.1f} Mbit/s")
+    print(f"    errors: {result['errors'] or 'none'}")
+    print(f"       ABR: {result['rendition_switches']} switches, {result['late_segments']} late segments, "
+          f"segments per rendition {result['segments_per_rendition']}")
+    print(f"       CPU: server {result['server_cpu_percent']:.1f}%, "
+          f"load generator {result['client_cpu_percent']:.1f}%")
+
+
+def main(args):
+    _raise_file_limit()
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as output_path:
+        config = StreamConfig(
+            input_url='rtsp://benchmark/stream',
+            output_path=output_path,
+            segment_duration=args.segment_duration,
+            enable_memory_segments=args.memory_segments,
+            enable_low_latency=False,
+            hls_server_port=port,
+        )
+        context = multiprocessing.get_context('spawn')
+        ready = context.Event()
+        process = context.Process(target=serve, args=(config, ready), name='hls_server')
+        process.start()
+        try:
+            if not ready.wait(30):
+                raise RuntimeError("HLS server did not start")
+            result = asyncio.run(run_load(f'http://127.0.0.1:{port}', psutil.Process(process.pid), args))
+        finally:
+            process.terminate()
+            process.join()
+
+    _print_report(result, args)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(dict(result, players=args.players, memory_segments=args.memory_segments,
+                           segment_duration=args.segment_duration), output_file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load after the ramp up starts')
+    parser.add_argument('--ramp-up', type=float, default=2, help='seconds over which players join')
+    parser.add_argument('--segment-duration', type=int, default=2)
+    parser.add_argument('--memory-segments', action='store_true', help='serve segments from memory, not files')
+    parser.add_argument('--bandwidth', default='0.5-8',
+                        help='link bandwidth of each player in Mbit/s, drawn from MIN-MAX, 0 for unlimited')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the results as JSON')
+    logging.basicConfig(level=logging.WARNING)
+    main(parser.parse_args())
@@ -0,0 +1,81 @@
+"""Playlist serving benchmark
+
+Compares rendering the media playlist on every request (the previous
+behaviour) with serving the pre-rendered bytes, with and without
+If-None-Match revalidation.
+
+Usage:
+    python -m benchmarks.playlist_benchmark [--requests N] [--concurrency N]
+"""
+import argparse
+import asyncio
+import logging
+import time
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+from src.config import StreamConfig
+from src.server import HLSServer
+from src.server.playlist import PLAYLIST_CONTENT_TYPE, render_media_playlist
+
+logger = logging.getLogger(__name__)
+
+RENDITION = '500000'
+
+
+def _build_server() -> HLSServer:
+    config = StreamConfig(input_url='rtsp://benchmark/stream', playlist_size=6)
+    server = HLSServer(config)
+    for segment_id in range(1, config.get_live_window_size() + 1):
+        server.segments.add({'id': segment_id, 'rendition': RENDITION, 'duration': 4.0})
+    server.playlists[RENDITION] = server._render_playlist(RENDITION)
+
+    async def render_per_request(request):
+        segments = server.segments.latest(RENDITION, config.playlist_size)
+        playlist = render_media_playlist(config, RENDITION, segments)
+        return web.Response(body=playlist.body, content_type=PLAYLIST_CONTENT_TYPE)
+
+    server.app.router.add_get('/uncached.m3u8', render_per_request)
+    return server
+
+
+async def _run(client: ClientSession, url: str, requests: int, concurrency: int, headers=None) -> float:
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            async with client.get(url, headers=headers) as response:
+                await response.read()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return requests / (time.perf_counter() - start)
+
+
+async def main(requests: int, concurrency: int):
+    server = _build_server()
+    async with TestServer(server.app) as test_server:
+        async with ClientSession() as client:
+            base = str(test_server.make_url(''))
+            async with client.get(f'{base}/stream_{RENDITION}.m3u8') as response:
+                etag = response.headers['ETag']
+
+            results = {
+                'render per request': await _run(client, f'{base}/uncached.m3u8', requests, concurrency),
+                'pre-rendered': await _run(client, f'{base}/stream_{RENDITION}.m3u8', requests, concurrency),
+                'pre-rendered, 304': await _run(client, f'{base}/stream_{RENDITION}.m3u8', requests,
+                                                concurrency, headers={'If-None-Match': etag}),
+            }
+
+    for name, rate in results.items():
+        print(f"{name:>20}: {rate:10.0f} requests/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args.requests, args.concurrency))
@@ -0,0 +1,279 @@
+"""RTSP control plane benchmark
+
+Measures how many RTSP requests one RTSPServer answers and what an idle
+session costs, apart from media. The server runs in a child process, so
+its CPU time and memory are measured apart from the load generator. It
+restreams a single encoded keyframe, enough to answer DESCRIBE.
+
+Runs four phases:
+    options     clients send OPTIONS one at a time and wait for each answer
+    pipelined   clients send batches of OPTIONS before reading the answers
+    handshake   clients go through DESCRIBE, SETUP, PLAY and TEARDOWN
+    keepalive   --sessions connections each set up and play a session over
+                TCP, then send GET_PARAMETER keepalives round after round
+
+Reports requests per second and server CPU per phase, plus the server RSS
+per idle playing session after the keepalive phase set them up.
+
+Usage:
+    python -m benchmarks.rtsp_benchmark [--sessions N] [--clients N] [--duration SECONDS]
+        [--pipeline DEPTH] [--output FILE]
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import multiprocessing
+import resource
+import socket
+import time
+from fractions import Fraction
+import av
+import numpy as np
+import psutil
+from src.config import StreamConfig
+from src.server import RTSPServer
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = 30
+# Connections opened at once while setting up the idle sessions
+CONNECT_BATCH = 500
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def _raise_file_limit():
+    """Allow one socket per session"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _encode_keyframe():
+    """An H.264 stream and one Annex B keyframe with its parameter sets"""
+    container = av.open(io.BytesIO(), 'w', format='mpegts')
+    stream = container.add_stream('libx264', rate=25)
+    stream.width, stream.height, stream.pix_fmt = 320, 240, 'yuv420p'
+    frame = av.VideoFrame.from_ndarray(np.zeros((240, 320, 3), np.uint8), format='rgb24').reformat(format='yuv420p')
+    frame.pts, frame.time_base = 0, Fraction(1, 25)
+    packets = list(stream.encode(frame)) + list(stream.encode(None))
+    return stream, bytes(packets[0])
+
+
+async def _serve(config: StreamConfig, ready):
+    _raise_file_limit()
+    server = RTSPServer(config)
+    await server.start()
+    stream, keyframe = _encode_keyframe()
+    server.set_source(stream)
+    server.send('video', keyframe, 0.0, True)
+    ready.set()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def serve(config: StreamConfig, ready):
+    """Run the RTSP server until terminated (child process)"""
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(_serve(config, ready))
+
+
+class Client:
+    """An RTSP connection sending requests and reading their answers"""
+
+    def __init__(self, reader, writer, url: str):
+        self.reader = reader
+        self.writer = writer
+        self.url = url
+        self.cseq = 0
+        self.session = None
+
+    @classmethod
+    async def connect(cls, port: int) -> 'Client':
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        return cls(reader, writer, f'rtsp://127.0.0.1:{port}/stream')
+
+    def send(self, method: str, url: str = None, headers: dict = None):
+        self.cseq += 1
+        lines = [f'{method} {url or self.url} RTSP/1.0', f'CSeq: {self.cseq}']
+        if self.session:
+            lines.append(f'Session: {self.session}')
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+
+    async def receive(self) -> dict:
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode()
+        status, *lines = head.strip().split('\r\n')
+        if not status.startswith('RTSP/1.0 2'):
+            raise RuntimeError(f"Request failed: {status}")
+        headers = dict(line.split(': ', 1) for line in lines)
+        await self.reader.readexactly(int(headers.get('Content-Length', 0)))
+        return headers
+
+    async def request(self, method: str, url: str = None, headers: dict = None) -> dict:
+        self.send(method, url, headers)
+        return await asyncio.wait_for(self.receive(), REQUEST_TIMEOUT)
+
+    async def play(self):
+        """Set up the video track over TCP and play it"""
+        headers = await self.request('SETUP', f'{self.url}/trackID=0',
+                                     {'Transport': 'RTP/AVP/TCP;unicast;interleaved=0-1'})
+        self.session = headers['Session'].split(';')[0]
+        await self.request('PLAY')
+
+    def close(self):
+        self.writer.close()
+
+
+class Phase:
+    """Counts requests and server CPU time over a phase"""
+
+    def __init__(self, server: psutil.Process):
+        self.server = server
+        self.requests = 0
+
+    def __enter__(self):
+        self.cpu = sum(self.server.cpu_times()[:2])
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.started
+        self.cpu = sum(self.server.cpu_times()[:2]) - self.cpu
+
+    def report(self) -> dict:
+        return dict(requests=self.requests, requests_per_second=round(self.requests / self.wall, 1),
+                    server_cpu_percent=round(100 * self.cpu / self.wall, 1))
+
+
+async def _options(client: Client, phase: Phase, deadline: float):
+    while time.perf_counter() < deadline:
+        await client.request('OPTIONS')
+        phase.requests += 1
+
+
+async def _pipelined(client: Client, phase: Phase, deadline: float, depth: int):
+    while time.perf_counter() < deadline:
+        for _ in range(depth):
+            client.send('OPTIONS')
+        for _ in range(depth):
+            await asyncio.wait_for(client.receive(), REQUEST_TIMEOUT)
+        phase.requests += depth
+
+
+async def _handshakes(client: Client, phase: Phase, deadline: float):
+    while time.perf_counter() < deadline:
+        await client.request('DESCRIBE', headers={'Accept': 'application/sdp'})
+        await client.play()
+        await client.request('TEARDOWN')
+        client.session = None
+        phase.requests += 4
+
+
+async def _phase(server: psutil.Process, clients: list, run, duration: float, *args) -> dict:
+    with Phase(server) as phase:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(run(client, phase, deadline, *args) for client in clients))
+    return phase.report()
+
+
+async def run_benchmark(port: int, server: psutil.Process, args) -> dict:
+    result = {}
+    clients = [await Client.connect(port) for _ in range(args.clients)]
+    try:
+        result['options'] = await _phase(server, clients, _options, args.duration)
+        result['pipelined'] = await _phase(server, clients, _pipelined, args.duration, args.pipeline)
+        result['handshake'] = await _phase(server, clients, _handshakes, args.duration)
+        result['handshake']['handshakes_per_second'] = round(result['handshake']['requests_per_second'] / 4, 1)
+    finally:
+        for client in clients:
+            client.close()
+
+    await asyncio.sleep(0.5)
+    rss_before = server.memory_info().rss
+    sessions = []
+    try:
+        for start in range(0, args.sessions, CONNECT_BATCH):
+            batch = await asyncio.gather(*(Client.connect(port)
+                                           for _ in range(min(CONNECT_BATCH, args.sessions - start))))
+            await asyncio.gather(*(client.play() for client in batch))
+            sessions += batch
+        await asyncio.sleep(0.5)
+        rss_after = server.memory_info().rss
+
+        with Phase(server) as phase:
+            deadline = time.perf_counter() + args.duration
+            rounds = 0
+            while time.perf_counter() < deadline:
+                for client in sessions:
+                    client.send('GET_PARAMETER')
+                await asyncio.gather(*(asyncio.wait_for(client.receive(), REQUEST_TIMEOUT) for client in sessions))
+                phase.requests += len(sessions)
+                rounds += 1
+        result['keepalive'] = dict(phase.report(), rounds=rounds)
+    finally:
+        for client in sessions:
+            client.close()
+
+    result['idle_sessions'] = dict(
+        sessions=len(sessions),
+        server_rss_mb=round(rss_after / 2 ** 20, 1),
+        rss_per_session_kb=round((rss_after - rss_before) / len(sessions) / 1024, 2)
+    )
+    return result
+
+
+def _print_report(result: dict, args):
+    print(f"{args.clients} clients for {args.duration}s per phase, pipelines of {args.pipeline}")
+    for name in ('options', 'pipelined', 'handshake', 'keepalive'):
+        phase = result[name]
+        print(f"{name:>10}: {phase['requests_per_second']:10.1f} requests/s  "
+              f"server CPU {phase['server_cpu_percent']:5.1f}%")
+    print(f"handshakes: {result['handshake']['handshakes_per_second']:.1f}/s")
+    idle = result['idle_sessions']
+    print(f"  sessions: {idle['sessions']} idle over TCP, server RSS {idle['server_rss_mb']} MB, "
+          f"{idle['rss_per_session_kb']} KB per session")
+
+
+def main(args):
+    _raise_file_limit()
+    port = _free_port()
+    config = StreamConfig(input_url='rtsp://benchmark/stream', output_path='.', rtsp_server_port=port,
+                          rtsp_rtp_port=0, rtsp_session_timeout=3600)
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    process = context.Process(target=serve, args=(config, ready), name='rtsp_server')
+    process.start()
+    try:
+        if not ready.wait(30):
+            raise RuntimeError("RTSP server did not start")
+        result = asyncio.run(run_benchmark(port, psutil.Process(process.pid), args))
+    finally:
+        process.terminate()
+        process.join()
+
+    _print_report(result, args)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(dict(result, clients=args.clients, pipeline=args.pipeline, duration=args.duration),
+                      output_file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=10000, help='idle playing sessions to set up')
+    parser.add_argument('--clients', type=int, default=50, help='connections sending requests in the other phases')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per phase')
+    parser.add_argument('--pipeline', type=int, default=16, help='requests per pipelined batch')
+    parser.add_argument('--output', help='also write the results as JSON')
+    logging.basicConfig(level=logging.WARNING)
+    main(parser.parse_args())
@@ -10,6 +10,8 @@ setup(
         'aiohttp-jinja2>=1.5.0',
         'jinja2>=3.0.0',
         'm3u8>=3.0.0',
+        'numpy>=1.21.0',
+        'prometheus_client>=0.13.0',
         'python-dotenv==1.0.1',
         'python-nginx==1.5.7'
     ]
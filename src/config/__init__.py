@@ -1,3 +1,3 @@
-from .stream_config import StreamConfig, StreamType
+from .stream_config import StreamConfig, StreamType, Rendition, AudioRendition
 
-__all__ = ['StreamConfig', 'StreamType']
+__all__ = ['StreamConfig', 'StreamType', 'Rendition', 'AudioRendition']
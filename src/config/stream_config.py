@@ -1,7 +1,9 @@
-from typing import List
-from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+from dataclasses import dataclass, field, replace
 from enum import Enum
+import math
 import os
+import re
 
 
 class StreamType(Enum):
@@ -17,14 +19,104 @@ def _parse_int_list(value: str) -> List[int]:
     return [int(x.strip()) for x in value.split(',')]
 
 
+def _parse_resolution_list(value: str) -> List[Tuple[int, int]]:
+    """Parse comma-separated WIDTHxHEIGHT values into a list of tuples"""
+    if not value:
+        return []
+    resolutions = []
+    for item in value.split(','):
+        width, height = item.strip().lower().split('x')
+        resolutions.append((int(width), int(height)))
+    return resolutions
+
+
+def _parse_stream_list(value: str) -> Dict[str, str]:
+    """Parse comma-separated name=url pairs into a dict"""
+    if not value:
+        return {}
+    streams = {}
+    for item in value.split(','):
+        name, url = item.strip().split('=', 1)
+        streams[name.strip()] = url.strip()
+    return streams
+
+
+# Stream names become URL path segments and directory names
+STREAM_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# File extension of media segments per segment format
+SEGMENT_EXTENSIONS = {'mpegts': 'ts', 'fmp4': 'm4s'}
+
+# swscale algorithms renditions can be scaled with
+SCALE_INTERPOLATIONS = ('point', 'fast_bilinear', 'bilinear', 'area', 'bicublin', 'bicubic',
+                        'gauss', 'sinc', 'lanczos', 'spline')
+
+# libavcodec threading, frame threads add a frame of delay each, auto allows both
+CODEC_THREAD_TYPES = ('none', 'slice', 'frame', 'auto')
+
+# x264 presets from fastest to slowest, the ones autotuning chooses from
+X264_PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow')
+
+# Channel layouts audio renditions are encoded in, by channel count, as libavutil picks them
+AUDIO_LAYOUTS = {1: 'mono', 2: 'stereo', 3: '2.1', 4: '4.0', 5: '5.0', 6: '5.1', 7: '6.1', 8: '7.1'}
+
+
+@dataclass(frozen=True)
+class Rendition:
+    """A single rung of the adaptive bitrate ladder"""
+    bitrate: int
+    width: int
+    height: int
+
+    @property
+    def name(self) -> str:
+        return str(self.bitrate)
+
+
+@dataclass(frozen=True)
+class AudioRendition:
+    """An audio-only rendition, one per audio bitrate, shared by every video rendition"""
+    bitrate: int
+
+    @property
+    def name(self) -> str:
+        return f'audio_{self.bitrate}'
+
+
 @dataclass
 class StreamConfig:
     input_url: str = os.getenv('INPUT_RTSP', '')
     output_path: str = os.getenv('OUTPUT_HLS', '/app/hls_output')
+    # Named inputs for multi-stream mode, each converted in its own worker process
+    input_streams: Dict[str, str] = field(default_factory=lambda: _parse_stream_list(
+        os.getenv('INPUT_STREAMS', '')
+    ))
+    # Seconds before restarting a crashed worker, doubled for every consecutive crash
+    worker_restart_delay: float = float(os.getenv('WORKER_RESTART_DELAY', '1'))
+    # Name of a stream in multi-stream mode, set by get_stream_configs and used as metrics label
+    stream_name: str = ''
     
     # HLS Configuration
     segment_duration: int = int(os.getenv('HLS_SEGMENT_DURATION', '4'))
     playlist_size: int = int(os.getenv('HLS_PLAYLIST_SIZE', '5'))
+    # Extra segments kept beyond the playlist for players still downloading them
+    segment_safety_margin: int = int(os.getenv('HLS_SEGMENT_SAFETY_MARGIN', '2'))
+    # Seconds to keep segment files after they leave the live window
+    segment_grace_period: float = float(os.getenv('HLS_SEGMENT_GRACE_PERIOD', '30'))
+    # Seconds CDNs and players may cache finished segments and parts, their content never changes
+    segment_max_age: int = int(os.getenv('HLS_SEGMENT_MAX_AGE', '86400'))
+    # Tag responses with Surrogate-Key headers, so a CDN can purge a stream or rendition
+    enable_surrogate_keys: bool = os.getenv('HLS_SURROGATE_KEYS', 'false').lower() == 'true'
+    # Keep segments in memory instead of writing them to output_path
+    enable_memory_segments: bool = os.getenv('HLS_MEMORY_SEGMENTS', 'false').lower() == 'true'
+    # Also write in-memory segments to output_path for DVR
+    enable_dvr: bool = os.getenv('HLS_DVR', 'false').lower() == 'true'
+    # Publish partial segments and answer blocking playlist reloads (LL-HLS)
+    enable_low_latency: bool = os.getenv('HLS_LOW_LATENCY', 'false').lower() == 'true'
+    # Upper bound of the partial segment duration in seconds
+    part_duration: float = float(os.getenv('HLS_PART_DURATION', '0.3'))
+    # Segment container, mpegts or fmp4 (CMAF fragments sharing one init segment)
+    segment_format: str = os.getenv('HLS_SEGMENT_FORMAT', 'mpegts')
     
     # Video Configuration
     video_bitrates: List[int] = field(default_factory=lambda: _parse_int_list(
@@ -32,10 +124,36 @@ class StreamConfig:
     ))
     video_codec: str = os.getenv('VIDEO_CODEC', 'h264')
     video_preset: str = os.getenv('VIDEO_PRESET', 'ultrafast')
+    # Optional per-bitrate resolutions, derived from width/height when empty
+    video_resolutions: List[Tuple[int, int]] = field(default_factory=lambda: _parse_resolution_list(
+        os.getenv('VIDEO_RESOLUTIONS', '')
+    ))
     width: int = int(os.getenv('VIDEO_WIDTH', '1280'))
     height: int = int(os.getenv('VIDEO_HEIGHT', '720'))
     fps: int = int(os.getenv('VIDEO_FPS', '30'))
     keyframe_interval: int = int(os.getenv('VIDEO_KEYFRAME_INTERVAL', '60'))
+    # swscale algorithm renditions are scaled with
+    scale_interpolation: str = os.getenv('VIDEO_SCALE_INTERPOLATION', 'bilinear').lower()
+    # Codec threading, 0 threads lets libav pick one per CPU
+    decoder_thread_type: str = os.getenv('DECODER_THREAD_TYPE', 'slice').lower()
+    decoder_threads: int = int(os.getenv('DECODER_THREADS', '0'))
+    encoder_thread_type: str = os.getenv('ENCODER_THREAD_TYPE', 'slice').lower()
+    encoder_threads: int = int(os.getenv('ENCODER_THREADS', '0'))
+    # Calibrate at startup for the slowest preset and encoder threading that keeps up
+    enable_autotune: bool = os.getenv('VIDEO_AUTOTUNE', 'false').lower() == 'true'
+    # Realtime factor every rendition has to reach during the calibration
+    autotune_target: float = float(os.getenv('VIDEO_AUTOTUNE_TARGET', '1.5'))
+    # Lower the frame rate and bitrate while the scene does not move
+    enable_motion_adaptive: bool = os.getenv('MOTION_ADAPTIVE', 'false').lower() == 'true'
+    # Fraction of pixels that have to change between frames to count as motion
+    motion_threshold: float = float(os.getenv('MOTION_THRESHOLD', '0.005'))
+    # Seconds without motion before the scene counts as static
+    motion_hold: float = float(os.getenv('MOTION_HOLD', '5'))
+    motion_static_fps: float = float(os.getenv('MOTION_STATIC_FPS', '1'))
+    # Fraction of the rendition bitrates spent on static scenes
+    motion_static_bitrate: float = float(os.getenv('MOTION_STATIC_BITRATE', '0.25'))
+    # Processes running the frame hooks of a stream processor
+    processor_workers: int = int(os.getenv('PROCESSOR_WORKERS', '1'))
     
     # Audio Configuration
     audio_bitrates: List[int] = field(default_factory=lambda: _parse_int_list(
@@ -44,38 +162,110 @@ class StreamConfig:
     audio_codec: str = os.getenv('AUDIO_CODEC', 'aac')
     audio_sample_rate: int = int(os.getenv('AUDIO_SAMPLE_RATE', '44100'))
     audio_channels: int = int(os.getenv('AUDIO_CHANNELS', '2'))
+    # Encode audio once per audio bitrate into audio-only renditions instead of into every video segment
+    enable_audio_renditions: bool = os.getenv('AUDIO_RENDITIONS', 'true').lower() == 'true'
     
     # Buffer Configuration
     max_buffer_size: int = int(os.getenv('MAX_BUFFER_SIZE', '60'))
+    # Seconds decoding may fall behind a live input before frames are dropped, 0 never drops
+    max_encode_lag: float = float(os.getenv('MAX_ENCODE_LAG', '3'))
     
     # RTSP Configuration
     rtsp_transport: str = os.getenv('RTSP_TRANSPORT', 'tcp')
     rtsp_timeout: int = int(os.getenv('RTSP_TIMEOUT', '5000000'))
+    # Reopen a lost or ended input instead of stopping the conversion
+    enable_reconnect: bool = os.getenv('INPUT_RECONNECT', 'true').lower() == 'true'
+    # Seconds before the second reconnection attempt, doubled up to the maximum for later ones
+    reconnect_delay: float = float(os.getenv('INPUT_RECONNECT_DELAY', '0.5'))
+    reconnect_max_delay: float = float(os.getenv('INPUT_RECONNECT_MAX_DELAY', '10'))
+    # Failed attempts before giving up on the input, 0 retries forever
+    reconnect_attempts: int = int(os.getenv('INPUT_RECONNECT_ATTEMPTS', '0'))
     
     # Server Configuration
     rtsp_server_port: int = int(os.getenv('RTSP_SERVER_PORT', '8554'))
+    # UDP port RTP is sent from to clients that set up UDP transport, RTCP uses the next one, 0 picks free ports
+    rtsp_rtp_port: int = int(os.getenv('RTSP_RTP_PORT', '8000'))
+    # Bytes queued for an RTSP client over TCP before it skips ahead to the next keyframe
+    rtsp_client_buffer: int = int(os.getenv('RTSP_CLIENT_BUFFER', '1048576'))
+    # Seconds an RTSP session lives without a request, RTCP receiver report or keepalive from its client
+    rtsp_session_timeout: float = float(os.getenv('RTSP_SESSION_TIMEOUT', '60'))
     hls_server_port: int = int(os.getenv('HLS_SERVER_PORT', '8080'))
     
     # Feature Flags
     enable_stats: bool = os.getenv('ENABLE_STATS', 'true').lower() == 'true'
     enable_debug: bool = os.getenv('ENABLE_DEBUG', 'false').lower() == 'true'
+    # Remux compatible inputs into the top rendition instead of transcoding
+    enable_passthrough: bool = os.getenv('ENABLE_PASSTHROUGH', 'false').lower() == 'true'
 
     def __post_init__(self):
         """Validate configuration after initialization"""
-        if not self.input_url:
+        if not self.input_url and not self.input_streams:
             raise ValueError("INPUT_RTSP environment variable is required")
+
+        for name in self.input_streams:
+            if not STREAM_NAME_PATTERN.match(name):
+                raise ValueError(f"Invalid stream name: {name}")
+
+        if self.worker_restart_delay < 0:
+            raise ValueError("Invalid worker restart delay")
         
         if not self.video_bitrates:
             raise ValueError("At least one video bitrate must be specified")
             
         if not self.audio_bitrates:
             raise ValueError("At least one audio bitrate must be specified")
+
+        if self.audio_sample_rate <= 0:
+            raise ValueError("Invalid audio sample rate")
+
+        if self.audio_channels not in AUDIO_LAYOUTS:
+            raise ValueError(f"Invalid audio channel count: {self.audio_channels}")
             
         if self.width <= 0 or self.height <= 0:
             raise ValueError("Invalid video dimensions")
+
+        if self.video_resolutions and len(self.video_resolutions) != len(self.video_bitrates):
+            raise ValueError("VIDEO_RESOLUTIONS must have one entry per video bitrate")
             
         if self.fps <= 0:
             raise ValueError("Invalid FPS value")
+
+        if self.scale_interpolation not in SCALE_INTERPOLATIONS:
+            raise ValueError(f"Invalid scale interpolation: {self.scale_interpolation}")
+
+        for thread_type in (self.decoder_thread_type, self.encoder_thread_type):
+            if thread_type not in CODEC_THREAD_TYPES:
+                raise ValueError(f"Invalid codec thread type: {thread_type}")
+
+        if self.decoder_threads < 0 or self.encoder_threads < 0:
+            raise ValueError("Invalid codec thread count")
+
+        if self.autotune_target <= 0:
+            raise ValueError("Invalid autotune target")
+
+        if not 0 <= self.motion_threshold <= 1:
+            raise ValueError("Invalid motion threshold")
+
+        if self.motion_hold < 0:
+            raise ValueError("Invalid motion hold")
+
+        if not 0 < self.motion_static_fps <= self.fps:
+            raise ValueError("Invalid static scene frame rate")
+
+        if not 0 < self.motion_static_bitrate <= 1:
+            raise ValueError("Invalid static scene bitrate")
+
+        if self.processor_workers < 1:
+            raise ValueError("Invalid processor worker count")
+
+        if not 0 <= self.rtsp_rtp_port < 65535:
+            raise ValueError("Invalid RTP port")
+
+        if self.rtsp_client_buffer <= 0:
+            raise ValueError("Invalid RTSP client buffer size")
+
+        if self.rtsp_session_timeout <= 0:
+            raise ValueError("Invalid RTSP session timeout")
             
         if self.segment_duration <= 0:
             raise ValueError("Invalid segment duration")
@@ -83,6 +273,88 @@ class StreamConfig:
         if self.playlist_size <= 0:
             raise ValueError("Invalid playlist size")
 
+        if self.segment_safety_margin < 0:
+            raise ValueError("Invalid segment safety margin")
+
+        if self.segment_grace_period < 0:
+            raise ValueError("Invalid segment grace period")
+
+        if self.segment_max_age < 0:
+            raise ValueError("Invalid segment max age")
+
+        if not 0 <= self.reconnect_delay <= self.reconnect_max_delay:
+            raise ValueError("Invalid reconnect delays")
+
+        if self.max_encode_lag < 0:
+            raise ValueError("Invalid maximum encode lag")
+
+        if self.reconnect_attempts < 0:
+            raise ValueError("Invalid reconnect attempts")
+
+        if not 0 < self.part_duration <= self.segment_duration:
+            raise ValueError("Invalid part duration")
+
+        if self.segment_format not in SEGMENT_EXTENSIONS:
+            raise ValueError(f"Invalid segment format: {self.segment_format}")
+
+    def get_stream_configs(self) -> Dict[str, 'StreamConfig']:
+        """Get a single-input configuration per named stream, each with its own output directory"""
+        return {
+            name: replace(self, input_url=url, input_streams={}, stream_name=name,
+                          output_path=os.path.join(self.output_path, name))
+            for name, url in self.input_streams.items()
+        }
+
+    def get_live_window_size(self) -> int:
+        """Get the number of segments kept per rendition"""
+        return self.playlist_size + self.segment_safety_margin
+
+    def get_segment_extension(self) -> str:
+        """Get the file extension of media segments"""
+        return SEGMENT_EXTENSIONS[self.segment_format]
+
+    def get_playlist_max_age(self) -> int:
+        """Get the seconds a live playlist may be cached, half the target duration rounded up"""
+        return max(1, math.ceil(self.segment_duration / 2))
+
+    def get_part_hold_back(self) -> float:
+        """Get how far behind the live edge LL-HLS players start, three part targets"""
+        return round(3 * self.part_duration, 6)
+
+    def get_static_fps(self) -> float:
+        """Frame rate of static scenes, in low latency mode every part still needs a frame"""
+        if self.enable_low_latency:
+            return min(self.fps, max(self.motion_static_fps, 1 / self.part_duration))
+        return self.motion_static_fps
+
+    def get_renditions(self) -> List[Rendition]:
+        """Get the ABR ladder, one rendition per video bitrate
+
+        Without explicit resolutions the highest bitrate uses width/height and
+        lower rungs are scaled down by the square root of their bitrate ratio.
+        """
+        if self.video_resolutions:
+            return [Rendition(bitrate, width, height)
+                    for bitrate, (width, height) in zip(self.video_bitrates, self.video_resolutions)]
+
+        top_bitrate = max(self.video_bitrates)
+        renditions = []
+        for bitrate in self.video_bitrates:
+            scale = math.sqrt(bitrate / top_bitrate)
+            # Encoders need even dimensions for yuv420p
+            width = max(2, int(self.width * scale) // 2 * 2)
+            height = max(2, int(self.height * scale) // 2 * 2)
+            renditions.append(Rendition(bitrate, width, height))
+        return renditions
+
+    def get_audio_renditions(self) -> List[AudioRendition]:
+        """Get the audio-only renditions, one per audio bitrate"""
+        return [AudioRendition(bitrate) for bitrate in self.audio_bitrates]
+
+    def get_audio_layout(self) -> str:
+        """Get the channel layout of the audio renditions"""
+        return AUDIO_LAYOUTS[self.audio_channels]
+
     def get_rtsp_options(self) -> dict:
         """Get RTSP-specific options"""
         return {
@@ -91,12 +363,15 @@ class StreamConfig:
         }
 
     def get_video_options(self) -> dict:
-        """Get video codec options"""
+        """Get the private options of the video encoder, the GOP size is set on the encoder itself"""
+        if self.video_codec != 'h264':
+            return {}
         return {
             'preset': self.video_preset,
             'tune': 'zerolatency',
             'profile': 'baseline',
-            'x264opts': f'keyint={self.keyframe_interval}:min-keyint={self.keyframe_interval}'
+            # Frames forced to I at segment boundaries become IDR frames
+            'forced-idr': '1'
         }
 
     def get_audio_options(self) -> dict:
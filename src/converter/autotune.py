@@ -0,0 +1,108 @@
+"""Startup calibration of the encoder preset and threading for the current host"""
+import io
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import List
+import av
+from av.video.reformatter import VideoReformatter
+from ..config import StreamConfig
+from ..config.stream_config import X264_PRESETS
+from .segment_writer import add_video_encoder
+
+logger = logging.getLogger(__name__)
+
+# Seconds of media every rendition encodes per calibration run
+CALIBRATION_SECONDS = 1.0
+# Moving test pattern with temporal noise, which costs the encoder about as much as a camera
+CALIBRATION_SOURCE = 'testsrc2=size={width}x{height}:rate={fps},noise=alls=12:allf=t+u'
+
+
+def calibration_frames(config: StreamConfig, seconds: float = CALIBRATION_SECONDS) -> List[av.VideoFrame]:
+    """Generate the input frames of a calibration run at the configured size and frame rate"""
+    source = CALIBRATION_SOURCE.format(width=config.width, height=config.height, fps=config.fps)
+    with av.open(source, format='lavfi') as container:
+        frames = []
+        for frame in container.decode(video=0):
+            frames.append(frame)
+            if len(frames) >= seconds * config.fps:
+                return frames
+    return frames
+
+
+def _encode(config: StreamConfig, rendition, frames: List[av.VideoFrame], deadline: float) -> float:
+    """Scale and encode frames like a segment writer, the media seconds done per second (blocking)"""
+    container = av.open(io.BytesIO(), 'w', format='mpegts')
+    try:
+        encoder = add_video_encoder(container, config, rendition, frames[0].time_base)
+        reformatter = VideoReformatter()
+        interpolation = config.scale_interpolation.upper()
+        started = time.perf_counter()
+        encoded = 0
+        for frame in frames:
+            if time.perf_counter() > deadline:
+                break
+            frame = reformatter.reformat(frame, width=rendition.width, height=rendition.height,
+                                         format='yuv420p', interpolation=interpolation)
+            encoder.encode(frame)
+            encoded += 1
+        encoder.encode(None)
+        return encoded / config.fps / (time.perf_counter() - started)
+    finally:
+        container.close()
+
+
+def calibrate(config: StreamConfig, frames: List[av.VideoFrame]) -> float:
+    """Encode frames into every rendition at once, the realtime factor of the slowest one
+
+    Renditions run on their own threads as in the pipeline, so they compete
+    for the CPUs like they will while converting. A run stops as soon as it
+    cannot reach the autotune target anymore.
+    """
+    renditions = config.get_renditions()
+    deadline = time.perf_counter() + len(frames) / config.fps / config.autotune_target
+    with ThreadPoolExecutor(max_workers=len(renditions)) as executor:
+        factors = list(executor.map(lambda rendition: _encode(config, rendition, frames, deadline),
+                                    renditions))
+    return min(factors)
+
+
+def autotune(config: StreamConfig) -> StreamConfig:
+    """Pick the slowest x264 preset and encoder threading keeping every rendition above the target (blocking)
+
+    Presets are tried from the fastest on, each with slice threads first and
+    frame threads, which add latency, second. The search ends at the first
+    preset no threading keeps up with. Without any that keeps up, the
+    fastest preset is used.
+    """
+    if config.video_codec != 'h264':
+        logger.warning(f"Autotune only supports h264, keeping the configuration of {config.video_codec}")
+        return config
+
+    frames = calibration_frames(config)
+    threads = max(1, (os.cpu_count() or 1) // len(config.video_bitrates))
+    thread_types = ('slice', 'frame') if threads > 1 else ('slice',)
+    started = time.perf_counter()
+    tuned = None
+    for preset in X264_PRESETS:
+        for thread_type in thread_types:
+            candidate = replace(config, video_preset=preset, encoder_thread_type=thread_type,
+                                encoder_threads=threads)
+            factor = calibrate(candidate, frames)
+            logger.info(f"Autotune: preset {preset}, {thread_type} threading with {threads} threads "
+                        f"per rendition runs at {factor:.2f}x realtime")
+            if factor >= config.autotune_target:
+                tuned = candidate
+                break
+        else:
+            break
+
+    if tuned is None:
+        logger.warning(f"No preset reaches {config.autotune_target}x realtime, using {X264_PRESETS[0]}")
+        tuned = replace(config, video_preset=X264_PRESETS[0], encoder_thread_type=thread_types[0],
+                        encoder_threads=threads)
+    logger.info(f"Autotune chose preset {tuned.video_preset}, {tuned.encoder_thread_type} threading with "
+                f"{tuned.encoder_threads} threads per rendition in {time.perf_counter() - started:.1f}s")
+    return tuned
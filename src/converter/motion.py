@@ -0,0 +1,71 @@
+import logging
+from typing import Optional
+import av
+import numpy as np
+from av.video.reformatter import VideoReformatter
+from .pipeline import FrameDecimator
+
+logger = logging.getLogger(__name__)
+
+# Luma change a pixel needs to count as moving, above the sensor noise of most cameras
+PIXEL_THRESHOLD = 12
+# Width in pixels frames are averaged down to before comparing them, which also evens out noise
+ANALYSIS_WIDTH = 160
+
+
+class MotionDetector:
+    """Scores the motion between decoded frames and thins out static scenes
+
+    The score is the fraction of pixels of the downscaled luma plane that
+    changed by more than PIXEL_THRESHOLD since the previous frame. After
+    hold seconds below threshold the scene is static: frames are thinned
+    out to static_fps and the writers lower their bitrate. The first frame
+    with motion switches back to full quality.
+    """
+
+    def __init__(self, threshold: float, hold: float, static_fps: float):
+        self.threshold = threshold
+        self.hold = hold
+        self.decimator = FrameDecimator(static_fps)
+        # Renditions read these from their encode threads
+        self.score = 0.0
+        self.static = False
+        self.previous: Optional[np.ndarray] = None
+        # Media time of the latest frame with motion
+        self.last_motion: Optional[float] = None
+        self.reformatter = VideoReformatter()
+
+    def _luma(self, frame: av.VideoFrame) -> np.ndarray:
+        """Luma of a frame averaged down to ANALYSIS_WIDTH, as int16 to subtract without wrapping"""
+        width = min(frame.width, ANALYSIS_WIDTH)
+        height = max(1, frame.height * width // frame.width)
+        small = self.reformatter.reformat(frame, width=width, height=height, format='gray',
+                                          interpolation='AREA')
+        return small.to_ndarray().astype(np.int16)
+
+    def keep(self, frame: av.VideoFrame) -> bool:
+        """Update the motion score with a decoded frame and tell whether to encode it"""
+        luma = self._luma(frame)
+        if self.previous is not None and self.previous.shape == luma.shape:
+            self.score = np.count_nonzero(np.abs(luma - self.previous) > PIXEL_THRESHOLD) / luma.size
+        self.previous = luma
+
+        media_time = frame.time
+        if media_time is None:
+            return True
+        if self.last_motion is None or self.score >= self.threshold:
+            self.last_motion = media_time
+        static = media_time - self.last_motion >= self.hold
+        if static != self.static:
+            logger.info(f"Scene turned {'static' if static else 'moving'} at {media_time:.1f}s "
+                        f"(motion score {self.score:.4f})")
+            self.static = static
+            # Static periods thin out from their first frame on
+            self.decimator.start = None
+        return not static or self.decimator.keep(frame)
+
+    def reset(self):
+        """Forget the previous frame, a reopened input starts with motion"""
+        self.previous = None
+        self.last_motion = None
+        self.static = False
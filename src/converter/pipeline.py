@@ -0,0 +1,554 @@
+import logging
+import math
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+import av
+from .probe import is_reference_frame
+
+logger = logging.getLogger(__name__)
+
+# Marker pushed through the queues once a stage has no more items
+END_OF_STREAM = object()
+
+# How long blocking queue operations wait before re-checking the stop flag
+QUEUE_POLL_INTERVAL = 0.1
+
+# How long the filter stage waits for a hook result before checking for new frames
+FILTER_POLL_INTERVAL = 0.005
+
+# Fraction of an output frame interval a frame may come early and still count for it
+DECIMATION_TOLERANCE = 0.1
+
+
+class PipelineStage(threading.Thread):
+    """Base class for a media pipeline stage running on its own thread"""
+
+    def __init__(self, name: str, stop_event: threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.stop_event = stop_event
+        self.error: Optional[BaseException] = None
+
+    def run(self):
+        logger.debug(f"Pipeline stage {self.name} started")
+        try:
+            self.process()
+        except Exception as e:
+            logger.error(f"Error in pipeline stage {self.name}: {e}", exc_info=True)
+            self.error = e
+            self.stop_event.set()
+        finally:
+            self.finish()
+            logger.debug(f"Pipeline stage {self.name} finished")
+
+    def process(self):
+        """Stage main loop, implemented by subclasses"""
+        raise NotImplementedError
+
+    def finish(self):
+        """Called once when the stage exits, even after an error"""
+
+    def put(self, output_queue: queue.Queue, item) -> bool:
+        """Put an item on a bounded queue, giving up when the pipeline stops"""
+        while not self.stop_event.is_set():
+            try:
+                output_queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, input_queue: queue.Queue):
+        """Get an item from a queue, returning END_OF_STREAM when the pipeline stops"""
+        while not self.stop_event.is_set():
+            try:
+                return input_queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return END_OF_STREAM
+
+    def end(self, output_queue: queue.Queue):
+        """Signal end of stream downstream"""
+        # Once stopped, downstream stages exit on their own at their next get()
+        self.put(output_queue, END_OF_STREAM)
+
+
+class Discontinuity:
+    """Marker sent down the queues when a lost input was reopened
+
+    Carries the streams of the new input. The container of the lost input is
+    closed once every stage consuming its packets has passed the marker.
+    """
+
+    def __init__(self, streams: list, previous_container, consumers: int):
+        self.streams = streams
+        self.video_stream = next((s for s in streams if s.type == 'video'), None)
+        self.audio_stream = next((s for s in streams if s.type == 'audio'), None)
+        self.previous_container = previous_container
+        self._consumers = consumers
+        self._lock = threading.Lock()
+
+    def release(self):
+        """Called by each packet consumer once it no longer uses the previous input"""
+        with self._lock:
+            self._consumers -= 1
+            if self._consumers:
+                return
+        try:
+            self.previous_container.close()
+        except Exception as e:
+            logger.error(f"Error closing lost input: {e}", exc_info=True)
+
+
+class RealtimeScheduler:
+    """Tracks how far decoding falls behind a live input and picks the video packets to drop
+
+    The lag is the wall clock time passed since the first packet minus the
+    media time passed. An input read faster than real time, like a file,
+    moves the anchor forward, so only falling behind counts. Beyond max_lag
+    packets no other frame references are dropped, beyond twice max_lag every
+    video packet up to the next keyframe. Keyframes are always decoded.
+    """
+
+    def __init__(self, max_lag: float, clock: Callable[[], float] = time.monotonic):
+        self.max_lag = max_lag
+        self.clock = clock
+        # (wall clock, media time) that a lag of zero is measured from
+        self.origin: Optional[Tuple[float, float]] = None
+        self.lag = 0.0
+        self.skipping = False
+
+    def should_drop(self, packet) -> bool:
+        """Update the lag with a video packet and tell whether to drop it undecoded"""
+        timestamp = packet.dts if packet.dts is not None else packet.pts
+        if timestamp is None:
+            return False
+        media_time = float(timestamp * packet.time_base)
+        now = self.clock()
+        if self.origin is None or now - self.origin[0] < media_time - self.origin[1]:
+            self.origin = (now, media_time)
+        self.lag = (now - self.origin[0]) - (media_time - self.origin[1])
+
+        if packet.is_keyframe:
+            self.skipping = False
+            return False
+        if self.skipping:
+            return True
+        if self.lag > 2 * self.max_lag:
+            logger.warning(f"Decoding is {self.lag:.1f}s behind the input, skipping to the next keyframe")
+            self.skipping = True
+            return True
+        return self.lag > self.max_lag and not is_reference_frame(packet)
+
+    def reset(self):
+        """Start measuring anew, the timestamps of a reopened input are unrelated"""
+        self.origin = None
+        self.lag = 0.0
+        self.skipping = False
+
+
+class FrameDecimator:
+    """Thins decoded video out to a maximum frame rate
+
+    Frames are placed on a grid of output intervals starting at the first
+    frame and the first frame of every interval is kept, so 30 fps becomes
+    exactly 10, 15 or 20 fps. Kept frames keep their timestamps, the encoder
+    runs in the input time base, and last at least one output interval.
+    """
+
+    def __init__(self, fps: float):
+        self.interval = 1 / fps
+        self.start: Optional[float] = None
+        self.last_index = -1
+
+    def keep(self, frame: av.VideoFrame) -> bool:
+        media_time = frame.time
+        if media_time is None:
+            return True
+        if self.start is None or media_time < self.start:
+            self.start = media_time
+            self.last_index = -1
+        index = math.floor((media_time - self.start) / self.interval + DECIMATION_TOLERANCE)
+        if index <= self.last_index:
+            return False
+        self.last_index = index
+        if frame.time_base is not None:
+            frame.duration = max(frame.duration or 0, round(self.interval / frame.time_base))
+        return True
+
+
+def copy_packet(packet: av.Packet) -> av.Packet:
+    """Copy a packet so that another stage can rebase and mux it independently"""
+    clone = av.Packet(bytes(packet))
+    clone.pts = packet.pts
+    clone.dts = packet.dts
+    clone.time_base = packet.time_base
+    clone.duration = packet.duration
+    clone.is_keyframe = packet.is_keyframe
+    clone.stream = packet.stream
+    return clone
+
+
+class DemuxStage(PipelineStage):
+    """Reads packets from the input container and hands them to every consumer
+
+    With a reopen callback a lost or ended input is replaced by the one it
+    returns, announced downstream by a Discontinuity marker. Timestamps of
+    the new input are shifted to continue after the old ones, plus the time
+    the input was down, so encoders and segment timelines keep counting up.
+    """
+
+    def __init__(self, input_container, streams: list, packet_queues: List[queue.Queue],
+                 stop_event: threading.Event,
+                 reopen: Optional[Callable[[threading.Event], Optional[Tuple[object, list]]]] = None,
+                 timer=None):
+        super().__init__('demux', stop_event)
+        self.input_container = input_container
+        self.streams = streams
+        self.packet_queues = packet_queues
+        self.reopen = reopen
+        # Histogram observing the time to read each packet
+        self.timer = timer
+        # Seconds added to the timestamps of the current input, None until its first packet
+        self.time_offset: Optional[float] = 0.0
+        # Media time the current input continues from and the end of the latest packet
+        self.resume_time = 0.0
+        self.media_end: Optional[float] = None
+
+    def process(self):
+        while True:
+            try:
+                if not self._demux() or self.reopen is None:
+                    return
+                logger.warning("Input ended")
+            except Exception as e:
+                if self.reopen is None:
+                    raise
+                logger.warning(f"Input lost: {e}")
+
+            lost_at = time.monotonic()
+            reopened = self.reopen(self.stop_event)
+            if reopened is None:
+                return
+            container, streams = reopened
+            marker = Discontinuity(streams, self.input_container, len(self.packet_queues))
+            self.input_container, self.streams = container, streams
+            self.time_offset = None
+            self.resume_time = (self.media_end or 0.0) + time.monotonic() - lost_at
+            for packet_queue in self.packet_queues:
+                if not self.put(packet_queue, marker):
+                    return
+
+    def _demux(self) -> bool:
+        """Hand out the packets of the current input, False when the pipeline stopped"""
+        started = time.perf_counter()
+        for packet in self.input_container.demux(self.streams):
+            if self.timer is not None:
+                self.timer.observe(time.perf_counter() - started)
+            # Flush packets carry no data, DecodeStage flushes the decoders itself.
+            # RTSP may deliver the first packets without timestamps, they still decode
+            if packet.size == 0:
+                continue
+            if self.reopen is not None:
+                self._rebase(packet)
+            # Decoding and muxing modify packets, so extra consumers get their own copy
+            for index, packet_queue in enumerate(self.packet_queues):
+                if not self.put(packet_queue, packet if index == 0 else copy_packet(packet)):
+                    return False
+            # Time blocked on full queues is not demux time
+            started = time.perf_counter()
+        return True
+
+    def _rebase(self, packet: av.Packet):
+        """Shift a packet onto the continued timeline and track where the input ends"""
+        timestamp = packet.dts if packet.dts is not None else packet.pts
+        if timestamp is None:
+            return
+        if self.time_offset is None:
+            self.time_offset = self.resume_time - float(timestamp * packet.time_base)
+        if self.time_offset:
+            shift = round(self.time_offset / packet.time_base)
+            if packet.dts is not None:
+                packet.dts += shift
+            if packet.pts is not None:
+                packet.pts += shift
+        # Only from the shifted timestamps, the source ones belong to the timeline of the input
+        shifted = max(t for t in (packet.dts, packet.pts) if t is not None)
+        end = float((shifted + (packet.duration or 0)) * packet.time_base)
+        if self.media_end is None or end > self.media_end:
+            self.media_end = end
+
+    def finish(self):
+        for packet_queue in self.packet_queues:
+            self.end(packet_queue)
+
+
+class DecodeStage(PipelineStage):
+    """Decodes demuxed packets once and fans the frames out to every encoder
+
+    With a scheduler, video packets are dropped before decoding while the
+    pipeline runs behind a live input, with a decimator, decoded frames above
+    the output frame rate are dropped before any rendition scales them, and
+    with a motion detector, static scenes are thinned out further. Every
+    rendition then misses the same frames, so their segments stay aligned.
+    Packets of media types none of the given streams has are not decoded.
+    """
+
+    def __init__(self, streams: list, packet_queue: queue.Queue, frame_queues: List[queue.Queue],
+                 stop_event: threading.Event, on_error: Callable[[Exception], None] = None,
+                 timer=None, scheduler: Optional[RealtimeScheduler] = None,
+                 on_drop: Optional[Callable[[], None]] = None,
+                 decimator: Optional[FrameDecimator] = None, motion=None):
+        super().__init__('decode', stop_event)
+        self.streams = streams
+        # Media types to decode, a reopened input keeps them even when it has more streams
+        self.types = {stream.type for stream in streams}
+        self.packet_queue = packet_queue
+        self.frame_queues = frame_queues
+        self.on_error = on_error
+        # Histogram observing the time to decode each packet
+        self.timer = timer
+        self.scheduler = scheduler
+        self.on_drop = on_drop
+        self.decimator = decimator
+        self.motion = motion
+
+    def process(self):
+        while True:
+            packet = self.get(self.packet_queue)
+            if packet is END_OF_STREAM:
+                break
+            if isinstance(packet, Discontinuity):
+                if not self._switch_input(packet):
+                    return
+                continue
+            if packet.stream.type not in self.types:
+                continue
+            if (self.scheduler is not None and packet.stream.type == 'video'
+                    and self.scheduler.should_drop(packet)):
+                if self.on_drop:
+                    self.on_drop()
+                continue
+            if not self._forward(packet.stream, packet):
+                return
+
+        if not self.stop_event.is_set():
+            for stream in self.streams:
+                self._forward(stream, None)
+
+    def _switch_input(self, marker: Discontinuity) -> bool:
+        """Drain the decoders of the lost input and pass the marker on to the encoders"""
+        for stream in self.streams:
+            if not self._forward(stream, None):
+                return False
+        self.streams = [stream for stream in marker.streams if stream.type in self.types]
+        marker.release()
+        if self.scheduler is not None:
+            self.scheduler.reset()
+        if self.motion is not None:
+            self.motion.reset()
+        for frame_queue in self.frame_queues:
+            if not self.put(frame_queue, marker):
+                return False
+        return True
+
+    def _forward(self, stream, packet) -> bool:
+        """Decode a packet (or flush the decoder with None) and pass the frames downstream"""
+        try:
+            started = time.perf_counter()
+            frames = stream.decode(packet)
+            if self.timer is not None:
+                self.timer.observe(time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"Error decoding packet: {e}", exc_info=True)
+            if self.on_error:
+                self.on_error(e)
+            return True
+        for frame in frames:
+            # Frames flushed out of the decoder come without a time base, their time would be NaN
+            if frame.time_base is None:
+                frame.time_base = stream.time_base
+            if stream.type == 'video':
+                if self.decimator is not None and not self.decimator.keep(frame):
+                    continue
+                if self.motion is not None and not self.motion.keep(frame):
+                    continue
+            for frame_queue in self.frame_queues:
+                if not self.put(frame_queue, frame):
+                    return False
+        return True
+
+    def finish(self):
+        for frame_queue in self.frame_queues:
+            self.end(frame_queue)
+
+
+class FilterStage(PipelineStage):
+    """Runs decoded video frames through the hooks of a stream processor
+
+    Frames are submitted as they arrive, several at once with several hook
+    processes, and passed on to the renditions in their original order,
+    audio frames and markers included. A frame is waited for no longer than
+    the hook budget; late frames are passed on as decoded or dropped, as the
+    processor decides, so a slow hook cannot stall encoding.
+    """
+
+    def __init__(self, processor, frame_queue: queue.Queue, frame_queues: List[queue.Queue],
+                 stop_event: threading.Event, on_drop: Optional[Callable[[], None]] = None):
+        super().__init__('filter', stop_event)
+        self.processor = processor
+        self.frame_queue = frame_queue
+        self.frame_queues = frame_queues
+        self.on_drop = on_drop
+        # (item, ticket) in input order, ticket None for items that need no hooks
+        self.pending = deque()
+
+    def process(self):
+        self.processor.start()
+        while True:
+            if not self._pass_on_finished():
+                return
+            if self.pending:
+                try:
+                    item = self.frame_queue.get_nowait()
+                except queue.Empty:
+                    self._wait(FILTER_POLL_INTERVAL)
+                    continue
+            else:
+                item = self.get(self.frame_queue)
+            if item is END_OF_STREAM:
+                break
+            if isinstance(item, av.VideoFrame):
+                self._submit(item)
+            else:
+                self.pending.append((item, None))
+
+        while self.pending and not self.stop_event.is_set():
+            self._wait(QUEUE_POLL_INTERVAL)
+            if not self._pass_on_finished():
+                return
+
+    def _submit(self, frame: av.VideoFrame):
+        """Hand a frame to the hooks, waiting for the oldest ones while every slot is taken"""
+        ticket = self.processor.submit(frame)
+        while ticket is None and self.pending:
+            self._wait(QUEUE_POLL_INTERVAL)
+            if not self._pass_on_finished():
+                return
+            ticket = self.processor.submit(frame)
+        if ticket is not None:
+            self.pending.append((frame, ticket))
+            return
+        # Slots still taken by hooks that overran, the frame misses them all
+        frame = self.processor.bypass(frame)
+        if frame is None:
+            self._drop()
+        else:
+            self.pending.append((frame, None))
+
+    def _wait(self, timeout: float):
+        """Wait for the hooks to finish the oldest frame, at most until its deadline"""
+        ticket = self.pending[0][1]
+        if ticket is not None:
+            ticket.done.wait(max(0.0, min(timeout, ticket.deadline - time.monotonic())))
+
+    def _pass_on_finished(self) -> bool:
+        """Pass on frames from the oldest on, up to the first one the hooks still have time for"""
+        while self.pending:
+            item, ticket = self.pending[0]
+            if ticket is not None:
+                if not ticket.done.is_set() and time.monotonic() < ticket.deadline:
+                    return True
+                item = self.processor.take(ticket, item)
+            self.pending.popleft()
+            if item is None:
+                self._drop()
+                continue
+            for frame_queue in self.frame_queues:
+                if not self.put(frame_queue, item):
+                    return False
+        return True
+
+    def _drop(self):
+        if self.on_drop:
+            self.on_drop()
+
+    def finish(self):
+        for frame_queue in self.frame_queues:
+            self.end(frame_queue)
+        self.processor.stop()
+
+
+class EncodeStage(PipelineStage):
+    """Encodes and muxes decoded frames through a segment writer"""
+
+    def __init__(self, frame_queue: queue.Queue, writer, stop_event: threading.Event,
+                 name: str = 'encode'):
+        super().__init__(name, stop_event)
+        self.frame_queue = frame_queue
+        self.writer = writer
+
+    def process(self):
+        while True:
+            frame = self.get(self.frame_queue)
+            if frame is END_OF_STREAM:
+                break
+            if isinstance(frame, Discontinuity):
+                self._interrupt(frame)
+                continue
+            self.writer.write(frame)
+
+    def _interrupt(self, marker: Discontinuity):
+        """Let the writer close its segment across the input gap"""
+        self.writer.interrupt(marker.video_stream, marker.audio_stream)
+
+    def finish(self):
+        try:
+            self.writer.close()
+        except Exception as e:
+            logger.error(f"Error closing segment writer: {e}", exc_info=True)
+
+
+class RemuxStage(EncodeStage):
+    """Muxes demuxed packets through a remux writer without decoding them"""
+
+    def __init__(self, packet_queue: queue.Queue, writer, stop_event: threading.Event,
+                 name: str = 'remux'):
+        super().__init__(packet_queue, writer, stop_event, name=name)
+
+    def _interrupt(self, marker: Discontinuity):
+        super()._interrupt(marker)
+        # Packets of the lost input were all muxed before the marker
+        marker.release()
+
+
+class Pipeline:
+    """Demux, decode and per-rendition encode or remux stages joined by bounded queues"""
+
+    def __init__(self, stages: List[PipelineStage], queues: List[queue.Queue],
+                 stop_event: threading.Event):
+        self.stages = stages
+        self.queues = queues
+        self.stop_event = stop_event
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        logger.info(f"Pipeline started with stages: {[s.name for s in self.stages]}")
+
+    def join(self):
+        for stage in self.stages:
+            stage.join()
+
+    def stop(self):
+        """Ask every stage to exit at its next queue operation"""
+        self.stop_event.set()
+
+    @property
+    def error(self) -> Optional[BaseException]:
+        return next((s.error for s in self.stages if s.error), None)
+
+    def queue_depths(self) -> List[int]:
+        return [q.qsize() for q in self.queues]
@@ -0,0 +1,95 @@
+import logging
+from typing import Optional
+from ..config import StreamConfig, Rendition
+
+logger = logging.getLogger(__name__)
+
+# H.264 profiles that HLS players decode without transcoding
+HLS_H264_PROFILES = {'Baseline', 'Constrained Baseline', 'Main', 'High'}
+
+
+def can_passthrough(config: StreamConfig, rendition: Rendition, video_stream, audio_stream) -> bool:
+    """Check whether the input can be remuxed into a rendition without transcoding"""
+    video_codec = video_stream.codec_context.name
+    if video_codec != config.video_codec:
+        logger.info(f"Passthrough disabled for {rendition.name}: video codec {video_codec} "
+                    f"does not match {config.video_codec}")
+        return False
+
+    profile = video_stream.codec_context.profile
+    if video_codec == 'h264' and profile not in HLS_H264_PROFILES:
+        logger.info(f"Passthrough disabled for {rendition.name}: unsupported H.264 profile {profile}")
+        return False
+
+    if (video_stream.codec_context.width, video_stream.codec_context.height) != (rendition.width, rendition.height):
+        logger.info(f"Passthrough disabled for {rendition.name}: input resolution "
+                    f"{video_stream.codec_context.width}x{video_stream.codec_context.height} "
+                    f"does not match {rendition.width}x{rendition.height}")
+        return False
+
+    if audio_stream:
+        audio_codec = audio_stream.codec_context.name
+        if audio_codec != config.audio_codec:
+            logger.info(f"Passthrough disabled for {rendition.name}: audio codec {audio_codec} "
+                        f"does not match {config.audio_codec}")
+            return False
+
+    logger.info(f"Passthrough enabled for rendition {rendition.name}")
+    return True
+
+
+# H.264 NAL unit types of coded slices, non-IDR and IDR
+H264_SLICE_TYPES = (1, 5)
+# H.264 NAL unit type of sequence parameter sets
+H264_SPS = 7
+# RFC 6381 object types of AAC profiles, for the mp4a.40.<type> codec string
+AAC_OBJECT_TYPES = {'LC': 2, 'HE-AAC': 5, 'HE-AACv2': 29}
+# RFC 6381 codec strings of the other audio codecs HLS players know
+AUDIO_CODEC_STRINGS = {'mp3': 'mp4a.40.34', 'ac3': 'ac-3', 'eac3': 'ec-3'}
+
+
+def _h264_nal_offsets(data: bytes):
+    """Yield the offset of the header byte of every NAL unit, in Annex B (RTSP) or length prefixed (MP4) framing"""
+    if data.startswith(b'\x00\x00\x01') or data.startswith(b'\x00\x00\x00\x01'):
+        position = data.find(b'\x00\x00\x01')
+        while position != -1 and position + 3 < len(data):
+            yield position + 3
+            position = data.find(b'\x00\x00\x01', position + 3)
+        return
+    position = 0
+    while position + 4 < len(data):
+        yield position + 4
+        position += 4 + int.from_bytes(data[position:position + 4], 'big')
+
+
+def h264_codec_string(data: bytes) -> Optional[str]:
+    """Get the RFC 6381 codec string, avc1.PPCCLL, of the SPS in extradata or a keyframe, None without one"""
+    if len(data) >= 4 and data[0] == 1:
+        # avcC record, its version is followed by profile, constraint flags and level of the SPS
+        return f'avc1.{data[1]:02X}{data[2]:02X}{data[3]:02X}'
+    for offset in _h264_nal_offsets(data):
+        if data[offset] & 0x1f == H264_SPS and offset + 3 < len(data):
+            return f'avc1.{data[offset + 1]:02X}{data[offset + 2]:02X}{data[offset + 3]:02X}'
+    return None
+
+
+def audio_codec_string(codec_context) -> Optional[str]:
+    """Get the RFC 6381 codec string of an audio stream, None for codecs HLS does not name"""
+    codec = codec_context.codec.canonical_name
+    if codec == 'aac':
+        return f'mp4a.40.{AAC_OBJECT_TYPES.get(codec_context.profile, 2)}'
+    return AUDIO_CODEC_STRINGS.get(codec)
+
+
+def is_reference_frame(packet) -> bool:
+    """Check whether later frames may reference a video packet, True when it cannot be told"""
+    if packet.is_disposable:
+        return False
+    if packet.stream.codec_context.name != 'h264':
+        return True
+    data = bytes(packet)
+    for offset in _h264_nal_offsets(data):
+        if data[offset] & 0x1f in H264_SLICE_TYPES:
+            # nal_ref_idc is zero for slices no other frame predicts from
+            return bool(data[offset] & 0x60)
+    return True
@@ -0,0 +1,776 @@
+import io
+import logging
+import time
+from collections import deque
+from fractions import Fraction
+import av
+from pathlib import Path
+from av.video.reformatter import VideoReformatter
+from typing import Callable, List, Optional
+from ..config import StreamConfig, Rendition, AudioRendition
+from ..monitoring.metrics import DROPPED_FRAMES, SEGMENT_WRITE_SECONDS, STAGE_SECONDS
+from .probe import audio_codec_string, h264_codec_string
+
+logger = logging.getLogger(__name__)
+
+# Tolerance for float rounding of frame times when comparing to boundaries
+TIME_EPSILON = 1e-6
+
+# Fragmented MP4 written as CMAF: an empty moov forms the init segment, every
+# segment is a moof/mdat run whose tfdt keeps the input decode times
+FMP4_OPTIONS = {
+    'movflags': 'cmaf+empty_moov+default_base_moof+frag_discont+skip_trailer',
+    'avoid_negative_ts': 'disabled',
+    'use_editlist': '0'
+}
+
+
+def _temporary_path(path: Path) -> Path:
+    """Get the name a segment file has while it is being written"""
+    return path.with_name(path.name + '.tmp')
+
+
+def _write_file(path: Path, data):
+    """Write a file under a temporary name and rename it, so readers never see it partially written"""
+    temporary = _temporary_path(path)
+    temporary.write_bytes(data)
+    temporary.replace(path)
+
+
+def add_video_encoder(container, config: StreamConfig, rendition: Rendition, time_base):
+    """Add the video encoder of a rendition to a container, with the configured options and threading"""
+    encoder = container.add_stream(config.video_codec, rate=config.fps)
+    encoder.width = rendition.width
+    encoder.height = rendition.height
+    encoder.pix_fmt = "yuv420p"
+    encoder.bit_rate = rendition.bitrate
+    encoder.time_base = time_base
+    # Keep input timestamps as they are, the default 1/fps encoder time base
+    # would round them and produce duplicate DTS values
+    encoder.codec_context.time_base = time_base
+    encoder.gop_size = config.keyframe_interval
+    encoder.codec_context.thread_type = config.encoder_thread_type.upper()
+    encoder.codec_context.thread_count = config.encoder_threads
+    options = config.get_video_options()
+    if config.enable_motion_adaptive and options:
+        # x264 only takes the bitrate changes of static scenes with VBV enabled
+        options.update(maxrate=str(rendition.bitrate), bufsize=str(rendition.bitrate))
+    encoder.options = options
+    return encoder
+
+
+class SegmentTimeline:
+    """Places segment boundaries on the presentation timeline
+
+    Boundaries fall every segment_duration seconds of media time, counted from
+    the first video frame, so every rendition cuts on the same frames.
+    """
+
+    def __init__(self, segment_duration: float):
+        self.segment_duration = segment_duration
+        self.origin: Optional[float] = None
+        self.index = 0
+
+    def is_boundary(self, media_time: float) -> bool:
+        """Check whether a video frame at media_time starts a new segment"""
+        if self.origin is None:
+            self.origin = media_time
+            return True
+
+        index = int((media_time - self.origin) / self.segment_duration + TIME_EPSILON)
+        if index < self.index - 1:
+            # Timestamps jumped backwards, re-anchor the timeline on this frame
+            logger.warning(f"Timestamp jump detected at {media_time:.3f}s, restarting timeline")
+            self.origin = media_time
+            self.index = 0
+            return True
+        if index > self.index:
+            self.index = index
+            return True
+        return False
+
+
+class BaseSegmentWriter:
+    """Common segment bookkeeping for the writers of one rendition
+
+    In low latency mode a partial segment is the byte range written to the
+    segment buffer since the previous part, published while the segment is
+    still being muxed. MPEG-TS flushes every packet and parts are cut on
+    media time, fragmented MP4 flushes a fragment per part and parts are cut
+    whenever one comes out.
+
+    Fragmented MP4 segments are muxed with their header, which is split off
+    as the rendition's init segment.
+    """
+
+    def __init__(self, config: StreamConfig, rendition: Rendition, video_stream, audio_stream,
+                 stats: dict, on_segment: Callable[[dict], None], primary: bool = True,
+                 on_part: Optional[Callable[[dict], None]] = None, first_segment_id: int = 1,
+                 on_packet: Optional[Callable[[str, av.Packet, float], None]] = None, resumed: bool = False):
+        self.config = config
+        self.rendition = rendition
+        # Only the primary rendition counts processed frames, so stats stay per input frame
+        self.primary = primary
+        self.video_stream = video_stream
+        self.audio_stream = audio_stream
+        self.stats = stats
+        self.on_segment = on_segment
+        self.on_part = on_part
+        # Gets every video and audio packet with its media time before it is muxed
+        self.on_packet = on_packet
+        # Ids continue where a previous converter of the stream stopped
+        self.segment_id = first_segment_id - 1
+        self.current_segment: Optional[dict] = None
+        self.current_part: Optional[dict] = None
+        self.output_container = None
+        self.segment_buffer: Optional[io.BytesIO] = None
+        # Bytes of the fMP4 header at the start of the segment buffer
+        self.header_size = 0
+        self.written_init: Optional[bytes] = None
+        self.output_video_stream = None
+        self.output_audio_stream = None
+        self.frame_count = 0
+        self.timeline = SegmentTimeline(config.segment_duration)
+        self.last_video_time: Optional[float] = None
+        self.frame_interval = 1 / config.fps
+        # Set across an input gap, the next segment then starts a discontinuity. A converter
+        # resuming the segments of a previous one starts over with new timestamps and encoders
+        self.discontinuity = resumed
+        # RFC 6381 codec strings of what the segments carry, for the CODECS of the master playlist.
+        # The video one is read from the SPS, which encoders only output with the first keyframe
+        self.video_codecs: Optional[str] = None
+        self.audio_codecs: Optional[str] = None
+        stream_name = config.stream_name
+        self.scale_timer = STAGE_SECONDS.labels(stream_name, 'scale', rendition.name)
+        self.encode_timer = STAGE_SECONDS.labels(stream_name, 'encode', rendition.name)
+        self.mux_timer = STAGE_SECONDS.labels(stream_name, 'mux', rendition.name)
+        self.segment_write_timer = SEGMENT_WRITE_SECONDS.labels(stream_name, rendition.name)
+        self.dropped_frames = DROPPED_FRAMES.labels(stream_name, rendition.name)
+
+    def _add_output_streams(self):
+        """Add the output streams to a freshly opened output container"""
+        raise NotImplementedError
+
+    def _open_segment(self, media_time: float):
+        """Open the output container of a new segment starting at media_time"""
+        self.segment_id += 1
+        extension = self.config.get_segment_extension()
+        segment_path = Path(self.config.output_path) / f'segment_{self.rendition.name}_{self.segment_id}.{extension}'
+        self.current_segment = {
+            'id': self.segment_id,
+            'rendition': self.rendition.name,
+            'path': segment_path,
+            'start_time': time.time(),
+            'media_start': media_time,
+            'duration': 0
+        }
+        if self.discontinuity:
+            self.current_segment['discontinuity'] = True
+            self.discontinuity = False
+        logger.debug(f"Created new segment: {segment_path}")
+        fmp4 = self.config.segment_format == 'fmp4'
+        if self.config.enable_low_latency or self.config.enable_memory_segments or fmp4:
+            self.segment_buffer = io.BytesIO()
+            target = self.segment_buffer
+        else:
+            # Muxed under a temporary name, a segment file only appears once it is complete
+            target = str(_temporary_path(segment_path))
+        self.output_container = av.open(target, 'w', format='mp4' if fmp4 else 'mpegts',
+                                        options=self._muxer_options())
+        self._add_output_streams()
+        self.audio_codecs = None
+        if self.output_audio_stream is not None:
+            self.audio_codecs = audio_codec_string(self.output_audio_stream.codec_context)
+
+        self.header_size = 0
+        if fmp4:
+            # Writes ftyp and the empty moov, which every segment of the rendition shares
+            self.output_container.start_encoding()
+            self.header_size = self.segment_buffer.tell()
+            self.current_segment['init'] = self.segment_buffer.getvalue()
+        if self.config.enable_low_latency:
+            self.current_segment['parts'] = []
+            self._open_part(media_time, independent=True)
+
+    def _muxer_options(self) -> dict:
+        """Get the muxer options of a segment container"""
+        if self.config.segment_format == 'fmp4':
+            options = dict(FMP4_OPTIONS)
+            if self.config.enable_low_latency:
+                # Flush a fragment before the frame that would push it past the part target
+                fragment = self.config.part_duration - self.frame_interval + TIME_EPSILON
+                options['frag_duration'] = str(max(1, int(fragment * 1000000)))
+            return options
+        if self.config.enable_low_latency:
+            # Write every packet through to the buffer, audio included, so parts are complete
+            return {'flush_packets': '1', 'pes_payload_size': '0'}
+        return {}
+
+    def _segment_codecs(self) -> Optional[str]:
+        """Get the CODECS of the current segment, None while one of its codecs is unknown"""
+        codecs = []
+        if self.output_video_stream is not None:
+            codecs.append(self.video_codecs)
+        if self.output_audio_stream is not None:
+            codecs.append(self.audio_codecs)
+        if not codecs or None in codecs:
+            return None
+        return ','.join(codecs)
+
+    def _close_segment(self, media_end: float):
+        """Close the current segment at media_end and hand it over"""
+        started = time.perf_counter()
+        codecs = self._segment_codecs()
+        if codecs is not None:
+            self.current_segment['codecs'] = codecs
+        self.output_container.close()
+        self.output_container = None
+        self.current_segment['duration'] = max(0.0, media_end - self.current_segment['media_start'])
+        if self.segment_buffer is not None:
+            # The buffer is complete, expose it without copying
+            data = self.segment_buffer.getbuffer()[self.header_size:]
+            self.segment_buffer = None
+            if self.current_part is not None:
+                # The last part is published together with its segment
+                offset = self.current_part['offset'] - self.header_size
+                self._close_part(media_end, data[offset:], publish=False)
+            if self.config.enable_memory_segments:
+                self.current_segment['data'] = data
+            if not self.config.enable_memory_segments or self.config.enable_dvr:
+                self._write_segment_files(data)
+            self.current_segment['size'] = len(data)
+        else:
+            path = self.current_segment['path']
+            self.current_segment['size'] = _temporary_path(path).stat().st_size
+            _temporary_path(path).replace(path)
+        self.segment_write_timer.observe(time.perf_counter() - started)
+        self.on_segment(self.current_segment)
+
+    def interrupt(self, video_stream, audio_stream):
+        """Close the current segment at an input gap and continue with the streams of the new input"""
+        if self.output_container is not None:
+            self._close_segment(self.last_video_time + self.frame_interval)
+        self.discontinuity = self.last_video_time is not None
+        self.video_stream = video_stream
+        # Renditions set up without audio stay without, it may go to the audio renditions
+        self.audio_stream = audio_stream if self.audio_stream is not None else None
+        # A reconnected camera may come back with another profile or level
+        self.video_codecs = None
+        # The new input starts a segment on its first frame, the gap is no frame interval
+        self.timeline = SegmentTimeline(self.config.segment_duration)
+        self.last_video_time = None
+        logger.info(f"Rendition {self.rendition.name} interrupted after segment {self.segment_id}")
+
+    def _write_segment_files(self, data):
+        """Write a buffered segment, and the init segment when it changed, to output_path"""
+        init = self.current_segment.get('init')
+        if init is not None and init != self.written_init:
+            _write_file(Path(self.config.output_path) / f'init_{self.rendition.name}.mp4', init)
+            self.written_init = init
+        _write_file(self.current_segment['path'], data)
+
+    def _open_part(self, media_time: float, independent: bool):
+        """Start the next partial segment at the current end of the segment buffer"""
+        index = len(self.current_segment['parts'])
+        self.current_part = {
+            'segment_id': self.segment_id,
+            'rendition': self.rendition.name,
+            'index': index,
+            'offset': self.segment_buffer.tell(),
+            'media_start': media_time,
+            'duration': 0,
+            'independent': independent,
+            # Lets playlists tag the segment before it is complete
+            'discontinuity': index == 0 and self.current_segment.get('discontinuity', False)
+        }
+
+    def _close_part(self, media_end: float, data, publish: bool = True):
+        """Finish the current partial segment with its data and hand it over"""
+        part = self.current_part
+        part['duration'] = max(0.0, media_end - part['media_start'])
+        part['data'] = data
+        self.current_segment['parts'].append(part)
+        self.current_part = None
+        if publish and self.on_part:
+            self.on_part(part)
+
+    def _cut_part(self, media_time: float, independent: bool):
+        """Publish the bytes muxed since the current part started and start a new one"""
+        with self.segment_buffer.getbuffer() as view:
+            # Copied out, the buffer cannot grow while a view of it is alive
+            data = bytes(view[self.current_part['offset']:])
+        self._close_part(media_time, data)
+        self._open_part(media_time, independent)
+
+    def _mux_video_packet(self, packet, media_time: float):
+        """Mux a video packet, starting a new part when the current one is full"""
+        fmp4 = self.config.segment_format == 'fmp4'
+        if self.current_part is not None and not fmp4:
+            # Cut before a frame that would push the part past its target duration
+            part_end = media_time + self.frame_interval - self.current_part['media_start']
+            if part_end > self.config.part_duration + TIME_EPSILON:
+                self._cut_part(media_time, independent=packet.is_keyframe)
+        if self.video_codecs is None and packet.is_keyframe:
+            self.video_codecs = self._probe_video_codecs(packet)
+        if self.on_packet:
+            self.on_packet('video', packet, media_time)
+        packet.stream = self.output_video_stream
+        started = time.perf_counter()
+        self.output_container.mux(packet)
+        self.mux_timer.observe(time.perf_counter() - started)
+        if self.current_part is not None and fmp4:
+            self._cut_flushed_fragment(media_time, packet.is_keyframe)
+
+    def _probe_video_codecs(self, packet) -> Optional[str]:
+        """Read the video codec string from the extradata or a keyframe with the SPS in band"""
+        codec_context = self.output_video_stream.codec_context
+        if codec_context.codec.canonical_name != 'h264':
+            return None
+        return h264_codec_string(bytes(codec_context.extradata or b'')) or h264_codec_string(bytes(packet))
+
+    def _mux_audio_packet(self, packet):
+        """Mux an audio packet into the current segment or part"""
+        if self.on_packet and packet.pts is not None:
+            self.on_packet('audio', packet, float(packet.pts * packet.time_base))
+        packet.stream = self.output_audio_stream
+        self.output_container.mux(packet)
+        if self.current_part is not None and self.config.segment_format == 'fmp4':
+            media_time = float(packet.pts * packet.time_base) if packet.pts is not None else self.last_video_time
+            self._cut_flushed_fragment(media_time, False)
+
+    def _cut_flushed_fragment(self, media_time: float, independent: bool):
+        """Turn the fragment the muxer flushed before the packet at media_time into a part"""
+        if self.segment_buffer.tell() > self.current_part['offset']:
+            self._cut_part(media_time, independent)
+
+    def _track_video_time(self, media_time: float):
+        """Remember the last video timestamp and the interval between frames"""
+        if self.last_video_time is not None and media_time > self.last_video_time:
+            self.frame_interval = media_time - self.last_video_time
+        self.last_video_time = media_time
+        if self.primary:
+            self.stats["media_time"] = media_time
+
+    def _drop_frame(self):
+        """Count a video frame that will not be in any segment"""
+        self.dropped_frames.inc()
+        if self.primary:
+            self.stats["dropped_frames"] += 1
+
+
+class SegmentWriter(BaseSegmentWriter):
+    """Encodes frames of one rendition into consecutive HLS segment files
+
+    The encoders are created once and live across all segments, so their
+    lookahead and rate control state survive segment boundaries. Encoded
+    packets are routed into the current segment and a new segment starts
+    with the IDR packet forced at each boundary.
+    """
+
+    def __init__(self, *args, motion=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Motion detector of the decode stage, static scenes are encoded at a lower bitrate
+        self.motion = motion
+        # frame.reformat() caches its scaler on the frame, which renditions share across
+        # threads, so every rendition scales through its own reformatter. It keeps its
+        # swscale context for as long as the input size and format stay the same.
+        self.reformatter = VideoReformatter()
+        self.interpolation = self.config.scale_interpolation.upper()
+        # Media times of frames forced to IDR whose packets have not come out yet
+        self.pending_boundaries = deque()
+        # Audio packets encoded before the first segment is opened
+        self.pending_audio_packets = []
+        self._create_encoders()
+
+    def _create_encoders(self):
+        """Create the video and audio encoders shared by all segments"""
+        # The encoders are hosted by a container that is never written,
+        # every segment copies their parameters into its own streams. Hosting
+        # them in MP4 makes them put SPS/PPS in extradata, as fMP4 needs.
+        fmp4 = self.config.segment_format == 'fmp4'
+        self.encoder_container = av.open(io.BytesIO(), 'w', format='mp4' if fmp4 else 'mpegts')
+
+        self.video_encoder = add_video_encoder(self.encoder_container, self.config, self.rendition,
+                                               self.video_stream.time_base)
+
+        self.audio_encoder = None
+        if self.audio_stream:
+            self.audio_encoder = self.encoder_container.add_stream(
+                self.config.audio_codec, rate=self.audio_stream.rate or 44100
+            )
+            self.audio_encoder.bit_rate = self.config.audio_bitrates[0]
+            self.audio_encoder.layout = self.audio_stream.layout or "stereo"
+            self.audio_encoder.time_base = self.audio_stream.time_base
+
+        # Opens the encoders and copies their parameters, including extradata such as
+        # the AAC AudioSpecificConfig, into the streams that segments use as templates
+        self.encoder_container.start_encoding()
+        logger.debug(f"Encoders created for rendition {self.rendition.name}")
+
+    def _add_output_streams(self):
+        """Add streams copying the parameters of the shared encoders"""
+        self.output_video_stream = self.output_container.add_stream_from_template(self.video_encoder)
+        self.output_audio_stream = None
+        if self.audio_encoder:
+            self.output_audio_stream = self.output_container.add_stream_from_template(self.audio_encoder)
+
+    def _adapt_bitrate(self, static: bool):
+        """Switch the encoder between the full and the static scene bitrate"""
+        bit_rate = self.rendition.bitrate
+        if static:
+            bit_rate = int(bit_rate * self.config.motion_static_bitrate)
+        if self.video_encoder.codec_context.bit_rate != bit_rate:
+            self.video_encoder.codec_context.bit_rate = bit_rate
+
+    def _mux_video(self, packets):
+        """Route encoded video packets, switching segments on boundary IDR packets"""
+        for packet in packets:
+            media_time = float(packet.pts * packet.time_base)
+            if (packet.is_keyframe and self.pending_boundaries
+                    and media_time >= self.pending_boundaries[0] - TIME_EPSILON):
+                self.pending_boundaries.popleft()
+                if self.output_container is not None:
+                    self._close_segment(media_time)
+                self._open_segment(media_time)
+                self._mux_audio(self.pending_audio_packets)
+                self.pending_audio_packets = []
+
+            self._mux_video_packet(packet, media_time)
+
+    def _mux_audio(self, packets):
+        """Route encoded audio packets into the current segment"""
+        for packet in packets:
+            if self.output_container is None:
+                self.pending_audio_packets.append(packet)
+                continue
+            self._mux_audio_packet(packet)
+
+    def write(self, frame):
+        """Encode a decoded frame into the current segment"""
+        try:
+            if isinstance(frame, av.VideoFrame):
+                media_time = frame.time
+                if media_time is None:
+                    if self.last_video_time is None:
+                        # RTSP leaves the frames before its first sender report untimed
+                        self._drop_frame()
+                        return
+                    # Without a timestamp, place the frame right after the previous one
+                    media_time = self.last_video_time + self.frame_interval
+
+                force_keyframe = self.timeline.is_boundary(media_time)
+                if force_keyframe:
+                    self.pending_boundaries.append(media_time)
+                self._track_video_time(media_time)
+
+                self.frame_count += 1
+                # Ensure frame has correct format and size
+                if (frame.width != self.rendition.width or
+                        frame.height != self.rendition.height or
+                        frame.format.name != "yuv420p"):
+                    started = time.perf_counter()
+                    frame = self.reformatter.reformat(
+                        frame,
+                        width=self.rendition.width,
+                        height=self.rendition.height,
+                        format="yuv420p",
+                        interpolation=self.interpolation
+                    )
+                    self.scale_timer.observe(time.perf_counter() - started)
+
+                # Segments start with an IDR frame, everywhere else the encoder picks the
+                # frame type instead of inheriting the one decoded from the source. Every
+                # rendition makes the same decision, so setting it on a shared frame is safe.
+                frame.pict_type = (av.video.frame.PictureType.I if force_keyframe
+                                   else av.video.frame.PictureType.NONE)
+
+                if self.motion is not None:
+                    self._adapt_bitrate(self.motion.static)
+
+                started = time.perf_counter()
+                packets = self.video_encoder.encode(frame)
+                self.encode_timer.observe(time.perf_counter() - started)
+                self._mux_video(packets)
+
+                if self.primary:
+                    self.stats["processed_video_frames"] += 1
+
+                if self.frame_count % 100 == 0:
+                    logger.info(f"Rendition {self.rendition.name}: processed {self.frame_count} video frames")
+                    logger.debug(f"Current stats: {self.stats}")
+
+            # Audio before the first video frame has no segment to go into
+            elif isinstance(frame, av.AudioFrame) and self.audio_encoder and self.last_video_time is not None:
+                self._mux_audio(self.audio_encoder.encode(frame))
+
+                if self.primary:
+                    self.stats["processed_audio_frames"] += 1
+
+        except Exception as e:
+            logger.error(f"Error processing frame: {e}", exc_info=True)
+            self.stats["encoding_errors"] += 1
+            if isinstance(frame, av.VideoFrame):
+                self._drop_frame()
+
+    def close(self):
+        """Flush the encoders into the last segment and close it"""
+        try:
+            if self.last_video_time is not None:
+                self._mux_video(self.video_encoder.encode(None))
+                if self.audio_encoder:
+                    self._mux_audio(self.audio_encoder.encode(None))
+        except Exception as e:
+            logger.error(f"Error flushing encoders: {e}", exc_info=True)
+            self.stats["encoding_errors"] += 1
+
+        if self.output_container is not None:
+            self._close_segment(self.last_video_time + self.frame_interval)
+        self.encoder_container.close()
+        logger.info(f"Segment writer for rendition {self.rendition.name} closed")
+
+
+class RemuxWriter(BaseSegmentWriter):
+    """Copies already compatible packets of one rendition into HLS segments
+
+    Segments can only start on keyframes chosen by the source, so a segment
+    is cut at the first keyframe at or after its media time boundary.
+    """
+
+    def _add_output_streams(self):
+        """Add streams copying the parameters of the input streams"""
+        self.output_video_stream = self.output_container.add_stream_from_template(self.video_stream)
+        self.output_audio_stream = None
+        if self.audio_stream:
+            self.output_audio_stream = self.output_container.add_stream_from_template(self.audio_stream)
+
+    def write(self, packet):
+        """Mux a demuxed packet into the current segment"""
+        try:
+            if packet.stream is self.video_stream:
+                media_time = float(packet.pts * packet.time_base) if packet.pts is not None else None
+                if media_time is None:
+                    if self.last_video_time is None:
+                        self._drop_frame()
+                        return
+                    media_time = self.last_video_time + self.frame_interval
+
+                if packet.is_keyframe and self.timeline.is_boundary(media_time):
+                    if self.output_container is not None:
+                        self._close_segment(media_time)
+                    self._open_segment(media_time)
+                if self.output_container is None:
+                    # Wait for the first keyframe, players cannot start without one
+                    self._drop_frame()
+                    return
+                self._track_video_time(media_time)
+                self._mux_video_packet(packet, media_time)
+
+                self.frame_count += 1
+                if self.primary:
+                    self.stats["processed_video_frames"] += 1
+
+                if self.frame_count % 100 == 0:
+                    logger.info(f"Rendition {self.rendition.name}: remuxed {self.frame_count} video packets")
+
+            elif packet.stream is self.audio_stream and self.output_container:
+                self._mux_audio_packet(packet)
+
+                if self.primary:
+                    self.stats["processed_audio_frames"] += 1
+
+        except Exception as e:
+            logger.error(f"Error remuxing packet: {e}", exc_info=True)
+            self.stats["encoding_errors"] += 1
+            if packet.stream is self.video_stream:
+                self._drop_frame()
+
+    def close(self):
+        """Close the last segment"""
+        if self.output_container is None:
+            return
+
+        self._close_segment(self.last_video_time + self.frame_interval)
+        logger.info(f"Remux writer for rendition {self.rendition.name} closed")
+
+
+class AudioSegmentWriter(BaseSegmentWriter):
+    """Encodes the resampled audio of one audio rendition into audio-only segments
+
+    Segments are cut on the boundaries the video frames passing through
+    place on the timeline, at the first audio packet past each one, so an
+    audio segment covers the same media time as the video segments of the
+    same id. Without video frames, next to a remuxed rendition, boundaries
+    are placed on the audio timeline itself.
+    """
+
+    def __init__(self, config: StreamConfig, rendition: AudioRendition, stats: dict,
+                 on_segment: Callable[[dict], None], follow_video: bool = True, **kwargs):
+        super().__init__(config, rendition, None, None, stats, on_segment, primary=False, **kwargs)
+        self.follow_video = follow_video
+        # Boundaries placed by video frames whose audio packets have not come out yet
+        self.pending_boundaries = deque()
+        self.last_audio_time: Optional[float] = None
+        self._create_encoder()
+        # Parts and the fMP4 fragment duration count in audio frames
+        self.frame_interval = self.audio_encoder.codec_context.frame_size / config.audio_sample_rate
+
+    def _create_encoder(self):
+        """Create the audio encoder shared by all segments"""
+        fmp4 = self.config.segment_format == 'fmp4'
+        self.encoder_container = av.open(io.BytesIO(), 'w', format='mp4' if fmp4 else 'mpegts')
+        self.audio_encoder = self.encoder_container.add_stream(self.config.audio_codec,
+                                                               rate=self.config.audio_sample_rate)
+        self.audio_encoder.bit_rate = self.rendition.bitrate
+        self.audio_encoder.layout = self.config.get_audio_layout()
+        self.audio_encoder.time_base = Fraction(1, self.config.audio_sample_rate)
+        self.encoder_container.start_encoding()
+        logger.debug(f"Audio encoder created for rendition {self.rendition.name}")
+
+    def _add_output_streams(self):
+        """Add an audio stream copying the parameters of the shared encoder"""
+        self.output_video_stream = None
+        self.output_audio_stream = self.output_container.add_stream_from_template(self.audio_encoder)
+
+    def _mux_audio(self, packets):
+        """Route encoded audio packets, switching segments at the first packet past a boundary"""
+        for packet in packets:
+            media_time = float(packet.pts * packet.time_base)
+            if not self.follow_video and self.timeline.is_boundary(media_time):
+                self.pending_boundaries.append(media_time)
+            boundary = None
+            # An input gap may pass several boundaries at once, only the last one starts a segment
+            while self.pending_boundaries and media_time >= self.pending_boundaries[0] - TIME_EPSILON:
+                boundary = self.pending_boundaries.popleft()
+            if boundary is not None:
+                if self.output_container is not None:
+                    self._close_segment(boundary)
+                self._open_segment(boundary)
+            if self.output_container is None:
+                # Audio before the first boundary has no segment to go into
+                continue
+
+            if self.current_part is not None and self.config.segment_format != 'fmp4':
+                part_end = media_time + self.frame_interval - self.current_part['media_start']
+                if part_end > self.config.part_duration + TIME_EPSILON:
+                    self._cut_part(media_time, independent=True)
+            if self.on_packet:
+                self.on_packet('audio', packet, media_time)
+            packet.stream = self.output_audio_stream
+            started = time.perf_counter()
+            self.output_container.mux(packet)
+            self.mux_timer.observe(time.perf_counter() - started)
+            self.last_audio_time = media_time
+            if self.current_part is not None and self.config.segment_format == 'fmp4':
+                # Every audio frame is independent, so is every part
+                self._cut_flushed_fragment(media_time, True)
+
+    def write(self, frame):
+        """Place a boundary for a video frame, or encode a resampled audio frame"""
+        try:
+            if isinstance(frame, av.VideoFrame):
+                if frame.time is not None and self.timeline.is_boundary(frame.time):
+                    self.pending_boundaries.append(frame.time)
+                return
+            if self.follow_video and self.timeline.origin is None:
+                return
+            started = time.perf_counter()
+            packets = self.audio_encoder.encode(frame)
+            self.encode_timer.observe(time.perf_counter() - started)
+            self._mux_audio(packets)
+        except Exception as e:
+            logger.error(f"Error encoding audio: {e}", exc_info=True)
+            self.stats["encoding_errors"] += 1
+
+    def interrupt(self, video_stream=None, audio_stream=None):
+        """Close the current segment at an input gap, the encoder continues with the new input"""
+        if self.output_container is not None:
+            self._close_segment(self.last_audio_time + self.frame_interval)
+        self.discontinuity = self.last_audio_time is not None
+        self.timeline = SegmentTimeline(self.config.segment_duration)
+        self.pending_boundaries.clear()
+        logger.info(f"Rendition {self.rendition.name} interrupted after segment {self.segment_id}")
+
+    def close(self):
+        """Flush the encoder into the last segment and close it"""
+        try:
+            self._mux_audio(self.audio_encoder.encode(None))
+        except Exception as e:
+            logger.error(f"Error flushing audio encoder: {e}", exc_info=True)
+            self.stats["encoding_errors"] += 1
+
+        if self.output_container is not None:
+            self._close_segment(self.last_audio_time + self.frame_interval)
+        self.encoder_container.close()
+        logger.info(f"Audio writer for rendition {self.rendition.name} closed")
+
+
+class AudioGroupWriter:
+    """Resamples decoded audio once and encodes it into every audio rendition
+
+    One resampler converts the input to the configured sample rate and
+    channel layout and batches the samples into frames of the encoder frame
+    size, so the encoders of all audio bitrates share its work. It lives
+    for as long as the input does, a reopened input may come in another
+    format and gets a new one.
+    """
+
+    def __init__(self, config: StreamConfig, writers: List[AudioSegmentWriter], stats: dict):
+        self.config = config
+        self.writers = writers
+        self.stats = stats
+        self.resampler = self._create_resampler()
+        self.resample_timer = STAGE_SECONDS.labels(config.stream_name, 'resample', '')
+
+    def _create_resampler(self) -> av.AudioResampler:
+        codec_context = self.writers[0].audio_encoder.codec_context
+        return av.AudioResampler(format=codec_context.format.name, layout=codec_context.layout.name,
+                                 rate=self.config.audio_sample_rate, frame_size=codec_context.frame_size)
+
+    def _resample(self, frame: Optional[av.AudioFrame]) -> list:
+        started = time.perf_counter()
+        frames = self.resampler.resample(frame)
+        self.resample_timer.observe(time.perf_counter() - started)
+        return frames
+
+    def write(self, frame):
+        """Resample a decoded audio frame into every rendition, video frames only place boundaries"""
+        if isinstance(frame, av.VideoFrame):
+            for writer in self.writers:
+                writer.write(frame)
+            return
+        try:
+            frames = self._resample(frame)
+        except Exception as e:
+            logger.error(f"Error resampling audio: {e}", exc_info=True)
+            self.stats["encoding_errors"] += 1
+            return
+        for resampled in frames:
+            for writer in self.writers:
+                writer.write(resampled)
+        self.stats["processed_audio_frames"] += 1
+
+    def _flush_resampler(self):
+        try:
+            frames = self._resample(None)
+        except Exception as e:
+            logger.error(f"Error flushing audio resampler: {e}", exc_info=True)
+            return
+        for resampled in frames:
+            for writer in self.writers:
+                writer.write(resampled)
+
+    def interrupt(self, video_stream, audio_stream):
+        """Close the segments of every rendition at an input gap and resample the new input anew"""
+        self._flush_resampler()
+        self.resampler = self._create_resampler()
+        for writer in self.writers:
+            writer.interrupt()
+
+    def close(self):
+        """Flush the resampler and the encoders and close every rendition"""
+        self._flush_resampler()
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as e:
+                logger.error(f"Error closing audio writer: {e}", exc_info=True)
@@ -1,21 +1,67 @@
 import logging
+import random
 import time
 import av
 from pathlib import Path
-from fractions import Fraction
 import asyncio
+import queue
+import threading
 from ..config import StreamConfig
+from ..monitoring.metrics import (DROPPED_FRAMES, LAG_SECONDS, MOTION_SCORE, QUEUE_DEPTH, REALTIME_FACTOR,
+                                  STAGE_SECONDS)
+from .pipeline import (Pipeline, DemuxStage, DecodeStage, EncodeStage, RemuxStage, FilterStage,
+                       RealtimeScheduler, FrameDecimator)
+from .autotune import autotune
+from .motion import MotionDetector
+from .probe import can_passthrough
+from .segment_writer import SegmentWriter, RemuxWriter, AudioSegmentWriter, AudioGroupWriter
 
 logger = logging.getLogger(__name__)
 
+# Seconds between updates of the queue depth and realtime factor gauges
+METRICS_INTERVAL = 1.0
+
+
+def backoff_delays(initial: float, maximum: float):
+    """Yield the delays before reconnection attempts
+
+    The first attempt is immediate, later ones back off exponentially from
+    initial up to maximum, jittered so restarted cameras are not hit in lockstep.
+    """
+    yield 0.0
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(maximum, delay * 2)
+
+
 class StreamConverter:
-    def __init__(self, config: StreamConfig):
+    def __init__(self, config: StreamConfig, first_segment_id: int = 1, processor=None, resumed: bool = False):
         self.config = config
+        self.first_segment_id = first_segment_id
+        # Continues the segments of a previous converter, its first segments start a discontinuity
+        self.resumed = resumed
+        # StreamProcessor whose hooks every decoded video frame goes through
+        self.processor = processor if processor is not None and processor.hooks else None
         self._init_stats()
         Path(config.output_path).mkdir(parents=True, exist_ok=True)
-        self.segment_id = 0
-        self.current_segment = None
+        self.pipeline = None
+        self.queue_names = []
+        # Drops frames while decoding falls behind a live input
+        self.scheduler = RealtimeScheduler(config.max_encode_lag) if config.max_encode_lag > 0 else None
+        # Thins out static scenes, which the renditions also encode at a lower bitrate
+        self.motion = None
+        if config.enable_motion_adaptive:
+            self.motion = MotionDetector(config.motion_threshold, config.motion_hold, config.get_static_fps())
         self.hls_server = None
+        self.rtsp_server = None
+        # Input streams and passthrough rendition chosen for the first input
+        self.input_container = None
+        self.video_stream = None
+        self.audio_stream = None
+        self.passthrough = None
+        # Set when the audio of the first input goes into audio-only renditions
+        self.audio_renditions = []
         logger.info("Stream converter initialized")
         logger.debug(f"Configuration: {vars(config)}")
 
@@ -25,7 +71,19 @@ class StreamConverter:
             "processed_audio_frames": 0,
             "dropped_frames": 0,
             "encoding_errors": 0,
-            "start_time": time.time()
+            "start_time": time.time(),
+            # Latest video timestamp written, drives the realtime factor
+            "media_time": None,
+            # Seconds the video being decoded is behind the live input
+            "lag": 0.0,
+            # Fraction of pixels changed between the latest frames, and whether the scene is static
+            "motion": 0.0,
+            "static": False,
+            "input_reconnects": 0,
+            # Wall time the input was lost at while it is down
+            "input_lost_at": None,
+            # Seconds from losing the input to publishing the first segment after reconnecting
+            "last_recovery_time": None
         }
         logger.debug("Statistics initialized")
 
@@ -35,18 +93,33 @@ class StreamConverter:
         server.converter = self
         logger.info("HLS server reference set")
 
-    def _create_new_segment(self):
-        """Create a new HLS segment"""
-        self.segment_id += 1
-        segment_path = Path(self.config.output_path) / f'segment_{self.segment_id}.ts'
-        self.current_segment = {
-            'id': self.segment_id,
-            'path': segment_path,
-            'start_time': time.time(),
-            'duration': 0
-        }
-        logger.debug(f"Created new segment: {segment_path}")
-        return av.open(str(segment_path), 'w')
+    def set_rtsp_server(self, server):
+        """Restream the top rendition through an RTSP server"""
+        self.rtsp_server = server
+        logger.info("RTSP server reference set")
+
+    def _publish_segment(self, segment: dict):
+        """Hand a finished segment over to the HLS server (runs on the event loop)"""
+        if segment.get('discontinuity') and self.stats["input_lost_at"] is not None:
+            recovery_time = time.time() - self.stats["input_lost_at"]
+            self.stats["input_lost_at"] = None
+            self.stats["last_recovery_time"] = recovery_time
+            logger.info(f"Recovered from input loss in {recovery_time:.2f}s")
+        if self.hls_server:
+            self.hls_server.add_segment(segment)
+            logger.debug(f"Added segment {segment['rendition']}/{segment['id']} to HLS server")
+
+    def _publish_part(self, part: dict):
+        """Hand a finished partial segment over to the HLS server (runs on the event loop)"""
+        if self.hls_server:
+            self.hls_server.add_part(part)
+
+    def _open_input(self):
+        """Open the input container (blocking)"""
+        logger.info("Opening input stream...")
+        input_container = av.open(self.config.input_url, options=self.config.get_rtsp_options())
+        logger.info("Input stream opened successfully")
+        return input_container
 
     async def start_conversion(self):
         """Start stream conversion process"""
@@ -55,154 +128,281 @@ class StreamConverter:
         logger.debug(f"Video settings: {self.config.width}x{self.config.height} @ {self.config.fps}fps")
         logger.debug(f"Video bitrates: {self.config.video_bitrates}")
         logger.debug(f"Audio bitrates: {self.config.audio_bitrates}")
-        
+
+        self.input_container = None
         try:
-            logger.info("Opening input stream...")
-            input_container = av.open(self.config.input_url, options={
-                'rtsp_transport': 'tcp',
-                'stimeout': '5000000'
-            })
-            logger.info("Input stream opened successfully")
-            
+            if self.config.enable_autotune:
+                # Before opening the input, a live camera would be left unread meanwhile
+                self.config = await asyncio.to_thread(autotune, self.config)
+
+            # Opening an RTSP input blocks until the camera answers
+            self.input_container = await asyncio.to_thread(self._open_input)
+
             logger.info("Starting stream processing...")
-            await self._process_stream(input_container)
+            await self._process_stream(self.input_container)
         except Exception as e:
             logger.error(f"Error in conversion: {e}", exc_info=True)
             raise
         finally:
+            # After reconnections this is the latest input, lost ones are closed by the pipeline
+            if self.input_container is not None:
+                try:
+                    self.input_container.close()
+                    logger.info("Input stream closed")
+                except Exception as e:
+                    logger.error(f"Error closing input stream: {e}", exc_info=True)
+
+    def _reopen_input(self, stop_event: threading.Event):
+        """Reopen a lost input with backoff, None once the pipeline stops (runs on the demux thread)
+
+        Returns the new container with its streams. Raises when the attempts
+        run out or the new input cannot feed the existing encoders.
+        """
+        self.stats["input_lost_at"] = time.time()
+        attempts = self.config.reconnect_attempts
+        for attempt, delay in enumerate(backoff_delays(self.config.reconnect_delay,
+                                                       self.config.reconnect_max_delay), 1):
+            if stop_event.wait(delay):
+                return None
             try:
-                input_container.close()
-                logger.info("Input stream closed")
+                input_container = self._open_input()
             except Exception as e:
-                logger.error(f"Error closing input stream: {e}", exc_info=True)
+                logger.warning(f"Reconnection attempt {attempt} failed: {e}")
+                if attempts and attempt >= attempts:
+                    raise ConnectionError(f"Input lost, gave up after {attempt} reconnection attempts") from e
+                continue
 
-    async def _process_stream(self, input_container):
-        """Process input stream"""
-        try:
-            # Get input streams
-            input_streams = input_container.streams
-            video_stream = next((s for s in input_streams if s.type == 'video'), None)
-            audio_stream = next((s for s in input_streams if s.type == 'audio'), None)
-
-            if not video_stream:
-                raise ValueError("No video stream found in input")
-
-            logger.info(f"Input video stream: {video_stream}")
-            if audio_stream:
-                logger.info(f"Input audio stream: {audio_stream}")
-
-            # Create output segment
-            output_container = self._create_new_segment()
-            logger.info(f"Created new segment: {self.current_segment['path']}")
-            segment_start_time = time.time()
-
-            # Create output streams
-            output_video_stream = output_container.add_stream(self.config.video_codec)
-            output_video_stream.width = self.config.width
-            output_video_stream.height = self.config.height
-            output_video_stream.pix_fmt = "yuv420p"
-            output_video_stream.bit_rate = self.config.video_bitrates[0]
-            output_video_stream.time_base = video_stream.time_base
-            if self.config.video_codec == "h264":
-                output_video_stream.options = {
-                    'preset': 'ultrafast',
-                    'tune': 'zerolatency',
-                    'profile': 'baseline'
-                }
-
-            output_audio_stream = None
-            if audio_stream:
-                output_audio_stream = output_container.add_stream(self.config.audio_codec)
-                output_audio_stream.bit_rate = self.config.audio_bitrates[0]
-                output_audio_stream.rate = audio_stream.rate or 44100
-                output_audio_stream.layout = audio_stream.layout or "stereo"
-                output_audio_stream.time_base = audio_stream.time_base
+            try:
+                video_stream, audio_stream = self._select_streams(input_container)
+                self._check_reopened_streams(video_stream, audio_stream)
+            except Exception:
+                input_container.close()
+                raise
+            self.input_container = input_container
+            self.stats["input_reconnects"] += 1
+            logger.info(f"Input reconnected after {attempt} attempts")
+            return input_container, [s for s in (video_stream, audio_stream) if s]
 
-            logger.info("Streams and codecs initialized successfully")
-            frame_count = 0
+    def _select_streams(self, input_container) -> tuple:
+        """Get the video and audio stream to convert from an input and set up the video decoder"""
+        input_streams = input_container.streams
+        video_stream = next((s for s in input_streams if s.type == 'video'), None)
+        audio_stream = next((s for s in input_streams if s.type == 'audio'), None)
 
-            # Process frames
-            for packet in input_container.demux():
-                try:
-                    current_time = time.time()
-                    if current_time - segment_start_time >= self.config.segment_duration:
-                        # Close current segment
-                        output_container.close()
-                        self.current_segment['duration'] = current_time - self.current_segment['start_time']
-                        if self.hls_server:
-                            self.hls_server.segments.append(self.current_segment)
-                            logger.debug(f"Added segment {self.segment_id} to HLS server")
-                        
-                        # Create new segment
-                        output_container = self._create_new_segment()
-                        segment_start_time = current_time
-                        
-                        # Recreate streams for new segment
-                        output_video_stream = output_container.add_stream(self.config.video_codec)
-                        output_video_stream.width = self.config.width
-                        output_video_stream.height = self.config.height
-                        output_video_stream.pix_fmt = "yuv420p"
-                        output_video_stream.bit_rate = self.config.video_bitrates[0]
-                        output_video_stream.time_base = video_stream.time_base
-                        
-                        if audio_stream:
-                            output_audio_stream = output_container.add_stream(self.config.audio_codec)
-                            output_audio_stream.bit_rate = self.config.audio_bitrates[0]
-                            output_audio_stream.rate = audio_stream.rate or 44100
-                            output_audio_stream.layout = audio_stream.layout or "stereo"
-                            output_audio_stream.time_base = audio_stream.time_base
-
-                    for frame in packet.decode():
-                        if isinstance(frame, av.VideoFrame):
-                            frame_count += 1
-                            # Ensure frame has correct format and size
-                            if (frame.width != self.config.width or
-                                    frame.height != self.config.height or
-                                    frame.format.name != "yuv420p"):
-                                frame = frame.reformat(
-                                    width=self.config.width,
-                                    height=self.config.height,
-                                    format="yuv420p"
-                                )
-
-                            packets = output_video_stream.encode(frame)
-                            for out_packet in packets:
-                                output_container.mux(out_packet)
-
-                            self.stats["processed_video_frames"] += 1
-
-                            if frame_count % 100 == 0:
-                                logger.info(f"Processed {frame_count} video frames")
-                                logger.debug(f"Current stats: {self.stats}")
-
-                        elif isinstance(frame, av.AudioFrame) and output_audio_stream:
-                            packets = output_audio_stream.encode(frame)
-                            for out_packet in packets:
-                                output_container.mux(out_packet)
-
-                            self.stats["processed_audio_frames"] += 1
+        if not video_stream:
+            raise ValueError("No video stream found in input")
+        # Takes effect when the decoder opens on the first packet
+        video_stream.codec_context.thread_type = self.config.decoder_thread_type.upper()
+        video_stream.codec_context.thread_count = self.config.decoder_threads
+        return video_stream, audio_stream
 
-                except Exception as e:
-                    logger.error(f"Error processing frame: {e}", exc_info=True)
-                    self.stats["encoding_errors"] += 1
+    def _check_reopened_streams(self, video_stream, audio_stream):
+        """Check that a reopened input can continue through the encoders of the first one"""
+        # Encoders and rebased timestamps use the time bases of the first input
+        if video_stream.time_base != self.video_stream.time_base:
+            raise ValueError(f"Reconnected input changed the video time base to {video_stream.time_base}")
+        if audio_stream and self.audio_stream and audio_stream.time_base != self.audio_stream.time_base:
+            raise ValueError(f"Reconnected input changed the audio time base to {audio_stream.time_base}")
+        if self.passthrough and not can_passthrough(self.config, self.passthrough, video_stream,
+                                                    None if self.audio_renditions else audio_stream):
+            raise ValueError("Reconnected input can no longer be passed through")
+
+    def _build_pipeline(self, input_container, loop: asyncio.AbstractEventLoop) -> Pipeline:
+        """Create the demux, decode and encode stages for an input"""
+        video_stream, audio_stream = self._select_streams(input_container)
+        self.video_stream, self.audio_stream = video_stream, audio_stream
 
-            # Flush encoders
-            if output_video_stream:
-                packets = output_video_stream.encode(None)
-                for packet in packets:
-                    output_container.mux(packet)
+        logger.info(f"Input video stream: {video_stream}")
+        if audio_stream:
+            logger.info(f"Input audio stream: {audio_stream}")
 
-            if output_audio_stream:
-                packets = output_audio_stream.encode(None)
-                for packet in packets:
-                    output_container.mux(packet)
+        streams = [s for s in (video_stream, audio_stream) if s]
+        renditions = self.config.get_renditions()
+        logger.info(f"Encoding renditions: {[f'{r.width}x{r.height}@{r.bitrate}' for r in renditions]}")
 
-            output_container.close()
+        # Audio is encoded once per audio bitrate, video segments then carry no audio
+        audio_renditions = []
+        if audio_stream and self.config.enable_audio_renditions:
+            audio_renditions = self.config.get_audio_renditions()
+            logger.info(f"Encoding audio renditions: {[r.name for r in audio_renditions]}")
+        self.audio_renditions = audio_renditions
+        muxed_audio_stream = None if audio_renditions else audio_stream
+        if self.hls_server:
+            self.hls_server.set_audio(bool(audio_renditions))
+
+        # Only the top rung can match the input, lower rungs always need scaling
+        top_rendition = max(renditions, key=lambda r: r.bitrate)
+        passthrough = None
+        if self.processor is not None:
+            # Remuxed packets would bypass the frame hooks
+            if self.config.enable_passthrough:
+                logger.info("Passthrough disabled, frame hooks apply to every rendition")
+        elif self.config.enable_passthrough and can_passthrough(self.config, top_rendition,
+                                                                video_stream, muxed_audio_stream):
+            passthrough = top_rendition
+        self.passthrough = passthrough
+        transcoded = [r for r in renditions if r is not passthrough]
+
+        stop_event = threading.Event()
+        packet_queues = []
+        queues = []
+        # Labels of the queues for the queue depth gauge
+        self.queue_names = []
+        stages = []
+
+        def on_segment(segment: dict):
+            # Finished segments are handed to the event loop thread, never awaited from workers
+            loop.call_soon_threadsafe(self._publish_segment, segment)
+
+        def on_part(part: dict):
+            loop.call_soon_threadsafe(self._publish_part, part)
+
+        def on_packet(kind: str, packet, media_time: float):
+            # Copied on the encode thread, muxing rewrites the packet
+            loop.call_soon_threadsafe(self.rtsp_server.send, kind, bytes(packet), media_time, packet.is_keyframe)
+
+        # The top rendition is restreamed over RTSP without encoding it again
+        restream = on_packet if self.rtsp_server else None
+
+        audio_writer = None
+        if audio_renditions:
+            top_audio_rendition = max(audio_renditions, key=lambda r: r.bitrate)
+            # Next to a remuxed rendition only, no video frames come by to place boundaries
+            audio_writers = [AudioSegmentWriter(
+                self.config, rendition, self.stats, on_segment=on_segment, follow_video=bool(transcoded),
+                on_part=on_part, first_segment_id=self.first_segment_id, resumed=self.resumed,
+                on_packet=restream if rendition is top_audio_rendition else None
+            ) for rendition in audio_renditions]
+            audio_writer = AudioGroupWriter(self.config, audio_writers, self.stats)
+            restreamed_audio = audio_writers[audio_renditions.index(top_audio_rendition)].audio_encoder
+
+        if transcoded or audio_writer:
+            packet_queue = queue.Queue(maxsize=self.config.max_buffer_size)
+            frame_queues = [queue.Queue(maxsize=self.config.max_buffer_size) for _ in transcoded]
+            packet_queues.append(packet_queue)
+            queues += [packet_queue] + frame_queues
+            self.queue_names += ['packets'] + [f'frames_{r.name}' for r in transcoded]
+            if audio_writer:
+                # Gets the video frames too, they place the segment boundaries
+                audio_queue = queue.Queue(maxsize=self.config.max_buffer_size)
+                frame_queues.append(audio_queue)
+                queues.append(audio_queue)
+                self.queue_names.append('frames_audio')
+            dropped_frames = DROPPED_FRAMES.labels(self.config.stream_name, '')
+
+            def on_drop():
+                self.stats["dropped_frames"] += 1
+                dropped_frames.inc()
+
+            # With frame hooks, decoded frames take a detour through the filter stage
+            decoded_queues = frame_queues
+            if self.processor is not None:
+                decoded_queues = [queue.Queue(maxsize=self.config.max_buffer_size)]
+                queues += decoded_queues
+                self.queue_names.append('filter')
+            # Without transcoded renditions only the audio is decoded
+            decoded_streams = streams if transcoded else [audio_stream]
+            stages.append(DecodeStage(decoded_streams, packet_queue, decoded_queues, stop_event,
+                                      on_error=self._count_error,
+                                      timer=STAGE_SECONDS.labels(self.config.stream_name, 'decode', ''),
+                                      scheduler=self.scheduler, on_drop=on_drop,
+                                      decimator=FrameDecimator(self.config.fps), motion=self.motion))
+            if self.processor is not None:
+                stages.append(FilterStage(self.processor, decoded_queues[0], frame_queues, stop_event,
+                                          on_drop=on_drop))
+            for rendition, frame_queue in zip(transcoded, frame_queues):
+                writer = SegmentWriter(
+                    self.config, rendition, video_stream, muxed_audio_stream, self.stats,
+                    on_segment=on_segment, primary=rendition is renditions[0], on_part=on_part,
+                    first_segment_id=self.first_segment_id, resumed=self.resumed, motion=self.motion,
+                    on_packet=restream if rendition is top_rendition else None
+                )
+                if restream and rendition is top_rendition:
+                    self.rtsp_server.set_source(writer.video_encoder,
+                                                restreamed_audio if audio_writer else writer.audio_encoder)
+                # One encoder thread per rendition, libav releases the GIL while scaling and encoding
+                stages.append(EncodeStage(frame_queue, writer, stop_event, name=f'encode_{rendition.name}'))
+            if audio_writer:
+                # All audio renditions share one thread, AAC encodes far faster than real time
+                stages.append(EncodeStage(audio_queue, audio_writer, stop_event, name='encode_audio'))
+
+        if passthrough:
+            remux_queue = queue.Queue(maxsize=self.config.max_buffer_size)
+            packet_queues.append(remux_queue)
+            queues.append(remux_queue)
+            self.queue_names.append(f'remux_{passthrough.name}')
+            writer = RemuxWriter(
+                self.config, passthrough, video_stream, muxed_audio_stream, self.stats,
+                on_segment=on_segment, primary=passthrough is renditions[0], on_part=on_part,
+                first_segment_id=self.first_segment_id, resumed=self.resumed, on_packet=restream
+            )
+            if restream:
+                self.rtsp_server.set_source(video_stream, restreamed_audio if audio_writer else audio_stream)
+            stages.append(RemuxStage(remux_queue, writer, stop_event, name=f'remux_{passthrough.name}'))
+
+        reopen = self._reopen_input if self.config.enable_reconnect else None
+        stages.insert(0, DemuxStage(input_container, streams, packet_queues, stop_event, reopen=reopen,
+                                    timer=STAGE_SECONDS.labels(self.config.stream_name, 'demux', '')))
+        return Pipeline(stages, queues, stop_event)
+
+    def _count_error(self, error: Exception):
+        self.stats["encoding_errors"] += 1
+
+    async def _process_stream(self, input_container):
+        """Process input stream on worker threads"""
+        try:
+            self.pipeline = self._build_pipeline(input_container, asyncio.get_running_loop())
+            logger.info("Streams and codecs initialized successfully")
+            self.pipeline.start()
+            sampler = asyncio.create_task(self._sample_metrics())
+
+            # Wait for the workers without blocking the event loop
+            try:
+                await asyncio.to_thread(self.pipeline.join)
+            finally:
+                sampler.cancel()
+
+            if self.pipeline.error:
+                raise self.pipeline.error
             logger.info("Stream processing completed")
 
         except Exception as e:
             logger.error(f"Error in stream processing: {e}", exc_info=True)
             raise
+        finally:
+            if self.pipeline:
+                self.pipeline.stop()
+
+    async def _sample_metrics(self):
+        """Update the gauges that are sampled rather than counted per frame"""
+        stream_name = self.config.stream_name
+        realtime_factor = REALTIME_FACTOR.labels(stream_name)
+        lag = LAG_SECONDS.labels(stream_name)
+        motion = MOTION_SCORE.labels(stream_name)
+        queue_depths = [QUEUE_DEPTH.labels(stream_name, name) for name in self.queue_names]
+        last_sample = (time.monotonic(), self.stats["media_time"])
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            for gauge, depth in zip(queue_depths, self.pipeline.queue_depths()):
+                gauge.set(depth)
+            sample = (time.monotonic(), self.stats["media_time"])
+            if sample[1] is not None and last_sample[1] is not None:
+                realtime_factor.set((sample[1] - last_sample[1]) / (sample[0] - last_sample[0]))
+            last_sample = sample
+            if self.scheduler is not None:
+                self.stats["lag"] = self.scheduler.lag
+                lag.set(self.scheduler.lag)
+            if self.motion is not None:
+                self.stats["motion"] = self.motion.score
+                self.stats["static"] = self.motion.static
+                motion.set(self.motion.score)
+
+    async def stop(self):
+        """Stop the conversion pipeline"""
+        if self.pipeline:
+            logger.info("Stopping stream conversion...")
+            self.pipeline.stop()
+            await asyncio.to_thread(self.pipeline.join)
 
     async def _log_stats(self):
         """Log processing statistics"""
@@ -216,8 +416,14 @@ class StreamConverter:
                     f"Video frames: {self.stats['processed_video_frames']}, "
                     f"Audio frames: {self.stats['processed_audio_frames']}, "
                     f"Errors: {self.stats['encoding_errors']}, "
+                    f"Dropped: {self.stats['dropped_frames']}, "
+                    f"Lag: {self.stats['lag']:.1f}s, "
+                    f"Motion: {self.stats['motion']:.4f}{' (static)' if self.stats['static'] else ''}, "
+                    f"Reconnects: {self.stats['input_reconnects']}, "
                     f"Video FPS: {self.stats['processed_video_frames'] / elapsed:.2f}, "
                     f"Audio FPS: {self.stats['processed_audio_frames'] / elapsed:.2f}"
                 )
+                if self.pipeline:
+                    logger.debug(f"Queue depths: {self.pipeline.queue_depths()}")
 
             await asyncio.sleep(5)
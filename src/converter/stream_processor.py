@@ -1,24 +1,299 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, List, Optional
+import av
+import numpy as np
 from ..config import StreamConfig
+from ..monitoring.metrics import HOOK_OVERRUNS, HOOK_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# What happens to a frame when a hook does not finish it within its budget
+OVERRUN_POLICIES = ('pass', 'drop')
+# Frames each hook process can have in flight, one being processed and one waiting
+FRAMES_PER_WORKER = 2
+# Seconds hook processes get to start, importing the hooks, before the stream starts without them
+START_TIMEOUT = 30.0
+# Seconds hook processes get to exit before they are killed
+STOP_TIMEOUT = 5.0
+# Pixel format of the arrays hooks work on, height x width x 3
+HOOK_FORMAT = 'rgb24'
+# First item a hook process puts on the results queue, with its index, unlike any frame result
+READY = 'ready'
+
+
+@dataclass(frozen=True)
+class FrameHook:
+    """A function run on the pixels of every video frame
+
+    The function gets the frame as a writable height x width x 3 RGB array
+    and its media time in seconds. Changes to the array end up in the
+    stream, a return value other than None is handed to on_result in the
+    converter process.
+    """
+    function: Callable[[np.ndarray, float], Any]
+    name: str
+    # Seconds the hook may take per frame
+    budget: float
+    on_overrun: str = 'pass'
+    on_result: Optional[Callable[[str, float, Any], None]] = None
+
+
+class Ticket:
+    """A frame handed to the hook processes, in one of the shared memory slots"""
+
+    def __init__(self, ticket_id: int, slot: int, shape: tuple, media_time: float, deadline: float):
+        self.id = ticket_id
+        self.slot = slot
+        self.shape = shape
+        self.media_time = media_time
+        self.deadline = deadline
+        self.done = threading.Event()
+        # Hooks that ran to completion, set once the result is back
+        self.completed = 0
+        # Set once the filter stage no longer waits for the result
+        self.abandoned = False
+
+
+def _run_hooks(index: int, functions: List[Callable], tasks, results, progress):
+    """Hook process main loop, runs the hooks on frames in shared memory until None comes
+
+    Slots are attached to once and stay attached, spawned processes share
+    the resource tracker of the converter, which unlinks them on stop.
+    """
+    slots: Dict[int, SharedMemory] = {}
+    # Frames are only submitted once every process is ready, or the first ones would all be late
+    results.put((READY, index))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            ticket_id, slot, name, shape, media_time, deadline = task
+            if slot not in slots or slots[slot].name != name:
+                if slot in slots:
+                    slots[slot].close()
+                slots[slot] = SharedMemory(name=name)
+            image = np.ndarray(shape, np.uint8, buffer=slots[slot].buf)
+            timings, values, error = [], [], None
+            for position, function in enumerate(functions):
+                # The filter stage already gave up on this frame
+                if time.monotonic() > deadline:
+                    break
+                started = time.monotonic()
+                try:
+                    values.append(function(image, media_time))
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    break
+                timings.append(time.monotonic() - started)
+                progress[slot] = position + 1
+            del image
+            results.put((ticket_id, timings, values, error))
+    finally:
+        for memory in slots.values():
+            memory.close()
+
 
 class StreamProcessor:
+    """Runs user hooks on decoded video frames in a pool of processes
+
+    Frames are copied once into shared memory slots, the hook processes
+    work on them in place, no pixels are pickled. Hooks run one after the
+    other in registration order, each frame in one process, several frames
+    at once with more than one process. Hooks must be importable module
+    level functions, the processes are spawned.
+    """
+
     def __init__(self, config: StreamConfig):
         self.config = config
         self.running = False
-        self._init_codecs()
-
-    def _init_codecs(self):
-        """Initialize codec configurations"""
-        self.video_codec_options = {
-            "h264": {
-                "preset": "veryfast",
-                "tune": "zerolatency",
-                "x264-params": "keyint=60:min-keyint=60"
-            }
-        }
-
-        self.audio_codec_options = {
-            "aac": {
-                "b:a": "128k",
-                "ar": 44100
-            }
-        }
+        self.hooks: List[FrameHook] = []
+        self.context = multiprocessing.get_context('spawn')
+        self.workers: List[multiprocessing.Process] = []
+        self.slots: List[Optional[SharedMemory]] = []
+        self.free_slots: List[int] = []
+        self.tickets: Dict[int, Ticket] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._collector: Optional[threading.Thread] = None
+        self._failed_hooks = set()
+
+    def add_hook(self, function: Callable[[np.ndarray, float], Any], budget: Optional[float] = None,
+                 on_overrun: str = 'pass', name: Optional[str] = None,
+                 on_result: Optional[Callable[[str, float, Any], None]] = None) -> FrameHook:
+        """Register a hook, run on every video frame before it is scaled and encoded
+
+        budget defaults to one frame interval. A frame whose hook does not
+        finish in time is passed on without the changes of that hook and
+        the ones after it, or dropped with on_overrun='drop', which hooks
+        masking private areas need.
+        """
+        if self.running:
+            raise RuntimeError("Hooks have to be added before the processor starts")
+        if on_overrun not in OVERRUN_POLICIES:
+            raise ValueError(f"Invalid overrun policy: {on_overrun}")
+        budget = 1 / self.config.fps if budget is None else budget
+        if budget <= 0:
+            raise ValueError("Invalid hook budget")
+        hook = FrameHook(function, name or function.__name__, budget, on_overrun, on_result)
+        self.hooks.append(hook)
+        logger.info(f"Added frame hook {hook.name} with a budget of {budget * 1000:.1f}ms")
+        return hook
+
+    @property
+    def budget(self) -> float:
+        """Seconds a frame may spend in the hooks before the overrun policy applies"""
+        return sum(hook.budget for hook in self.hooks)
+
+    def start(self):
+        """Spawn the hook processes"""
+        workers = self.config.processor_workers
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        # Hooks done with the frame in each slot, tells which hooks a late frame misses
+        self.progress = self.context.Array('i', workers * FRAMES_PER_WORKER, lock=False)
+        self.slots = [None] * (workers * FRAMES_PER_WORKER)
+        self.free_slots = list(range(len(self.slots)))
+        # Hook functions are pickled once per process, only slot names travel with every frame
+        functions = [hook.function for hook in self.hooks]
+        self.workers = [self.context.Process(target=_run_hooks, name=f'hooks_{index}',
+                                             args=(index, functions, self.tasks, self.results, self.progress),
+                                             daemon=True)
+                        for index in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        try:
+            for _ in self.workers:
+                self.results.get(timeout=START_TIMEOUT)
+        except queue.Empty:
+            # The late ones join in once ready, the collector skips their ready markers
+            logger.error(f"Hook processes did not start within {START_TIMEOUT}s")
+        self._collector = threading.Thread(target=self._collect, name='hook_results', daemon=True)
+        self._collector.start()
+        self.running = True
+        logger.info(f"Stream processor started {workers} hook processes for {len(self.hooks)} hooks")
+
+    def stop(self):
+        """Stop the hook processes and free the shared memory (blocking)"""
+        if not self.running:
+            return
+        self.running = False
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(STOP_TIMEOUT)
+            if worker.is_alive():
+                logger.warning(f"Hook process {worker.name} did not stop, killing it")
+                worker.kill()
+                worker.join()
+        self.results.put(None)
+        self._collector.join()
+        for memory in self.slots:
+            if memory is not None:
+                memory.close()
+                memory.unlink()
+        self.slots = []
+        logger.info("Stream processor stopped")
+
+    def submit(self, frame: av.VideoFrame) -> Optional[Ticket]:
+        """Copy a frame into a free slot and queue it for the hooks, None without a free slot"""
+        with self._lock:
+            if not self.free_slots:
+                return None
+            slot = self.free_slots.pop()
+        image = frame.to_ndarray(format=HOOK_FORMAT)
+        memory = self.slots[slot]
+        if memory is None or memory.size < image.nbytes:
+            if memory is not None:
+                memory.close()
+                memory.unlink()
+            memory = self.slots[slot] = SharedMemory(create=True, size=image.nbytes)
+        np.copyto(np.ndarray(image.shape, np.uint8, buffer=memory.buf), image)
+
+        media_time = frame.time if frame.time is not None else 0.0
+        ticket = Ticket(next(self._ids), slot, image.shape, media_time, time.monotonic() + self.budget)
+        self.progress[slot] = 0
+        with self._lock:
+            self.tickets[ticket.id] = ticket
+        self.tasks.put((ticket.id, slot, memory.name, image.shape, media_time, ticket.deadline))
+        return ticket
+
+    def take(self, ticket: Ticket, frame: av.VideoFrame) -> Optional[av.VideoFrame]:
+        """The frame to pass on for a ticket that is done or past its deadline, None to drop it"""
+        with self._lock:
+            if not ticket.done.is_set():
+                # The slot stays taken until the late hook process is done with it
+                ticket.abandoned = True
+                completed = self.progress[ticket.slot]
+            else:
+                completed = ticket.completed
+                self._release(ticket)
+        if completed == len(self.hooks):
+            memory = self.slots[ticket.slot]
+            processed = av.VideoFrame.from_ndarray(np.ndarray(ticket.shape, np.uint8, buffer=memory.buf),
+                                                   format=HOOK_FORMAT)
+            processed.pts = frame.pts
+            processed.time_base = frame.time_base
+            processed.duration = frame.duration
+            return processed
+
+        return self._overrun(frame, self.hooks[completed:])
+
+    def bypass(self, frame: av.VideoFrame) -> Optional[av.VideoFrame]:
+        """The frame to pass on without running any hook, None to drop it"""
+        return self._overrun(frame, self.hooks)
+
+    def _overrun(self, frame: av.VideoFrame, missed: List[FrameHook]) -> Optional[av.VideoFrame]:
+        """Apply the policies of the hooks a frame missed"""
+        HOOK_OVERRUNS.labels(self.config.stream_name, missed[0].name).inc()
+        if any(hook.on_overrun == 'drop' for hook in missed):
+            return None
+        return frame
+
+    def _release(self, ticket: Ticket):
+        del self.tickets[ticket.id]
+        self.free_slots.append(ticket.slot)
+
+    def _collect(self):
+        """Hand hook results over to the tickets (collector thread)"""
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            if result[0] == READY:
+                logger.warning(f"Hook process {result[1]} became ready late")
+                continue
+            ticket_id, timings, values, error = result
+            for hook, elapsed in zip(self.hooks, timings):
+                HOOK_SECONDS.labels(self.config.stream_name, hook.name).observe(elapsed)
+            if error is not None:
+                self._report_error(self.hooks[len(timings)], error)
+            with self._lock:
+                ticket = self.tickets.get(ticket_id)
+                if ticket is None:
+                    continue
+                ticket.completed = len(timings)
+                ticket.done.set()
+                if ticket.abandoned:
+                    self._release(ticket)
+                    continue
+            for hook, value in zip(self.hooks, values):
+                if value is not None and hook.on_result is not None:
+                    try:
+                        hook.on_result(hook.name, ticket.media_time, value)
+                    except Exception as e:
+                        logger.error(f"Error handling result of frame hook {hook.name}: {e}", exc_info=True)
+
+    def _report_error(self, hook: FrameHook, error: str):
+        """Log the first error of a hook, later ones only count as overruns"""
+        if hook.name in self._failed_hooks:
+            return
+        self._failed_hooks.add(hook.name)
+        logger.error(f"Frame hook {hook.name} failed: {error}, further errors are not logged")
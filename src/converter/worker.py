@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from ..config import StreamConfig
+from .stream_converter import StreamConverter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between stats updates sent to the supervisor
+STATS_INTERVAL = 1.0
+
+
+class QueuePublisher:
+    """Stands in for the HLS server inside a worker process
+
+    Everything the converter publishes is put on the supervisor's event
+    queue as (kind, stream name, payload) tuples.
+    """
+
+    def __init__(self, name: str, events):
+        self.name = name
+        self.events = events
+        self.converter = None
+
+    @staticmethod
+    def _detach(item: dict) -> dict:
+        """Copy a segment or part, turning memoryviews of muxer buffers into picklable bytes"""
+        item = dict(item)
+        for key in ('data', 'init'):
+            if item.get(key) is not None:
+                item[key] = bytes(item[key])
+        if 'parts' in item:
+            item['parts'] = [QueuePublisher._detach(part) for part in item['parts']]
+        return item
+
+    def add_segment(self, segment: dict):
+        self.events.put(('segment', self.name, self._detach(segment)))
+
+    def add_part(self, part: dict):
+        self.events.put(('part', self.name, self._detach(part)))
+
+    def set_audio(self, available: bool):
+        self.events.put(('audio', self.name, available))
+
+    def send_stats(self, stats: dict):
+        self.events.put(('stats', self.name, dict(stats)))
+
+    async def forward_stats(self, stats: dict):
+        """Send the converter stats to the supervisor periodically"""
+        while True:
+            self.send_stats(stats)
+            await asyncio.sleep(STATS_INTERVAL)
+
+
+async def _convert(name: str, config: StreamConfig, events, first_segment_id: int, resumed: bool):
+    converter = StreamConverter(config, first_segment_id=first_segment_id, resumed=resumed)
+    publisher = QueuePublisher(name, events)
+    converter.set_hls_server(publisher)
+    stats_task = asyncio.create_task(publisher.forward_stats(converter.stats))
+    try:
+        await converter.start_conversion()
+    finally:
+        stats_task.cancel()
+        publisher.send_stats(converter.stats)
+
+
+def run_worker(name: str, config: StreamConfig, events, first_segment_id: int = 1, resumed: bool = False,
+               log_level: int = logging.INFO):
+    """Convert one stream in a worker process (process entry point)"""
+    logging.basicConfig(
+        level=log_level,
+        format=f'%(asctime)s - {name} - %(name)s - %(levelname)s - %(message)s'
+    )
+    logger.info(f"Worker for stream {name} started from segment {first_segment_id}")
+    asyncio.run(_convert(name, config, events, first_segment_id, resumed))
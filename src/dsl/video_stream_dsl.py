@@ -1,7 +1,7 @@
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional
 from ..config import StreamConfig, StreamType
-from ..converter import StreamConverter
-from ..server import HLSServer
+from ..converter import StreamConverter, StreamProcessor
+from ..server import HLSServer, RTSPServer, StreamSupervisor
 import asyncio
 import logging
 import os
@@ -29,19 +29,26 @@ class VideoStreamDSL:
         self.rtsp_port = int(os.getenv('RTSP_SERVER_PORT', '8554'))
         self.hls_port = int(os.getenv('HLS_SERVER_PORT', '8080'))
         self.hls_server = None
+        self.rtsp_server = None
         self.converter = None
+        self.processor = None
 
     def source(self, url: str = None) -> 'VideoStreamDSL':
         """Define stream source"""
         if url:
             self.config.input_url = url
-        elif not self.config.input_url:
+        elif not self.config.input_url and not self.config.input_streams:
             raise ValueError("Stream source URL is required")
         return self
 
+    def sources(self, streams: Dict[str, str]) -> 'VideoStreamDSL':
+        """Define named stream sources, each converted in its own worker process"""
+        self.config.input_streams = dict(streams)
+        return self
+
     def rtsp(self, port: int = None) -> 'VideoStreamDSL':
-        """Configure RTSP output"""
-        self.stream_type = StreamType.RTSP
+        """Configure RTSP output, restreaming the top rendition"""
+        self.stream_type = StreamType.BOTH if self.stream_type is StreamType.HLS else StreamType.RTSP
         if port:
             self.rtsp_port = port
         return self
@@ -50,7 +57,7 @@ class VideoStreamDSL:
             playlist_size: int = None,
             port: int = None) -> 'VideoStreamDSL':
         """Configure HLS output"""
-        self.stream_type = StreamType.HLS
+        self.stream_type = StreamType.BOTH if self.stream_type is StreamType.RTSP else StreamType.HLS
         if segment_duration:
             self.config.segment_duration = segment_duration
         if playlist_size:
@@ -68,6 +75,27 @@ class VideoStreamDSL:
             self.config.audio_bitrates = audio_bitrates
         return self
 
+    def passthrough(self, enabled: bool = True) -> 'VideoStreamDSL':
+        """Remux HLS-compatible input without transcoding when possible"""
+        self.config.enable_passthrough = enabled
+        return self
+
+    def low_latency(self, enabled: bool = True, part_duration: float = None) -> 'VideoStreamDSL':
+        """Publish LL-HLS partial segments"""
+        self.config.enable_low_latency = enabled
+        if part_duration:
+            self.config.part_duration = part_duration
+        return self
+
+    def process(self, function: Callable[..., Any], budget: float = None, on_overrun: str = 'pass',
+                name: str = None, on_result: Callable[[str, float, Any], None] = None) -> 'VideoStreamDSL':
+        """Run a module level function on the RGB pixels of every video frame before encoding"""
+        if self.processor is None:
+            self.processor = StreamProcessor(self.config)
+        self.processor.add_hook(function, budget=budget, on_overrun=on_overrun, name=name,
+                                on_result=on_result)
+        return self
+
     def output(self, path: str = None) -> 'VideoStreamDSL':
         """Define output path"""
         if path:
@@ -86,18 +114,32 @@ class VideoStreamDSL:
             player_url = f"http://localhost:{self.hls_port}/player"
             logger.info(f"Web player available at: {player_url}")
 
+    async def start_rtsp_server(self):
+        """Start RTSP server"""
+        if self.stream_type in [StreamType.RTSP, StreamType.BOTH]:
+            self.config.rtsp_server_port = self.rtsp_port
+            self.rtsp_server = RTSPServer(self.config)
+            await self.rtsp_server.start()
+            logger.info(f"RTSP stream available at: rtsp://localhost:{self.rtsp_port}/stream")
+
     async def build(self) -> StreamConverter:
         """Build and return stream converter"""
-        self.converter = StreamConverter(self.config)
+        self.converter = StreamConverter(self.config, processor=self.processor)
         if self.hls_server:
             self.converter.set_hls_server(self.hls_server)
+        if self.rtsp_server:
+            self.converter.set_rtsp_server(self.rtsp_server)
         return self.converter
 
     async def run(self):
         """Run the complete streaming pipeline"""
+        if self.config.input_streams:
+            await self.run_streams()
+            return
         try:
-            # Start HLS server
+            # Start HLS and RTSP servers
             await self.start_hls_server()
+            await self.start_rtsp_server()
             
             # Build and start converter
             self.converter = await self.build()
@@ -108,3 +150,14 @@ class VideoStreamDSL:
         except Exception as e:
             logger.error(f"Error running streaming pipeline: {e}")
             raise
+
+    async def run_streams(self):
+        """Run every named source in its own worker process behind one HLS server"""
+        self.config.hls_server_port = self.hls_port
+        if self.processor is not None:
+            logger.warning("Frame hooks only run with a single source, ignoring them")
+        if self.stream_type is not StreamType.HLS:
+            logger.warning("RTSP restreaming only runs with a single source, serving HLS only")
+        supervisor = StreamSupervisor(self.config)
+        logger.info(f"Streams available at: http://localhost:{self.hls_port}/streams")
+        await supervisor.run()
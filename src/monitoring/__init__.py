@@ -0,0 +1,3 @@
+from .metrics import render_metrics, METRICS_CONTENT_TYPE
+
+__all__ = ['render_metrics', 'METRICS_CONTENT_TYPE']
@@ -0,0 +1,87 @@
+import os
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Per packet and per frame work, from tens of microseconds up to a frame interval and beyond
+FRAME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+# Segment writes and HTTP requests, blocking playlist reloads wait up to three target durations
+REQUEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Children are bound to their labels once per stage or writer, so the per-frame
+# cost is one perf_counter() pair and a lock-protected bucket increment
+
+STAGE_SECONDS = Histogram(
+    'hls_stage_seconds', 'Time spent per packet (demux, decode) or video frame (scale, encode, mux)',
+    ['stream', 'stage', 'rendition'], buckets=FRAME_BUCKETS
+)
+HOOK_SECONDS = Histogram(
+    'hls_hook_seconds', 'Time a frame hook took per video frame',
+    ['stream', 'hook'], buckets=FRAME_BUCKETS
+)
+SEGMENT_WRITE_SECONDS = Histogram(
+    'hls_segment_write_seconds', 'Time to finish a segment and store it',
+    ['stream', 'rendition'], buckets=REQUEST_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    'hls_request_seconds', 'Time to answer playlist and media requests, blocking reloads included',
+    ['stream', 'kind'], buckets=REQUEST_BUCKETS
+)
+QUEUE_DEPTH = Gauge(
+    'hls_queue_depth', 'Items waiting in a pipeline queue',
+    ['stream', 'queue'], multiprocess_mode='livesum'
+)
+REALTIME_FACTOR = Gauge(
+    'hls_realtime_factor', 'Media seconds converted per wall clock second, below 1 the converter falls behind',
+    ['stream'], multiprocess_mode='livemax'
+)
+LAG_SECONDS = Gauge(
+    'hls_lag_seconds', 'Seconds the video being decoded is behind the live input',
+    ['stream'], multiprocess_mode='livemax'
+)
+MOTION_SCORE = Gauge(
+    'hls_motion_score', 'Fraction of pixels that changed between the latest decoded frames',
+    ['stream'], multiprocess_mode='livemax'
+)
+RTSP_CLIENTS = Gauge(
+    'hls_rtsp_clients', 'RTSP clients receiving media',
+    ['stream'], multiprocess_mode='livesum'
+)
+BYTES_OUT = Counter(
+    'hls_bytes_out', 'Bytes of segments, parts and init segments served',
+    ['stream', 'rendition']
+)
+HOOK_OVERRUNS = Counter(
+    'hls_hook_overruns', 'Video frames a hook did not finish within its budget or failed on',
+    ['stream', 'hook']
+)
+RTSP_DROPPED_PACKETS = Counter(
+    'hls_rtsp_dropped_packets', 'RTP packets skipped for RTSP clients that did not keep up',
+    ['stream']
+)
+DROPPED_FRAMES = Counter(
+    'hls_dropped_frames', 'Video frames that did not make it into a segment, rendition "" for frames '
+    'dropped before decoding',
+    ['stream', 'rendition']
+)
+
+
+def render_metrics() -> bytes:
+    """Serialize the metrics, aggregated over all processes in multiprocess mode
+
+    With PROMETHEUS_MULTIPROC_DIR set, as multi-stream mode needs to see
+    the metrics of its worker processes, every process records into that
+    directory and the collector merges them.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def process_exited(pid: int):
+    """Drop the live gauges of an exited worker process"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
@@ -1,4 +1,6 @@
 from .rtsp_server import RTSPServer
 from .hls_server import HLSServer
+from .segment_store import SegmentStore
+from .supervisor import StreamSupervisor
 
-__all__ = ['RTSPServer', 'HLSServer']
+__all__ = ['RTSPServer', 'HLSServer', 'SegmentStore', 'StreamSupervisor']
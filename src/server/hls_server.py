@@ -1,24 +1,80 @@
+import asyncio
 import logging
+import os
 from pathlib import Path
-import m3u8
+from typing import Optional, Tuple
 from aiohttp import web
 import jinja2
 import aiohttp_jinja2
 import time
 from ..config import StreamConfig
+from ..monitoring.metrics import BYTES_OUT, METRICS_CONTENT_TYPE, REQUEST_SECONDS, render_metrics
+from .playlist import (PLAYLIST_CONTENT_TYPE, RenderedPlaylist, content_etag, render_master_playlist,
+                       render_media_playlist)
+from .segment_store import SegmentStore
 
 logger = logging.getLogger(__name__)
 
+# Rendition names in media URLs, video bitrates and audio_<bitrate> for audio renditions
+RENDITION_PATTERN = r'(?:audio_)?\d+'
+
+# MIME type of media segments and parts per segment format
+SEGMENT_CONTENT_TYPES = {'mpegts': 'video/mp2t', 'fmp4': 'video/mp4'}
+
+# Request latency label per handler, other routes are not timed
+REQUEST_KINDS = {
+    '_handle_master_playlist': 'playlist',
+    '_handle_playlist': 'playlist',
+    '_handle_segment': 'segment',
+    '_handle_part': 'part',
+    '_handle_init': 'init'
+}
+
+
+def _request_kind(request) -> str:
+    """Get the REQUEST_KINDS label of the handler serving a request, None for other routes"""
+    return REQUEST_KINDS.get(getattr(request.match_info.route.handler, '__name__', None))
+
+
 class HLSServer:
-    """HLS Server Implementation"""
+    """HLS Server Implementation
 
-    def __init__(self, config: StreamConfig):
+    In multi-stream mode each stream's server is mounted below /<stream>,
+    its playlists then point at URIs below that prefix.
+    """
+
+    def __init__(self, config: StreamConfig, prefix: str = ''):
         self.config = config
-        self.segments = []
+        self.prefix = prefix
+        self.renditions = config.get_renditions()
+        self.audio_renditions = config.get_audio_renditions() if config.enable_audio_renditions else []
+        # Set by the converter once it knows whether the input has audio for the audio renditions
+        self.has_audio = False
+        self.rendition_names = [r.name for r in self.renditions + self.audio_renditions]
+        # CODECS of every rendition, as its latest segment reports them
+        self.codecs = {}
+        self.segments = SegmentStore(self.rendition_names, config.get_live_window_size())
+        # Playlists are rendered when their content changes, not per request
+        self.master_playlist = self._render_master_playlist()
+        self.playlists = {name: self._render_playlist(name) for name in self.rendition_names}
+        # Latest fMP4 init segment per rendition and the ETag of its bytes
+        self.init_segments = {}
+        self.init_etags = {}
+        # Segment ids start over with a restarted server, the boot id keeps media ETags unique
+        self.boot_id = f'{time.time_ns():x}'
+        self.cache_control = self._cache_policies()
+        self.segment_content_type = SEGMENT_CONTENT_TYPES[config.segment_format]
+        # Set and replaced whenever a rendition publishes, wakes blocking playlist requests
+        self._updates = {name: asyncio.Event() for name in self.rendition_names}
+        # Delayed deletions of segment files that left the live window
+        self._cleanup_tasks = set()
+        self.runner = None
         self.app = web.Application()
         self._setup_routes()
         self._setup_templates()
         self.converter = None  # Will be set by the DSL
+        self._request_timers = {kind: REQUEST_SECONDS.labels(config.stream_name, kind)
+                                for kind in set(REQUEST_KINDS.values())}
         logger.info("HLS Server initialized")
 
     def _setup_templates(self):
@@ -32,12 +88,21 @@ class HLSServer:
         # API routes
         self.app.router.add_get('/stream.m3u8', self._handle_master_playlist)
         self.app.router.add_get('/stream_{bitrate}.m3u8', self._handle_playlist)
-        self.app.router.add_get('/segment_{id}.ts', self._handle_segment)
+        extension = self.config.get_segment_extension()
+        self.app.router.add_get(f'/segment_{{bitrate:{RENDITION_PATTERN}}}_{{id:\\d+}}.{extension}',
+                                self._handle_segment)
+        self.app.router.add_get(f'/part_{{bitrate:{RENDITION_PATTERN}}}_{{id:\\d+}}_{{index:\\d+}}.{extension}',
+                                self._handle_part)
+        self.app.router.add_get(f'/init_{{bitrate:{RENDITION_PATTERN}}}.mp4', self._handle_init)
         self.app.router.add_get('/player', self._handle_player)
         self.app.router.add_get('/stats', self._handle_stats)
+        self.app.router.add_get('/metrics', handle_metrics)
         
         # Add CORS middleware
         self.app.middlewares.append(self._cors_middleware)
+        self.app.middlewares.append(self._metrics_middleware)
+        self.app.middlewares.append(self._cache_middleware)
+        self.app.on_response_prepare.append(self._count_file_bytes)
         logger.debug("Routes and middleware configured")
 
     @web.middleware
@@ -54,22 +119,215 @@ class HLSServer:
         response.headers['Access-Control-Max-Age'] = '86400'  # 24 hours
         return response
 
+    @web.middleware
+    async def _metrics_middleware(self, request, handler):
+        """Time playlist and media requests until their response is ready"""
+        kind = _request_kind(request)
+        if kind is None:
+            return await handler(request)
+        started = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            self._request_timers[kind].observe(time.perf_counter() - started)
+
+    def _cache_policies(self) -> dict:
+        """Get the Cache-Control value per request kind"""
+        playlist = f'public, max-age={self.config.get_playlist_max_age()}'
+        # Finished segments and parts never change, so CDNs serve them without revalidation
+        media = f'public, max-age={self.config.segment_max_age}, immutable'
+        return {
+            'playlist': playlist,
+            # An answer to a blocking reload stays valid for as long as the reload may be held,
+            # later answers for the same part only add to it
+            'blocking_playlist': f'public, max-age={3 * self.config.segment_duration}',
+            'segment': media,
+            'part': media,
+            # Replaced when the encoders restart, so it is revalidated like a playlist
+            'init': playlist
+        }
+
+    @web.middleware
+    async def _cache_middleware(self, request, handler):
+        """Set the caching policy of playlists and media for CDNs and reverse proxies"""
+        kind = _request_kind(request)
+        if kind is None:
+            return await handler(request)
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            # A missing segment or part may be published shortly, nothing should cache its absence
+            e.headers['Cache-Control'] = 'no-cache'
+            raise
+        if kind == 'playlist' and self.config.enable_low_latency and '_HLS_msn' in request.query:
+            kind = 'blocking_playlist'
+        response.headers['Cache-Control'] = self.cache_control[kind]
+        if self.config.enable_surrogate_keys:
+            stream = self.config.stream_name or 'hls'
+            keys = [stream, f'{stream}-{kind}']
+            if 'bitrate' in request.match_info:
+                keys.append(f"{stream}-{request.match_info['bitrate']}")
+            response.headers['Surrogate-Key'] = ' '.join(keys)
+        return response
+
+    def _count_bytes(self, rendition: str, size: int):
+        BYTES_OUT.labels(self.config.stream_name, rendition).inc(size)
+
+    async def _count_file_bytes(self, request, response):
+        """Count the bytes of a file segment once FileResponse decided to send them, not for a 304"""
+        if isinstance(response, web.FileResponse) and response.status in (200, 206):
+            self._count_bytes(request.match_info['bitrate'], response.content_length)
+
+    def add_segment(self, segment: dict):
+        """Publish a finished segment of a rendition (called on the event loop)"""
+        evicted = self.segments.add(segment)
+        if segment.get('init') is not None and segment['init'] != self.init_segments.get(segment['rendition']):
+            self.init_segments[segment['rendition']] = segment['init']
+            self.init_etags[segment['rendition']] = content_etag(segment['init'])
+        codecs = segment.get('codecs')
+        if codecs is not None and codecs != self.codecs.get(segment['rendition']):
+            self.codecs[segment['rendition']] = codecs
+            self.master_playlist = self._render_master_playlist()
+        self._publish(segment['rendition'])
+        # In-memory segments go away with the store entry, DVR recordings are kept
+        paths = [s['path'] for s in evicted if s.get('path') and s.get('data') is None]
+        if paths and not self.config.enable_dvr:
+            task = asyncio.get_running_loop().create_task(self._delete_files_later(paths))
+            self._cleanup_tasks.add(task)
+            task.add_done_callback(self._cleanup_tasks.discard)
+
+    def add_part(self, part: dict):
+        """Publish a partial segment of the segment being encoded (called on the event loop)"""
+        self.segments.add_part(part)
+        self._publish(part['rendition'])
+
+    def set_audio(self, available: bool):
+        """List the audio renditions in the master playlist, or stop listing them (called on the event loop)
+
+        The converter tells once it opened the input, the master playlist
+        must not point players at audio playlists that never get segments.
+        """
+        has_audio = available and bool(self.audio_renditions)
+        if has_audio != self.has_audio:
+            self.has_audio = has_audio
+            self.master_playlist = self._render_master_playlist()
+            logger.info(f"Master playlist {'lists' if has_audio else 'no longer lists'} the audio renditions")
+
+    def _render_master_playlist(self) -> RenderedPlaylist:
+        return render_master_playlist(self.renditions, self.prefix,
+                                      self.audio_renditions if self.has_audio else None,
+                                      self.config.audio_channels, self.codecs)
+
+    def _publish(self, rendition: str):
+        """Re-render the playlist of a rendition and wake the requests waiting for it"""
+        self.playlists[rendition] = self._render_playlist(rendition)
+        event = self._updates[rendition]
+        self._updates[rendition] = asyncio.Event()
+        event.set()
+
+    def next_segment_id(self) -> int:
+        """Get the first segment id for a restarted converter, past every id already used"""
+        last_id = 0
+        for name in self.rendition_names:
+            pending = self.segments.pending_parts(name)
+            last_id = max(last_id, self.segments.last_id(name),
+                          pending[-1]['segment_id'] if pending else 0)
+        return last_id + 1
+
+    def _render_playlist(self, rendition: str) -> RenderedPlaylist:
+        """Render the media playlist of a rendition from the live window"""
+        segments = self.segments.latest(rendition, self.config.playlist_size)
+        logger.debug(f"Rendered media playlist of {rendition} with {len(segments)} segments")
+        if not self.config.enable_low_latency:
+            return render_media_playlist(self.config, rendition, segments, prefix=self.prefix)
+
+        # Renditions publish in lockstep, so reports of the others lag by at most one part.
+        # Players switch between video renditions and between audio renditions, never across
+        group = self.audio_renditions if rendition.startswith('audio_') else self.renditions
+        reports = []
+        for other in group:
+            if other.name != rendition:
+                reports.append((other.name, *self._last_part(other.name)))
+        return render_media_playlist(self.config, rendition, segments,
+                                     self.segments.pending_parts(rendition), reports, self.prefix)
+
+    def _last_part(self, rendition: str) -> tuple:
+        """Get the media sequence number and part index last published by a rendition"""
+        pending = self.segments.pending_parts(rendition)
+        if pending:
+            return pending[-1]['segment_id'], pending[-1]['index']
+        last_id = self.segments.last_id(rendition)
+        segment = self.segments.get(rendition, last_id)
+        parts = segment.get('parts') if segment else None
+        return last_id, len(parts) - 1 if parts else None
+
+    async def _wait_for_part(self, rendition: str, segment_id: int, index: int = None) -> bool:
+        """Wait until a segment or one of its parts is published, at most three target durations"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 3 * self.config.segment_duration
+        while not self.segments.has_part(rendition, segment_id, index):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._updates[rendition].wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _delete_files_later(self, paths: list):
+        """Delete segment files once players had time to finish downloading them"""
+        await asyncio.sleep(self.config.segment_grace_period)
+        await asyncio.to_thread(self._delete_files, paths)
+
+    @staticmethod
+    def _delete_files(paths: list):
+        """Delete files, ignoring the ones already gone (blocking)"""
+        for path in paths:
+            try:
+                Path(path).unlink(missing_ok=True)
+                logger.debug(f"Deleted segment file: {path}")
+            except OSError as e:
+                logger.error(f"Error deleting segment file {path}: {e}")
+
+    def _sweep_stale_segments(self):
+        """Delete segment files left in output_path by a previous run (blocking)"""
+        output_path = Path(self.config.output_path)
+        stale = [*output_path.glob('segment_*.ts'), *output_path.glob('segment_*.m4s'),
+                 *output_path.glob('init_*.mp4'), *output_path.glob('*.tmp')]
+        self._delete_files(stale)
+        if stale:
+            logger.info(f"Removed {len(stale)} stale segments from {self.config.output_path}")
+
     async def start(self):
         """Start HLS server"""
         logger.info("Starting HLS server...")
-        runner = web.AppRunner(self.app)
-        await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', self.config.hls_server_port)
+        if not self.config.enable_dvr:
+            await asyncio.to_thread(self._sweep_stale_segments)
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '0.0.0.0', self.config.hls_server_port)
         await site.start()
         logger.info(f"HLS Server started on port {self.config.hls_server_port}")
         logger.debug(f"Server configuration: {vars(self.config)}")
 
+    async def stop(self):
+        """Stop HLS server"""
+        # Files still waiting for their grace period are swept on the next start
+        for task in list(self._cleanup_tasks):
+            task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        logger.info("HLS Server stopped")
+
     @aiohttp_jinja2.template('player.html')
     async def _handle_player(self, request):
         """Handle player page request"""
         logger.debug(f"Player page requested from {request.remote}")
         return {
-            'stream_url': '/stream.m3u8',
+            'stream_url': f'{self.prefix}/stream.m3u8',
+            'stats_url': f'{self.prefix}/stats',
             'server_url': f'http://{request.host}'
         }
 
@@ -84,7 +342,14 @@ class HLSServer:
                 'processed_audio_frames': self.converter.stats['processed_audio_frames'],
                 'video_fps': self.converter.stats['processed_video_frames'] / elapsed if elapsed > 0 else 0,
                 'audio_fps': self.converter.stats['processed_audio_frames'] / elapsed if elapsed > 0 else 0,
-                'encoding_errors': self.converter.stats['encoding_errors']
+                'encoding_errors': self.converter.stats['encoding_errors'],
+                'dropped_frames': self.converter.stats['dropped_frames'],
+                'lag': self.converter.stats['lag'],
+                'motion': self.converter.stats['motion'],
+                'static': self.converter.stats['static'],
+                'input_reconnects': self.converter.stats['input_reconnects'],
+                'input_down': self.converter.stats['input_lost_at'] is not None,
+                'last_recovery_time': self.converter.stats['last_recovery_time']
             }
             logger.debug(f"Returning stats: {stats}")
             return web.json_response(stats)
@@ -93,66 +358,159 @@ class HLSServer:
             'processed_audio_frames': 0,
             'video_fps': 0,
             'audio_fps': 0,
-            'encoding_errors': 0
+            'encoding_errors': 0,
+            'dropped_frames': 0,
+            'lag': 0.0,
+            'motion': 0.0,
+            'static': False,
+            'input_reconnects': 0,
+            'input_down': False,
+            'last_recovery_time': None
         })
 
+    @staticmethod
+    def _conditional_response(request, body, etag: str, content_type: str) -> web.Response:
+        """Serve bytes with a strong ETag, answering conditional requests with 304"""
+        if any(match.value == etag for match in request.if_none_match or ()):
+            response = web.Response(status=304)
+        else:
+            response = web.Response(body=body, content_type=content_type)
+        response.etag = etag
+        return response
+
+    def _playlist_response(self, request, playlist: RenderedPlaylist) -> web.Response:
+        """Serve pre-rendered playlist bytes"""
+        return self._conditional_response(request, playlist.body, playlist.etag, PLAYLIST_CONTENT_TYPE)
+
+    def _media_response(self, request, rendition: str, data, etag: str, content_type: str) -> web.Response:
+        """Serve in-memory media, answering conditional and range requests and counting the bytes sent"""
+        if any(match.value == etag for match in request.if_none_match or ()):
+            response = web.Response(status=304)
+        else:
+            byte_range = self._byte_range(request, len(data))
+            if byte_range is None or not self._range_applies(request, etag):
+                body = data
+                response = web.Response(body=body, content_type=content_type)
+            else:
+                start, stop = byte_range
+                body = data[start:stop]
+                response = web.Response(status=206, body=body, content_type=content_type)
+                response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(data)}'
+            self._count_bytes(rendition, len(body))
+        response.etag = etag
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    @staticmethod
+    def _range_applies(request, etag: str) -> bool:
+        """Check an If-Range precondition, a range of a changed representation is not served"""
+        if_range = request.headers.get('If-Range')
+        return if_range is None or if_range.strip('"') == etag
+
+    @staticmethod
+    def _byte_range(request, size: int) -> Optional[Tuple[int, int]]:
+        """Get the start and end (exclusive) of the bytes a Range header asks for, None without one"""
+        try:
+            requested = request.http_range
+        except ValueError:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+        if requested.start is None and requested.stop is None:
+            return None
+        start, stop, _ = requested.indices(size)
+        if start >= stop:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+        return start, stop
+
     async def _handle_master_playlist(self, request):
         """Handle master playlist request"""
         logger.debug("Master playlist requested")
-        playlist = m3u8.M3U8()
-        playlist.is_endlist = False
-        playlist.is_live = True
-
-        # Add different quality variants
-        for bitrate in self.config.video_bitrates:
-            playlist.add_playlist(
-                uri=f'/stream_{bitrate}.m3u8',
-                stream_info={
-                    'bandwidth': bitrate,
-                    'resolution': f"{self.config.width}x{self.config.height}",
-                    'codecs': 'avc1.42E01E,mp4a.40.2'
-                }
-            )
-
-        logger.debug(f"Generated master playlist with {len(self.config.video_bitrates)} variants")
-        return web.Response(
-            text=playlist.dumps(),
-            content_type='application/vnd.apple.mpegurl'
-        )
+        return self._playlist_response(request, self.master_playlist)
 
     async def _handle_playlist(self, request):
         """Handle media playlist request"""
         bitrate = request.match_info['bitrate']
         logger.debug(f"Media playlist requested for bitrate {bitrate}")
-        
-        playlist = m3u8.M3U8()
-        playlist.target_duration = self.config.segment_duration
-        playlist.is_endlist = False
-        playlist.is_live = True
-
-        # Add segments
-        for segment in self.segments[-self.config.playlist_size:]:
-            playlist.add_segment(
-                uri=f'/segment_{segment["id"]}.ts',
-                duration=segment["duration"]
-            )
-
-        logger.debug(f"Generated media playlist with {len(self.segments[-self.config.playlist_size:])} segments")
-        return web.Response(
-            text=playlist.dumps(),
-            content_type='application/vnd.apple.mpegurl'
-        )
+
+        if bitrate not in self.playlists:
+            logger.warning(f"Unknown rendition requested: {bitrate}")
+            raise web.HTTPNotFound()
+
+        if self.config.enable_low_latency and '_HLS_part' in request.query and '_HLS_msn' not in request.query:
+            raise web.HTTPBadRequest()
+        if self.config.enable_low_latency and '_HLS_msn' in request.query:
+            # Blocking playlist reload, answered once the requested part exists
+            try:
+                msn = int(request.query['_HLS_msn'])
+                part = int(request.query['_HLS_part']) if '_HLS_part' in request.query else None
+            except ValueError:
+                raise web.HTTPBadRequest()
+            if msn > self.segments.last_id(bitrate) + 2:
+                raise web.HTTPBadRequest()
+            if not await self._wait_for_part(bitrate, msn, part):
+                raise web.HTTPServiceUnavailable()
+
+        return self._playlist_response(request, self.playlists[bitrate])
+
+    async def _handle_part(self, request):
+        """Handle partial segment request, holding hinted parts until they are published"""
+        bitrate = request.match_info['bitrate']
+        segment_id = int(request.match_info['id'])
+        index = int(request.match_info['index'])
+        logger.debug(f"Part requested: {bitrate}/{segment_id}.{index}")
+
+        if bitrate not in self.playlists:
+            raise web.HTTPNotFound()
+        if segment_id <= self.segments.last_id(bitrate) + 1:
+            await self._wait_for_part(bitrate, segment_id, index)
+
+        part = self.segments.get_part(bitrate, segment_id, index)
+        if part is None:
+            logger.warning(f"Part not found: {bitrate}/{segment_id}.{index}")
+            raise web.HTTPNotFound()
+        etag = f"{self.boot_id}-{bitrate}-{segment_id}.{index}-{len(part['data'])}"
+        return self._media_response(request, bitrate, part['data'], etag, self.segment_content_type)
+
+    async def _handle_init(self, request):
+        """Handle fMP4 init segment request"""
+        bitrate = request.match_info['bitrate']
+        init = self.init_segments.get(bitrate)
+        if init is None:
+            logger.warning(f"Init segment not found: {bitrate}")
+            raise web.HTTPNotFound()
+        return self._media_response(request, bitrate, init, self.init_etags[bitrate], 'video/mp4')
 
     async def _handle_segment(self, request):
         """Handle segment request"""
+        bitrate = request.match_info['bitrate']
         segment_id = request.match_info['id']
-        logger.debug(f"Segment requested: {segment_id}")
-        
-        segment_path = Path(self.config.output_path) / f'segment_{segment_id}.ts'
+        logger.debug(f"Segment requested: {bitrate}/{segment_id}")
 
-        if not segment_path.exists():
-            logger.warning(f"Segment not found: {segment_path}")
+        # Only published segments are indexed, unknown, expired and unfinished ones never touch the disk
+        segment = self.segments.get(bitrate, int(segment_id))
+        if segment is None:
+            logger.warning(f"Segment not found: {bitrate}/{segment_id}")
             raise web.HTTPNotFound()
+        if segment.get('data') is not None:
+            # Served straight from the memoryview of the muxer buffer. The bytes behind an id
+            # never change, so the id makes a strong ETag without hashing them
+            etag = f"{self.boot_id}-{bitrate}-{segment_id}-{len(segment['data'])}"
+            return self._media_response(request, bitrate, segment['data'], etag, self.segment_content_type)
+
+        # Segments published with only a path are measured once, off the event loop, a missing file is a 404
+        if segment.get('size') is None:
+            try:
+                segment['size'] = (await asyncio.to_thread(os.stat, segment['path'])).st_size
+            except FileNotFoundError:
+                logger.warning(f"Segment file missing: {segment['path']}")
+                raise web.HTTPNotFound()
+
+        logger.debug(f"Serving segment: {segment['path']}")
+        # Sent with sendfile, FileResponse also answers range and conditional requests. Its
+        # bytes are counted once it knows the status, revalidations send none
+        return web.FileResponse(segment['path'], headers={'Content-Type': self.segment_content_type})
+
 
-        logger.debug(f"Serving segment: {segment_path}")
-        return web.FileResponse(segment_path)
+async def handle_metrics(request):
+    """Serve the Prometheus metrics"""
+    body = await asyncio.to_thread(render_metrics)
+    return web.Response(body=body, headers={'Content-Type': METRICS_CONTENT_TYPE})
@@ -0,0 +1,174 @@
+import hashlib
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import m3u8
+from ..config import StreamConfig, Rendition, AudioRendition
+
+PLAYLIST_CONTENT_TYPE = 'application/vnd.apple.mpegurl'
+
+
+def content_etag(data) -> str:
+    """Get a strong ETag derived from the bytes of a response"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@dataclass(frozen=True)
+class RenderedPlaylist:
+    """Serialized playlist with the strong ETag of its bytes"""
+    body: bytes
+    etag: str
+
+    @classmethod
+    def from_text(cls, text: str) -> 'RenderedPlaylist':
+        body = text.encode()
+        return cls(body=body, etag=content_etag(body))
+
+
+def render_master_playlist(renditions: List[Rendition], prefix: str = '',
+                           audio_renditions: Optional[List[AudioRendition]] = None,
+                           audio_channels: int = 2, codecs: Optional[Dict[str, str]] = None) -> RenderedPlaylist:
+    """Render the master playlist with one variant per rendition, URIs below prefix
+
+    With audio renditions every audio bitrate forms its own audio group and
+    every video rendition is listed once per group, so players pick video
+    and audio bandwidth together and switch video without reloading audio.
+    CODECS lists the codecs of a variant by rendition name, as the segments
+    report them, and is left out until all of them are known.
+    """
+    codecs = codecs or {}
+    playlist = m3u8.M3U8()
+    playlist.is_endlist = False
+    playlist.is_live = True
+
+    audio_renditions = audio_renditions or []
+    for audio_rendition in audio_renditions:
+        playlist.add_media(m3u8.Media(
+            uri=f'{prefix}/stream_{audio_rendition.name}.m3u8',
+            type='AUDIO',
+            group_id=audio_rendition.name,
+            name=f'{audio_rendition.bitrate // 1000} kbps',
+            default='YES',
+            autoselect='YES',
+            channels=str(audio_channels)
+        ))
+
+    # Add different quality variants
+    for audio_rendition in audio_renditions or [None]:
+        for rendition in renditions:
+            stream_info = {
+                'bandwidth': rendition.bitrate,
+                'resolution': f"{rendition.width}x{rendition.height}"
+            }
+            variant_codecs = [codecs.get(rendition.name)]
+            if audio_rendition is not None:
+                stream_info['bandwidth'] += audio_rendition.bitrate
+                stream_info['audio'] = audio_rendition.name
+                variant_codecs.append(codecs.get(audio_rendition.name))
+            if None not in variant_codecs:
+                stream_info['codecs'] = ','.join(variant_codecs)
+            playlist.add_playlist(m3u8.Playlist(
+                uri=f'{prefix}/stream_{rendition.name}.m3u8',
+                stream_info=stream_info,
+                # The AUDIO attribute is only written for a group among these
+                media=playlist.media,
+                base_uri=None
+            ))
+
+    return RenderedPlaylist.from_text(playlist.dumps())
+
+
+def segment_uri(rendition: str, segment_id: int, extension: str = 'ts', prefix: str = '') -> str:
+    return f'{prefix}/segment_{rendition}_{segment_id}.{extension}'
+
+
+def part_uri(rendition: str, segment_id: int, index: int, extension: str = 'ts', prefix: str = '') -> str:
+    return f'{prefix}/part_{rendition}_{segment_id}_{index}.{extension}'
+
+
+def init_uri(rendition: str, prefix: str = '') -> str:
+    return f'{prefix}/init_{rendition}.mp4'
+
+
+def _partial_segments(rendition: str, parts: List[dict], extension: str, prefix: str) -> List[dict]:
+    return [{
+        'uri': part_uri(rendition, part['segment_id'], part['index'], extension, prefix),
+        # Media time arithmetic leaves float noise that would end up in the tag
+        'duration': round(part['duration'], 6),
+        'independent': 'YES' if part['independent'] else None
+    } for part in parts]
+
+
+def render_media_playlist(config: StreamConfig, rendition: str, segments: List[dict],
+                          pending_parts: Optional[List[dict]] = None,
+                          rendition_reports: Optional[List[Tuple[str, int, Optional[int]]]] = None,
+                          prefix: str = '') -> RenderedPlaylist:
+    """Render the live media playlist of a rendition from its newest segments, URIs below prefix
+
+    With low latency enabled the playlist also lists the partial segments of
+    its last segments and of the segment being encoded, hints the next part
+    and reports (rendition, last_msn, last_part) for the other renditions.
+    """
+    pending_parts = pending_parts or []
+    extension = config.get_segment_extension()
+    playlist = m3u8.M3U8()
+    # Segment ids increase by one, so the first listed id is the media sequence
+    if segments:
+        playlist.media_sequence = segments[0]['id']
+        # Counts the discontinuities that left the playlist, the first segment's own tag is still listed
+        playlist.discontinuity_sequence = segments[0].get('discontinuity_sequence', 0)
+    elif pending_parts:
+        playlist.media_sequence = pending_parts[0]['segment_id']
+    # Durations come from media time and may overshoot the nominal duration slightly
+    playlist.target_duration = max(
+        [config.segment_duration] + [math.ceil(s["duration"]) for s in segments]
+    )
+    playlist.is_endlist = False
+    playlist.is_live = True
+
+    # Parts are only listed for the segments within three target durations of the live edge
+    part_window_start = len(segments)
+    if config.enable_low_latency:
+        remaining = 3 * playlist.target_duration - sum(p['duration'] for p in pending_parts)
+        while part_window_start > 0 and remaining > 0:
+            part_window_start -= 1
+            remaining -= segments[part_window_start]['duration']
+
+    # Add segments
+    for position, segment in enumerate(segments):
+        parts = segment.get('parts', []) if position >= part_window_start else []
+        playlist.add_segment(m3u8.Segment(
+            uri=segment_uri(rendition, segment["id"], extension, prefix),
+            duration=segment["duration"],
+            parts=_partial_segments(rendition, parts, extension, prefix),
+            discontinuity=segment.get('discontinuity', False)
+        ))
+
+    if config.enable_low_latency:
+        playlist.server_control = m3u8.ServerControl(
+            can_block_reload='YES',
+            part_hold_back=config.get_part_hold_back()
+        )
+        playlist.part_inf = m3u8.PartInformation(part_target=config.part_duration)
+        if pending_parts:
+            # The parts of the segment being encoded come without a segment URI
+            playlist.add_segment(m3u8.Segment(
+                parts=_partial_segments(rendition, pending_parts, extension, prefix),
+                discontinuity=pending_parts[0].get('discontinuity', False)
+            ))
+            next_part = (pending_parts[-1]['segment_id'], len(pending_parts))
+        else:
+            next_part = ((segments[-1]['id'] if segments else 0) + 1, 0)
+        playlist.preload_hint = m3u8.PreloadHint('PART', None, part_uri(rendition, *next_part, extension, prefix))
+        playlist.rendition_reports = m3u8.RenditionReportList(
+            m3u8.RenditionReport(None, f'{prefix}/stream_{name}.m3u8', last_msn, last_part)
+            for name, last_msn, last_part in rendition_reports or []
+        )
+
+    if config.segment_format == 'fmp4':
+        # EXT-X-MAP applies to every following segment, so the first one carries it
+        playlist.version = 7
+        if playlist.segments:
+            playlist.segments[0].init_section = m3u8.model.InitializationSection(None, init_uri(rendition, prefix))
+
+    return RenderedPlaylist.from_text(playlist.dumps())
@@ -1,115 +1,842 @@
 import asyncio
+import base64
 import logging
-from typing import List
+import math
+import random
+import secrets
+import struct
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import urlsplit
 from ..config import StreamConfig
+from ..monitoring.metrics import RTSP_CLIENTS, RTSP_DROPPED_PACKETS
 
 logger = logging.getLogger(__name__)
 
+# RTP payload bytes per packet, below a 1500 byte MTU with the IP, UDP and RTP headers
+RTP_PAYLOAD_SIZE = 1400
+VIDEO_PAYLOAD_TYPE = 96
+AUDIO_PAYLOAD_TYPE = 97
+VIDEO_CLOCK_RATE = 90000
+# Seconds between the RTCP sender reports that let clients sync audio with video
+RTCP_INTERVAL = 5.0
+# Seconds DESCRIBE waits for the parameter sets of the first keyframe
+DESCRIBE_TIMEOUT = 10.0
+# Seconds from 1900, where NTP time starts, to 1970
+NTP_EPOCH_OFFSET = 2208988800
+# Sampling frequencies of an AAC AudioSpecificConfig, by index
+AAC_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+
+# Largest request head and body accepted, clients send a few hundred bytes
+MAX_HEAD_SIZE = 8192
+MAX_BODY_SIZE = 65536
+# Connections the kernel queues while the event loop is busy, for bursts of reconnecting cameras
+LISTEN_BACKLOG = 1024
+# Seconds between checks for sessions and connections past the session timeout
+SWEEP_INTERVAL = 1.0
+SUPPORTED_METHODS = 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER'
+
+# H.264 NAL unit types
+H264_SPS = 7
+H264_PPS = 8
+H264_AUD = 9
+H264_FU_A = 28
+
+
+def split_nal_units(data: bytes, length_size: int = 0) -> List[bytes]:
+    """Split an H.264 access unit into NAL units, Annex B or with length_size byte length prefixes"""
+    units = []
+    if length_size:
+        offset = 0
+        while offset + length_size <= len(data):
+            size = int.from_bytes(data[offset:offset + length_size], 'big')
+            offset += length_size
+            units.append(data[offset:offset + size])
+            offset += size
+        return units
+
+    start = data.find(b'\x00\x00\x01')
+    while start >= 0:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        # Zeros before a start code belong to it, NAL units never end with one
+        units.append(data[start:end if end >= 0 else len(data)].rstrip(b'\x00'))
+        start = end
+    return units
+
+
+def parse_avc_config(extradata: bytes) -> Tuple[int, List[bytes]]:
+    """Get the NAL unit length size and the parameter sets of an avcC record"""
+    length_size = (extradata[4] & 3) + 1
+    units = []
+    offset = 5
+    # SPS count in the low 5 bits, then the PPS count in a full byte
+    for count_mask in (0x1F, 0xFF):
+        count = extradata[offset] & count_mask
+        offset += 1
+        for _ in range(count):
+            size = int.from_bytes(extradata[offset:offset + 2], 'big')
+            units.append(extradata[offset + 2:offset + 2 + size])
+            offset += 2 + size
+    return length_size, units
+
+
+class RTPPacketizer:
+    """Turns the encoded packets of one track into RTP packets
+
+    SSRC, sequence numbers and timestamps start at random values. Timestamps
+    follow the media time of the packets, and the packets are built once
+    and sent as they are to every client.
+    """
+
+    payload_type = 0
+
+    def __init__(self, clock_rate: int):
+        self.clock_rate = clock_rate
+        self.ssrc = random.getrandbits(32)
+        self.sequence = random.getrandbits(16)
+        self.timestamp_base = random.getrandbits(32)
+        # Timestamp and media time of the latest packet, for sender reports
+        self.timestamp = self.timestamp_base
+        self.media_time = 0.0
+        self.packet_count = 0
+        self.octet_count = 0
+
+    @property
+    def ready(self) -> bool:
+        """Whether the track can be described in SDP"""
+        return True
+
+    def packetize(self, data: bytes, media_time: float, keyframe: bool = False) -> List[bytes]:
+        """Get the RTP packets of an encoded packet"""
+        self.media_time = media_time
+        self.timestamp = (self.timestamp_base + round(media_time * self.clock_rate)) & 0xFFFFFFFF
+        return self._packets(data, keyframe)
+
+    def _packets(self, data: bytes, keyframe: bool) -> List[bytes]:
+        raise NotImplementedError
+
+    def _packet(self, payload: bytes, marker: bool) -> bytes:
+        header = struct.pack('!BBHII', 0x80, marker << 7 | self.payload_type, self.sequence,
+                             self.timestamp, self.ssrc)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.packet_count += 1
+        self.octet_count += len(payload)
+        return header + payload
+
+    def sender_report(self, ntp_time: float) -> bytes:
+        """RTCP sender report tying the timestamp of the latest packet to ntp_time"""
+        seconds = int(ntp_time)
+        fraction = int((ntp_time - seconds) * (1 << 32))
+        return struct.pack('!BBHIIIIII', 0x80, 200, 6, self.ssrc, seconds & 0xFFFFFFFF, fraction,
+                           self.timestamp, self.packet_count & 0xFFFFFFFF, self.octet_count & 0xFFFFFFFF)
+
+    def media_description(self, control: str) -> List[str]:
+        """SDP lines of the track"""
+        raise NotImplementedError
+
+
+class H264Packetizer(RTPPacketizer):
+    """H.264 over RTP (RFC 6184), as single NAL unit packets and FU-A fragments
+
+    SPS and PPS are taken from the extradata or the latest keyframe and put
+    in front of keyframes that lack them, so clients can start at any
+    keyframe.
+    """
+
+    payload_type = VIDEO_PAYLOAD_TYPE
+
+    def __init__(self, extradata: Optional[bytes] = None):
+        super().__init__(VIDEO_CLOCK_RATE)
+        # Encoders output Annex B, packets demuxed from MP4 are length prefixed
+        self.length_size = 0
+        self.sps: Optional[bytes] = None
+        self.pps: Optional[bytes] = None
+        if extradata:
+            if extradata[0] == 1:
+                self.length_size, units = parse_avc_config(extradata)
+            else:
+                units = split_nal_units(extradata)
+            self._keep_parameter_sets(units)
+
+    @property
+    def ready(self) -> bool:
+        return self.sps is not None and self.pps is not None
+
+    def _keep_parameter_sets(self, units: List[bytes]):
+        for unit in units:
+            if unit[0] & 0x1F == H264_SPS:
+                self.sps = unit
+            elif unit[0] & 0x1F == H264_PPS:
+                self.pps = unit
+
+    def _packets(self, data: bytes, keyframe: bool) -> List[bytes]:
+        units = [unit for unit in split_nal_units(data, self.length_size) if unit and unit[0] & 0x1F != H264_AUD]
+        self._keep_parameter_sets(units)
+        if keyframe and self.ready and not any(unit[0] & 0x1F == H264_SPS for unit in units):
+            units = [self.sps, self.pps] + units
+
+        packets = []
+        for index, unit in enumerate(units):
+            last = index == len(units) - 1
+            if len(unit) <= RTP_PAYLOAD_SIZE:
+                packets.append(self._packet(unit, last))
+                continue
+            # FU-A fragments carry the NAL header split over an indicator and a header byte
+            indicator = bytes([unit[0] & 0xE0 | H264_FU_A])
+            nal_type = unit[0] & 0x1F
+            body = memoryview(unit)[1:]
+            size = RTP_PAYLOAD_SIZE - 2
+            for offset in range(0, len(body), size):
+                end = offset + size >= len(body)
+                header = nal_type | (0x80 if offset == 0 else 0) | (0x40 if end else 0)
+                packets.append(self._packet(indicator + bytes([header]) + body[offset:offset + size],
+                                            last and end))
+        return packets
+
+    def media_description(self, control: str) -> List[str]:
+        parameter_sets = ','.join(base64.b64encode(unit).decode() for unit in (self.sps, self.pps))
+        return [
+            f'm=video 0 RTP/AVP {self.payload_type}',
+            f'a=rtpmap:{self.payload_type} H264/{self.clock_rate}',
+            f'a=fmtp:{self.payload_type} packetization-mode=1;profile-level-id={self.sps[1:4].hex().upper()};'
+            f'sprop-parameter-sets={parameter_sets}',
+            f'a=control:{control}'
+        ]
+
+
+class AACPacketizer(RTPPacketizer):
+    """AAC over RTP (RFC 3640 AAC-hbr mode), one access unit per packet"""
+
+    payload_type = AUDIO_PAYLOAD_TYPE
+
+    def __init__(self, sample_rate: int, channels: int, extradata: Optional[bytes] = None):
+        super().__init__(sample_rate)
+        self.channels = channels
+        self.config = extradata
+        if not self.config:
+            if sample_rate not in AAC_SAMPLE_RATES:
+                raise ValueError(f"Unsupported AAC sample rate: {sample_rate}")
+            # AAC LC AudioSpecificConfig: object type, sampling frequency index and channels
+            self.config = (2 << 11 | AAC_SAMPLE_RATES.index(sample_rate) << 7 | channels << 3).to_bytes(2, 'big')
+
+    def _packets(self, data: bytes, keyframe: bool) -> List[bytes]:
+        # Audio demuxed from MPEG-TS comes with ADTS headers, RTP carries raw access units
+        if len(data) > 7 and data[0] == 0xFF and data[1] & 0xF0 == 0xF0:
+            data = data[7 if data[1] & 1 else 9:]
+        # 16 bits of AU headers, a single one with a 13 bit size and a 3 bit index
+        return [self._packet(struct.pack('!HH', 16, len(data) << 3) + data, True)]
+
+    def media_description(self, control: str) -> List[str]:
+        return [
+            f'm=audio 0 RTP/AVP {self.payload_type}',
+            f'a=rtpmap:{self.payload_type} MPEG4-GENERIC/{self.clock_rate}/{self.channels}',
+            f'a=fmtp:{self.payload_type} streamtype=5;profile-level-id=1;mode=AAC-hbr;sizelength=13;'
+            f'indexlength=3;indexdeltalength=3;config={self.config.hex()}',
+            f'a=control:{control}'
+        ]
+
+
+class RTSPRequest:
+    """A parsed RTSP request, header names in lowercase"""
+
+    __slots__ = ('method', 'url', 'headers', 'body')
+
+    def __init__(self, method: str, url: str, headers: Dict[str, str], body: bytes = b''):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.body = body
+
+
+class RTSPError(Exception):
+    """A request that cannot be parsed, answered with status before the connection is closed"""
+
+    def __init__(self, status: str, cseq: str = '0'):
+        super().__init__(status)
+        self.status = status
+        self.cseq = cseq
+
+
+class RTSPParser:
+    """Incremental RTSP/1.0 request parser over a reusable buffer
+
+    Bytes are appended as they arrive and feed() returns every request they
+    complete, so requests split across reads and pipelined requests are
+    both handled. Interleaved binary frames between requests, the RTCP
+    reports of clients over TCP, are skipped and counted. The consumed part
+    of the buffer is dropped once per feed, not once per request.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Bytes of an incomplete head already searched for its end
+        self.scanned = 0
+        # Request whose body is still incomplete
+        self.pending: Optional[RTSPRequest] = None
+        self.body_length = 0
+        self.frames = 0
+
+    def feed(self, data: bytes) -> List[RTSPRequest]:
+        """Add received bytes, the requests they complete (raises RTSPError)"""
+        buffer = self.buffer
+        buffer += data
+        requests = []
+        position = 0
+        try:
+            while position < len(buffer):
+                if self.pending is not None:
+                    end = position + self.body_length
+                    if end > len(buffer):
+                        break
+                    self.pending.body = bytes(buffer[position:end])
+                    requests.append(self.pending)
+                    self.pending = None
+                    position = end
+                    continue
+
+                first = buffer[position]
+                if first == 0x24:
+                    if len(buffer) - position < 4:
+                        break
+                    end = position + 4 + int.from_bytes(buffer[position + 2:position + 4], 'big')
+                    if end > len(buffer):
+                        break
+                    self.frames += 1
+                    position = end
+                    continue
+                if first in b'\r\n':
+                    # Empty lines between requests
+                    position += 1
+                    continue
+
+                end = buffer.find(b'\r\n\r\n', position + self.scanned)
+                if end < 0:
+                    if len(buffer) - position > MAX_HEAD_SIZE:
+                        raise RTSPError('400 Bad Request')
+                    # The end of the head may start in the last three bytes
+                    self.scanned = max(0, len(buffer) - position - 3)
+                    break
+                self.scanned = 0
+                request = self._parse_head(bytes(buffer[position:end]))
+                position = end + 4
+                length = request.headers.get('content-length', '0')
+                if not length.isdigit() or int(length) > MAX_BODY_SIZE:
+                    raise RTSPError('400 Bad Request', request.headers.get('cseq', '0'))
+                if int(length):
+                    self.pending = request
+                    self.body_length = int(length)
+                    continue
+                requests.append(request)
+        finally:
+            del buffer[:position]
+        return requests
+
+    @staticmethod
+    def _parse_head(head: bytes) -> RTSPRequest:
+        lines = head.decode('latin-1').split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if not separator:
+                raise RTSPError('400 Bad Request')
+            headers[name.strip().lower()] = value.strip()
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            raise RTSPError('400 Bad Request', headers.get('cseq', '0'))
+        method, url, version = parts
+        if version != 'RTSP/1.0':
+            raise RTSPError('505 RTSP Version Not Supported', headers.get('cseq', '0'))
+        return RTSPRequest(method, url, headers)
+
+
+class RTSPSession:
+    """A client session: the tracks it set up and where their packets go"""
+
+    def __init__(self, session_id: str, connection: 'RTSPConnection'):
+        self.id = session_id
+        # Interleaved packets go out over the connection that set the session up
+        self.connection = connection
+        self.host = connection.host
+        # Track index to ('tcp', RTP channel) or ('udp', RTP port), RTCP goes to the one after
+        self.transports: Dict[int, Tuple[str, int]] = {}
+        self.playing = False
+        # Tracks held back until they can start: video at the next keyframe, audio
+        # right away unless the session's video is still waiting, so both start together
+        self.waiting: Set[int] = set()
+        self.started = False
+        self.last_reports: Dict[int, float] = {}
+        self.last_seen = time.monotonic()
+
+
+class RTSPConnection(asyncio.Protocol):
+    """An RTSP control connection
+
+    Requests are answered in the order they came in. The rare answer that
+    has to wait, DESCRIBE before the first keyframe, holds back the
+    requests pipelined behind it.
+    """
+
+    def __init__(self, server: 'RTSPServer'):
+        self.server = server
+        self.transport: Optional[asyncio.Transport] = None
+        self.parser = RTSPParser()
+        self.host: Optional[str] = None
+        self.local_host = '0.0.0.0'
+        self.sessions: Dict[str, RTSPSession] = {}
+        self.backlog = deque()
+        self.answering: Optional[asyncio.Future] = None
+        self.last_seen = time.monotonic()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        peer = transport.get_extra_info('peername')
+        self.host = peer[0] if peer else None
+        local = transport.get_extra_info('sockname')
+        if local:
+            self.local_host = local[0]
+        self.server._connection_made(self)
+
+    def data_received(self, data: bytes):
+        frames = self.parser.frames
+        try:
+            requests = self.parser.feed(data)
+        except RTSPError as e:
+            logger.warning(f"Closing RTSP connection from {self.host}: {e.status}")
+            self.transport.write(_response(e.status, e.cseq))
+            self.transport.close()
+            return
+        # Interleaved RTCP reports keep the sessions of the connection alive
+        self.server._touch(self, self.sessions.values() if self.parser.frames != frames else ())
+        self.backlog.extend(requests)
+        self._answer()
+
+    def _answer(self):
+        while self.backlog and self.answering is None and not self.transport.is_closing():
+            response = self.server._process_rtsp_request(self.backlog.popleft(), self)
+            if isinstance(response, bytes):
+                self.transport.write(response)
+                continue
+            self.answering = asyncio.ensure_future(response)
+            self.answering.add_done_callback(self._answered)
+
+    def _answered(self, answer: asyncio.Future):
+        self.answering = None
+        if answer.cancelled():
+            return
+        if answer.exception() is not None:
+            logger.error(f"Error handling RTSP request: {answer.exception()}")
+            self.transport.close()
+            return
+        if not self.transport.is_closing():
+            self.transport.write(answer.result())
+            self._answer()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self.answering is not None:
+            self.answering.cancel()
+        self.server._connection_lost(self)
+
+
+class RTCPReceiver(asyncio.DatagramProtocol):
+    """The UDP socket RTCP goes out from, receiver reports coming in keep their sessions alive"""
+
+    def __init__(self, server: 'RTSPServer'):
+        self.server = server
+
+    def datagram_received(self, data: bytes, addr):
+        # RTP version 2 and a compound packet starting with a sender or receiver report
+        if len(data) >= 8 and data[0] >> 6 == 2 and data[1] in (200, 201):
+            self.server._rtcp_received(addr[:2])
+
+
+def _response(status: str, cseq: str, headers: Optional[Dict[str, str]] = None, body: bytes = b'') -> bytes:
+    lines = [f'RTSP/1.0 {status}', f'CSeq: {cseq}']
+    lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+    if body:
+        lines.append(f'Content-Length: {len(body)}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+def _track_index(url: str) -> Optional[int]:
+    """Get the track a SETUP URL points at, from its trackID=<index> control path"""
+    name = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+    if not name.startswith('trackID='):
+        return None
+    try:
+        return int(name[len('trackID='):])
+    except ValueError:
+        return None
+
+
+def _range_start(value: str, lowest: int, highest: int) -> Optional[int]:
+    """Get the first number of a transport range such as 5000-5001, None when malformed or out of bounds"""
+    try:
+        number = int(value.split('-')[0])
+    except ValueError:
+        return None
+    return number if lowest <= number <= highest else None
+
+
 class RTSPServer:
-    """RTSP Server Implementation"""
+    """Restreams the top rendition over RTSP
+
+    The converter hands over the encoded packets of one rendition, which
+    are packetized into RTP once and fanned out to every playing session,
+    interleaved on its RTSP connection or over UDP. Sessions start at a
+    keyframe. A TCP client whose send buffer holds more than
+    rtsp_client_buffer bytes skips ahead to the next keyframe instead of
+    holding up the converter.
+
+    Sessions and connections are kept in order of their last activity, so
+    finding the ones past rtsp_session_timeout only looks at those that
+    actually are. Requests carrying the session, RTCP reports over TCP or
+    from the RTCP port of a UDP client and GET_PARAMETER keepalives count
+    as activity.
+    """
 
     def __init__(self, config: StreamConfig):
         self.config = config
-        self.clients = {}
-        self.session_counter = 0
+        # Least recently active first
+        self.sessions: 'OrderedDict[str, RTSPSession]' = OrderedDict()
+        self.connections: 'OrderedDict[RTSPConnection, None]' = OrderedDict()
+        # Sessions packets are sent to
+        self.playing: Dict[str, RTSPSession] = {}
+        # (host, RTCP port) of UDP clients to the session their reports keep alive
+        self.rtcp_peers: Dict[Tuple[str, int], RTSPSession] = {}
+        self.server = None
+        self.port = config.rtsp_server_port
+        self.rtp = None
+        self.rtcp = None
+        self._sweeper: Optional[asyncio.Task] = None
+        # Packetizers of the restreamed tracks in SDP order, and their index by media type
+        self.tracks: List[RTPPacketizer] = []
+        self.track_index: Dict[str, int] = {}
+        # Set once the tracks can be described
+        self.ready = asyncio.Event()
+        self.session_version = int(time.time())
+        # Wall clock time of media time 0, shared by the sender reports of all tracks
+        self.media_epoch: Optional[float] = None
+        self.clients_gauge = RTSP_CLIENTS.labels(config.stream_name)
+        self.dropped_packets = RTSP_DROPPED_PACKETS.labels(config.stream_name)
 
     async def start(self):
         """Start RTSP server"""
-        server = await asyncio.start_server(
-            self._handle_client,
-            'localhost',
-            8554
-        )
-
-        logger.info("RTSP Server started on port 8554")
-        await server.serve_forever()
-
-    async def _handle_client(self, reader, writer):
-        """Handle RTSP client connection"""
-        session_id = self._generate_session_id()
-        self.clients[session_id] = {
-            'reader': reader,
-            'writer': writer,
-            'state': 'INIT'
-        }
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: RTSPConnection(self), '0.0.0.0',
+                                               self.config.rtsp_server_port, backlog=LISTEN_BACKLOG)
+        self.port = self.server.sockets[0].getsockname()[1]
+        rtp_port = self.config.rtsp_rtp_port
+        self.rtp, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                          local_addr=('0.0.0.0', rtp_port))
+        self.rtcp, _ = await loop.create_datagram_endpoint(lambda: RTCPReceiver(self),
+                                                           local_addr=('0.0.0.0', rtp_port + 1 if rtp_port else 0))
+        self._sweeper = asyncio.create_task(self._evict_idle())
+        logger.info(f"RTSP Server started on port {self.port}, "
+                    f"RTP over UDP from ports {self._udp_port(self.rtp)}-{self._udp_port(self.rtcp)}")
 
-        try:
-            while True:
-                data = await reader.read(1024)
-                if not data:
+    async def stop(self):
+        """Stop RTSP server"""
+        if self._sweeper:
+            self._sweeper.cancel()
+            self._sweeper = None
+        if self.server:
+            self.server.close()
+            for connection in list(self.connections):
+                connection.transport.close()
+            await self.server.wait_closed()
+            self.server = None
+        for transport in (self.rtp, self.rtcp):
+            if transport:
+                transport.close()
+        self.rtp = self.rtcp = None
+        # Lets the closed connections report their loss
+        await asyncio.sleep(0)
+        logger.info("RTSP Server stopped")
+
+    @staticmethod
+    def _udp_port(transport) -> int:
+        return transport.get_extra_info('sockname')[1]
+
+    def set_source(self, video_stream, audio_stream=None):
+        """Restream the packets of these encoder or input streams (runs on the event loop)"""
+        self.tracks = []
+        self.track_index = {}
+        self.ready.clear()
+        codec = video_stream.codec_context.codec.canonical_name
+        if codec != 'h264':
+            logger.warning(f"RTSP restreaming supports H.264 video only, not {codec}")
+            return
+        self.tracks.append(H264Packetizer(video_stream.codec_context.extradata))
+        self.track_index['video'] = 0
+
+        if audio_stream is not None:
+            codec = audio_stream.codec_context.codec.canonical_name
+            try:
+                if codec != 'aac':
+                    raise ValueError(f"Unsupported audio codec: {codec}")
+                self.tracks.append(AACPacketizer(audio_stream.rate, audio_stream.layout.nb_channels,
+                                                 audio_stream.codec_context.extradata))
+                self.track_index['audio'] = 1
+            except ValueError as e:
+                logger.warning(f"RTSP restreaming video without audio: {e}")
+        if self.tracks[0].ready:
+            self.ready.set()
+        logger.info(f"RTSP restreaming tracks: {list(self.track_index)}")
+
+    def send(self, kind: str, data: bytes, media_time: float, keyframe: bool):
+        """Packetize an encoded packet once and send it to every playing session (runs on the event loop)"""
+        index = self.track_index.get(kind)
+        if index is None:
+            return
+        packetizer = self.tracks[index]
+        keyframe = keyframe and kind == 'video'
+        if self.media_epoch is None:
+            self.media_epoch = time.time() - media_time
+        packets = packetizer.packetize(data, media_time, keyframe)
+        if not self.ready.is_set() and self.tracks[0].ready:
+            self.ready.set()
+
+        now = time.monotonic()
+        # Interleaved packets by channel, framed once for all sessions on that channel
+        framed: Dict[int, bytes] = {}
+        for session in self.playing.values():
+            transport = session.transports.get(index)
+            if transport is None:
+                continue
+            if index in session.waiting:
+                if not (keyframe if kind == 'video' else self.track_index['video'] not in session.waiting):
+                    if session.started:
+                        self.dropped_packets.inc(len(packets))
+                    continue
+                session.waiting.discard(index)
+                session.started = True
+            if now - session.last_reports.get(index, 0.0) >= RTCP_INTERVAL:
+                session.last_reports[index] = now
+                report = packetizer.sender_report(NTP_EPOCH_OFFSET + self.media_epoch + media_time)
+                self._send_to(session, transport, [report], rtcp=True)
+            self._send_to(session, transport, packets, framed=framed)
+
+    def _send_to(self, session: RTSPSession, transport: Tuple[str, int], packets: List[bytes],
+                 rtcp: bool = False, framed: Optional[Dict[int, bytes]] = None):
+        """Send RTP or RTCP packets over the transport a session set up for a track"""
+        protocol, port = transport
+        port += rtcp
+        if protocol == 'udp':
+            socket = self.rtcp if rtcp else self.rtp
+            for packet in packets:
+                socket.sendto(packet, (session.host, port))
+            return
+
+        stream = session.connection.transport
+        if stream.is_closing():
+            return
+        if stream.get_write_buffer_size() > self.config.rtsp_client_buffer:
+            # Never wait for a slow reader, it continues from the next keyframe
+            logger.warning(f"RTSP session {session.id} is not keeping up, skipping to the next keyframe")
+            session.waiting = set(session.transports)
+            self.dropped_packets.inc(len(packets))
+            return
+        data = framed.get(port) if framed is not None else None
+        if data is None:
+            data = b''.join(struct.pack('!BBH', 0x24, port, len(packet)) + packet for packet in packets)
+            if framed is not None:
+                framed[port] = data
+        stream.write(data)
+
+    def _connection_made(self, connection: RTSPConnection):
+        self.connections[connection] = None
+
+    def _connection_lost(self, connection: RTSPConnection):
+        self.connections.pop(connection, None)
+        # Sessions over UDP may outlive their control connection until they time out
+        for session in list(connection.sessions.values()):
+            if any(protocol == 'tcp' for protocol, _ in session.transports.values()):
+                self._close_session(session)
+
+    def _touch(self, connection: RTSPConnection, sessions=()):
+        """Note activity on a connection and sessions, moving them to the end of the timeout order"""
+        now = time.monotonic()
+        connection.last_seen = now
+        if connection in self.connections:
+            self.connections.move_to_end(connection)
+        for session in sessions:
+            session.last_seen = now
+            self.sessions.move_to_end(session.id)
+
+    def _rtcp_received(self, peer: Tuple[str, int]):
+        session = self.rtcp_peers.get(peer)
+        if session is not None:
+            self._touch(session.connection, (session,))
+
+    def _forget_rtcp_peer(self, session: RTSPSession, transport: Optional[Tuple[str, int]]):
+        if transport is not None and transport[0] == 'udp':
+            peer = (session.host, transport[1] + 1)
+            if self.rtcp_peers.get(peer) is session:
+                del self.rtcp_peers[peer]
+
+    def _close_session(self, session: RTSPSession):
+        for transport in session.transports.values():
+            self._forget_rtcp_peer(session, transport)
+        self.sessions.pop(session.id, None)
+        session.connection.sessions.pop(session.id, None)
+        if self.playing.pop(session.id, None) is not None:
+            self.clients_gauge.dec()
+            logger.info(f"RTSP session {session.id} stopped playing")
+
+    async def _evict_idle(self):
+        """Close sessions and connections silent for longer than the session timeout"""
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            deadline = time.monotonic() - self.config.rtsp_session_timeout
+            while self.sessions:
+                session = next(iter(self.sessions.values()))
+                if session.last_seen > deadline:
+                    break
+                logger.info(f"RTSP session {session.id} timed out")
+                self._close_session(session)
+            while self.connections:
+                connection = next(iter(self.connections))
+                if connection.last_seen > deadline:
                     break
+                self.connections.pop(connection)
+                connection.transport.close()
 
-                response = await self._process_rtsp_request(data, session_id)
-                writer.write(response)
-                await writer.drain()
+    def _process_rtsp_request(self, request: RTSPRequest,
+                              connection: RTSPConnection) -> Union[bytes, Awaitable[bytes]]:
+        """Process RTSP request and generate response, or a coroutine generating it"""
+        cseq = request.headers.get('cseq', '0')
+        session = None
+        session_id = request.headers.get('session', '').split(';')[0].strip()
+        if session_id:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return _response('454 Session Not Found', cseq)
+            if session.connection is not connection and session.connection.transport.is_closing():
+                # A UDP session controlled from a new connection after the old one closed
+                session.connection.sessions.pop(session.id, None)
+                session.connection = connection
+                connection.sessions[session.id] = session
+            self._touch(connection, (session,))
+        elif len(connection.sessions) == 1 and request.method != 'SETUP':
+            # Lenient with clients leaving out the header on the connection of their session
+            session = next(iter(connection.sessions.values()))
+            self._touch(connection, (session,))
 
-        except Exception as e:
-            logger.error(f"Error handling RTSP client: {e}")
-        finally:
-            del self.clients[session_id]
-            writer.close()
-            await writer.wait_closed()
-
-    def _generate_session_id(self):
-        """Generate unique session ID"""
-        self.session_counter += 1
-        return f"session_{self.session_counter}"
-
-    async def _process_rtsp_request(self, data: bytes, session_id: str) -> bytes:
-        """Process RTSP request and generate response"""
-        request = data.decode().split('\r\n')
-        request_type = request[0].split()[0]
-
-        if request_type == 'OPTIONS':
-            return self._handle_options()
-        elif request_type == 'DESCRIBE':
-            return self._handle_describe(request[0])
-        elif request_type == 'SETUP':
-            return self._handle_setup(request, session_id)
-        elif request_type == 'PLAY':
-            return self._handle_play(session_id)
-
-        return b'RTSP/1.0 400 Bad Request\r\n\r\n'
-
-    def _handle_options(self) -> bytes:
-        """Handle OPTIONS request"""
-        return b'RTSP/1.0 200 OK\r\nPublic: OPTIONS, DESCRIBE, SETUP, PLAY\r\n\r\n'
-
-    def _handle_describe(self, request_line: str) -> bytes:
-        """Handle DESCRIBE request"""
-        # Basic SDP response
-        sdp = (
-            "v=0\r\n"
-            "o=- 0 0 IN IP4 127.0.0.1\r\n"
-            "s=Stream\r\n"
-            "c=IN IP4 127.0.0.1\r\n"
-            "t=0 0\r\n"
-            "m=video 0 RTP/AVP 96\r\n"
-            "a=rtpmap:96 H264/90000\r\n"
-        ).encode()
-
-        response = (
-            b"RTSP/1.0 200 OK\r\n"
-            b"Content-Type: application/sdp\r\n"
-            b"Content-Length: " + str(len(sdp)).encode() + b"\r\n"
-            b"\r\n" + sdp
-        )
-        return response
-
-    def _handle_setup(self, request: List[str], session_id: str) -> bytes:
-        """Handle SETUP request"""
-        return (
-            b"RTSP/1.0 200 OK\r\n"
-            b"Transport: RTP/AVP;unicast;client_port=8000-8001\r\n"
-            b"Session: " + session_id.encode() + b"\r\n"
-            b"\r\n"
-        )
-
-    def _handle_play(self, session_id: str) -> bytes:
-        """Handle PLAY request"""
-        return (
-            b"RTSP/1.0 200 OK\r\n"
-            b"Range: npt=0.000-\r\n"
-            b"Session: " + session_id.encode() + b"\r\n"
-            b"\r\n"
-        )
+        method = request.method
+        if method == 'OPTIONS':
+            return self._handle_options(cseq, session)
+        elif method == 'DESCRIBE':
+            if not self.ready.is_set():
+                return self._describe_when_ready(request.url, cseq, connection)
+            return self._handle_describe(request.url, cseq, connection)
+        elif method == 'SETUP':
+            return self._handle_setup(request, cseq, connection, session)
+        elif method in ('PLAY', 'TEARDOWN', 'GET_PARAMETER') and session is None:
+            return _response('454 Session Not Found', cseq)
+        elif method == 'PLAY':
+            return self._handle_play(cseq, session)
+        elif method == 'TEARDOWN':
+            return self._handle_teardown(cseq, session)
+        elif method == 'GET_PARAMETER':
+            return self._handle_get_parameter(cseq, session)
+
+        return _response('501 Not Implemented', cseq)
+
+    def _session_header(self, session: RTSPSession) -> str:
+        return f'{session.id};timeout={math.ceil(self.config.rtsp_session_timeout)}'
+
+    def _handle_options(self, cseq: str, session: Optional[RTSPSession]) -> bytes:
+        """Handle OPTIONS request, which some clients send as keepalive"""
+        headers = {'Public': SUPPORTED_METHODS}
+        if session is not None:
+            headers['Session'] = self._session_header(session)
+        return _response('200 OK', cseq, headers)
+
+    async def _describe_when_ready(self, url: str, cseq: str, connection: RTSPConnection) -> bytes:
+        try:
+            await asyncio.wait_for(self.ready.wait(), DESCRIBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return _response('503 Service Unavailable', cseq)
+        return self._handle_describe(url, cseq, connection)
+
+    def _handle_describe(self, url: str, cseq: str, connection: RTSPConnection) -> bytes:
+        """Handle DESCRIBE request with the SDP of the restreamed tracks"""
+        lines = [
+            'v=0',
+            f'o=- {self.session_version} 1 IN IP4 {connection.local_host}',
+            f's={self.config.stream_name or "Stream"}',
+            'c=IN IP4 0.0.0.0',
+            't=0 0',
+            'a=control:*',
+            'a=range:npt=now-'
+        ]
+        for index, packetizer in enumerate(self.tracks):
+            lines += packetizer.media_description(f'trackID={index}')
+        sdp = ('\r\n'.join(lines) + '\r\n').encode()
+        return _response('200 OK', cseq, {
+            'Content-Base': url.rstrip('/') + '/',
+            'Content-Type': 'application/sdp'
+        }, sdp)
+
+    def _handle_setup(self, request: RTSPRequest, cseq: str, connection: RTSPConnection,
+                      session: Optional[RTSPSession]) -> bytes:
+        """Handle SETUP request for one track, over interleaved TCP or UDP, starting a session"""
+        index = _track_index(request.url)
+        if index is None or index >= len(self.tracks):
+            return _response('404 Not Found', cseq)
+
+        # The first of the transports the client offers
+        transport = request.headers.get('transport', '').split(',')[0]
+        options = dict(option.partition('=')[::2] for option in transport.split(';'))
+        if transport.startswith('RTP/AVP/TCP'):
+            # RTP and RTCP take two channels of the one byte channel id
+            channel = _range_start(options.get('interleaved', str(index * 2)), 0, 254)
+            if channel is None:
+                return _response('400 Bad Request', cseq)
+            setup = ('tcp', channel)
+            reply = f'RTP/AVP/TCP;unicast;interleaved={channel}-{channel + 1}'
+        elif transport.startswith('RTP/AVP') and 'client_port' in options and connection.host:
+            port = _range_start(options['client_port'], 1, 65534)
+            if port is None:
+                return _response('400 Bad Request', cseq)
+            setup = ('udp', port)
+            reply = (f'RTP/AVP;unicast;client_port={port}-{port + 1};'
+                     f'server_port={self._udp_port(self.rtp)}-{self._udp_port(self.rtcp)};'
+                     f'ssrc={self.tracks[index].ssrc:08X}')
+        else:
+            return _response('461 Unsupported Transport', cseq)
+
+        if session is None:
+            # Unguessable, the session id is all a request needs to control a stream
+            session = RTSPSession(secrets.token_hex(8), connection)
+            self.sessions[session.id] = session
+            connection.sessions[session.id] = session
+        self._forget_rtcp_peer(session, session.transports.get(index))
+        session.transports[index] = setup
+        if setup[0] == 'udp':
+            # Clients send their reports from the port after the RTP one
+            self.rtcp_peers[(session.host, setup[1] + 1)] = session
+        return _response('200 OK', cseq, {'Transport': reply, 'Session': self._session_header(session)})
+
+    def _handle_play(self, cseq: str, session: RTSPSession) -> bytes:
+        """Handle PLAY request, media follows from the next keyframe on"""
+        if not session.transports:
+            return _response('455 Method Not Valid in This State', cseq)
+        if not session.playing:
+            session.playing = True
+            session.waiting = set(session.transports)
+            self.playing[session.id] = session
+            self.clients_gauge.inc()
+            logger.info(f"RTSP session {session.id} playing tracks {sorted(session.transports)}")
+        return _response('200 OK', cseq, {'Range': 'npt=0.000-', 'Session': self._session_header(session)})
+
+    def _handle_teardown(self, cseq: str, session: RTSPSession) -> bytes:
+        """Handle TEARDOWN request, ending the session"""
+        self._close_session(session)
+        return _response('200 OK', cseq)
+
+    def _handle_get_parameter(self, cseq: str, session: RTSPSession) -> bytes:
+        """Handle GET_PARAMETER request, the keepalive of most clients"""
+        return _response('200 OK', cseq, {'Session': self._session_header(session)})
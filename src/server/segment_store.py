@@ -0,0 +1,97 @@
+import logging
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentStore:
+    """Published segments per rendition, optionally bounded to a ring buffer
+
+    Partial segments of the segment being encoded are kept apart until
+    the whole segment is added, which then carries them in its 'parts'.
+    Every added segment is given its 'discontinuity_sequence', the number of
+    discontinuities before it in the rendition.
+    """
+
+    def __init__(self, renditions: Iterable[str], max_segments: Optional[int] = None):
+        self.max_segments = max_segments
+        self._segments: Dict[str, deque] = {name: deque() for name in renditions}
+        self._index: Dict[str, Dict[int, dict]] = {name: {} for name in self._segments}
+        self._pending_parts: Dict[str, List[dict]] = {name: [] for name in self._segments}
+        self._discontinuities: Dict[str, int] = {name: 0 for name in self._segments}
+
+    def __contains__(self, rendition: str) -> bool:
+        return rendition in self._segments
+
+    def __getitem__(self, rendition: str) -> List[dict]:
+        return list(self._segments[rendition])
+
+    def add(self, segment: dict) -> List[dict]:
+        """Add a segment and return the segments evicted to make room for it"""
+        rendition = segment['rendition']
+        segments = self._segments[rendition]
+        index = self._index[rendition]
+        segment['discontinuity_sequence'] = self._discontinuities[rendition]
+        if segment.get('discontinuity'):
+            self._discontinuities[rendition] += 1
+        segments.append(segment)
+        index[segment['id']] = segment
+        self._pending_parts[rendition] = []
+
+        evicted = []
+        while self.max_segments is not None and len(segments) > self.max_segments:
+            old = segments.popleft()
+            del index[old['id']]
+            evicted.append(old)
+        if evicted:
+            logger.debug(f"Evicted {len(evicted)} segments of rendition {rendition}")
+        return evicted
+
+    def add_part(self, part: dict):
+        """Add a partial segment of the segment being encoded"""
+        pending = self._pending_parts[part['rendition']]
+        if pending and pending[0]['segment_id'] != part['segment_id']:
+            # The previous segment was never completed
+            pending.clear()
+        pending.append(part)
+
+    def pending_parts(self, rendition: str) -> List[dict]:
+        """Get the published parts of the segment being encoded"""
+        return list(self._pending_parts[rendition])
+
+    def last_id(self, rendition: str) -> int:
+        """Get the id of the newest complete segment, 0 before the first one"""
+        segments = self._segments[rendition]
+        return segments[-1]['id'] if segments else 0
+
+    def has_part(self, rendition: str, segment_id: int, index: Optional[int] = None) -> bool:
+        """Check whether a segment, or a part of it when index is given, was published"""
+        if segment_id <= self.last_id(rendition):
+            return True
+        pending = self._pending_parts[rendition]
+        return (index is not None and bool(pending)
+                and pending[0]['segment_id'] == segment_id and index < len(pending))
+
+    def get_part(self, rendition: str, segment_id: int, index: int) -> Optional[dict]:
+        """Look up a published partial segment"""
+        pending = self._pending_parts.get(rendition)
+        if pending and pending[0]['segment_id'] == segment_id:
+            parts = pending
+        else:
+            segment = self.get(rendition, segment_id)
+            parts = segment.get('parts', []) if segment else []
+        return parts[index] if 0 <= index < len(parts) else None
+
+    def get(self, rendition: str, segment_id: int) -> Optional[dict]:
+        """Look up a published segment by rendition and id"""
+        index = self._index.get(rendition)
+        if index is None:
+            return None
+        return index.get(segment_id)
+
+    def latest(self, rendition: str, count: int) -> List[dict]:
+        """Get the newest count segments of a rendition, oldest first"""
+        segments = self._segments[rendition]
+        start = max(0, len(segments) - count)
+        return [segments[i] for i in range(start, len(segments))]
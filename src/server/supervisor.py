@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from typing import Callable, Dict, Optional
+from aiohttp import web
+from ..config import StreamConfig
+from ..converter.worker import run_worker
+from ..monitoring.metrics import process_exited
+from .hls_server import HLSServer, handle_metrics
+
+logger = logging.getLogger(__name__)
+
+# Upper bound of the delay between restarts of a crashing worker
+MAX_RESTART_DELAY = 60.0
+# A worker that ran this long before exiting starts over from the base restart delay
+HEALTHY_UPTIME = 60.0
+# Seconds a terminated worker gets to exit before it is killed
+STOP_TIMEOUT = 5.0
+
+
+class StreamWorker:
+    """The worker process of one named stream, as seen by the supervisor"""
+
+    def __init__(self, name: str, config: StreamConfig, server: HLSServer):
+        self.name = name
+        self.config = config
+        self.server = server
+        self.process: Optional[multiprocessing.Process] = None
+        # Latest converter stats reported by the worker, read by the stats endpoint
+        self.stats = {
+            "processed_video_frames": 0,
+            "processed_audio_frames": 0,
+            "dropped_frames": 0,
+            "encoding_errors": 0,
+            "lag": 0.0,
+            "motion": 0.0,
+            "static": False,
+            "start_time": time.time(),
+            "input_reconnects": 0,
+            "input_lost_at": None,
+            "last_recovery_time": None
+        }
+        self.started_at = 0.0
+        self.restarts = 0
+        self.failures = 0
+        self.restart_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class StreamSupervisor:
+    """Runs one converter process per named stream behind a single HTTP front end
+
+    Every stream gets its own HLSServer mounted below /<stream>. Workers
+    publish segments, parts and stats over one queue, which a reader thread
+    hands to the event loop. A worker that exits is restarted with an
+    exponential backoff, the other workers keep running.
+    """
+
+    def __init__(self, config: StreamConfig, worker_target: Callable = run_worker):
+        self.config = config
+        self.worker_target = worker_target
+        # Workers run libav threads, fork would copy a process with running threads
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue()
+        self.app = web.Application()
+        self.workers: Dict[str, StreamWorker] = {}
+        for name, stream_config in config.get_stream_configs().items():
+            server = HLSServer(stream_config, prefix=f'/{name}')
+            worker = StreamWorker(name, stream_config, server)
+            # The stats endpoint reads the stats the worker reports
+            server.converter = worker
+            self.app.add_subapp(f'/{name}', server.app)
+            self.workers[name] = worker
+        self.app.router.add_get('/streams', self._handle_streams)
+        self.app.router.add_get('/metrics', handle_metrics)
+        self.runner = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+        self._stopping = False
+        logger.info(f"Stream supervisor initialized for streams: {list(self.workers)}")
+
+    async def start(self):
+        """Start the worker processes and the HTTP front end"""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = False
+        self._reader = threading.Thread(target=self._read_events, name='supervisor_events', daemon=True)
+        self._reader.start()
+
+        for worker in self.workers.values():
+            if not self.config.enable_dvr:
+                await asyncio.to_thread(worker.server._sweep_stale_segments)
+            self._start_worker(worker)
+
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '0.0.0.0', self.config.hls_server_port)
+        await site.start()
+        logger.info(f"Stream supervisor serving {len(self.workers)} streams on port {self.config.hls_server_port}")
+
+    async def stop(self):
+        """Stop the workers and the HTTP front end"""
+        self._stopping = True
+        for worker in self.workers.values():
+            if worker.restart_handle:
+                worker.restart_handle.cancel()
+                worker.restart_handle = None
+            if worker.process is not None:
+                self._loop.remove_reader(worker.process.sentinel)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+        await asyncio.gather(*(asyncio.to_thread(self._join_worker, worker)
+                               for worker in self.workers.values()))
+
+        self.events.put(None)
+        await asyncio.to_thread(self._reader.join)
+        for worker in self.workers.values():
+            await worker.server.stop()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        logger.info("Stream supervisor stopped")
+
+    async def run(self):
+        """Serve all streams until cancelled"""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    def _start_worker(self, worker: StreamWorker):
+        """Spawn the worker process of a stream and watch for its exit"""
+        worker.restart_handle = None
+        first_segment_id = worker.server.next_segment_id()
+        # After segments of a previous worker, the new one starts a discontinuity
+        worker.process = self.context.Process(
+            target=self.worker_target,
+            args=(worker.name, worker.config, self.events, first_segment_id, first_segment_id > 1,
+                  logging.getLogger().getEffectiveLevel()),
+            name=f'worker_{worker.name}'
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        # The sentinel becomes readable when the process exits, no thread has to wait for it
+        self._loop.add_reader(worker.process.sentinel, self._on_worker_exit, worker)
+        logger.info(f"Started worker for stream {worker.name} (pid {worker.process.pid})")
+
+    def _on_worker_exit(self, worker: StreamWorker):
+        """Schedule the restart of a worker that exited"""
+        self._loop.remove_reader(worker.process.sentinel)
+        worker.process.join()
+        process_exited(worker.process.pid)
+        if self._stopping:
+            return
+
+        if time.monotonic() - worker.started_at >= HEALTHY_UPTIME:
+            worker.failures = 0
+        delay = min(MAX_RESTART_DELAY, self.config.worker_restart_delay * 2 ** worker.failures)
+        worker.failures += 1
+        logger.warning(f"Worker for stream {worker.name} exited with code {worker.process.exitcode}, "
+                       f"restarting in {delay:.1f}s")
+        worker.restart_handle = self._loop.call_later(delay, self._restart_worker, worker)
+
+    def _restart_worker(self, worker: StreamWorker):
+        if self._stopping:
+            return
+        worker.restarts += 1
+        self._start_worker(worker)
+
+    @staticmethod
+    def _join_worker(worker: StreamWorker):
+        """Wait for a terminated worker, killing it if it does not exit (blocking)"""
+        if worker.process is None:
+            return
+        worker.process.join(STOP_TIMEOUT)
+        if worker.process.is_alive():
+            logger.warning(f"Worker for stream {worker.name} did not stop, killing it")
+            worker.process.kill()
+            worker.process.join()
+
+    def _read_events(self):
+        """Hand events from the worker queue over to the event loop (reader thread)"""
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: tuple):
+        """Apply an event published by a worker (runs on the event loop)"""
+        kind, name, payload = event
+        worker = self.workers.get(name)
+        if worker is None:
+            logger.warning(f"Event for unknown stream {name}")
+            return
+        if kind == 'segment':
+            worker.server.add_segment(payload)
+        elif kind == 'part':
+            worker.server.add_part(payload)
+        elif kind == 'audio':
+            worker.server.set_audio(payload)
+        elif kind == 'stats':
+            worker.stats = payload
+
+    async def _handle_streams(self, request):
+        """List the streams with their URLs and worker state"""
+        return web.json_response({
+            name: {
+                'playlist': f'/{name}/stream.m3u8',
+                'player': f'/{name}/player',
+                'alive': worker.alive,
+                'restarts': worker.restarts
+            }
+            for name, worker in self.workers.items()
+        })
@@ -0,0 +1,78 @@
+import io
+import logging
+from dataclasses import replace
+from fractions import Fraction
+import av
+import pytest
+from src.config import StreamConfig
+from src.converter import autotune as autotune_module
+from src.converter.autotune import autotune, calibrate, calibration_frames
+from src.converter.segment_writer import add_video_encoder
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def config():
+    return StreamConfig(
+        input_url='test.mp4',
+        video_bitrates=[500000, 250000],
+        width=160,
+        height=120,
+        fps=10,
+        autotune_target=2.0,
+    )
+
+
+def test_encoder_uses_configured_preset_and_threading(config):
+    """Writers and calibration runs share one resolution of the encoder options"""
+    config = replace(config, video_preset='veryfast', encoder_thread_type='frame', encoder_threads=2)
+    with av.open(io.BytesIO(), 'w', format='mpegts') as container:
+        encoder = add_video_encoder(container, config, config.get_renditions()[0], Fraction(1, 90000))
+        assert encoder.options['preset'] == 'veryfast'
+        assert encoder.codec_context.thread_type.name == 'FRAME'
+        assert encoder.codec_context.thread_count == 2
+
+
+def test_calibration_measures_every_rendition(config):
+    """A real calibration run encodes the synthetic frames into all renditions"""
+    frames = calibration_frames(config, seconds=0.5)
+    assert len(frames) == 5
+    assert (frames[0].width, frames[0].height) == (160, 120)
+    assert calibrate(config, frames) > 0
+
+
+def test_autotune_picks_slowest_preset_that_keeps_up(config, monkeypatch):
+    """Presets get slower until one misses the target, the last one that made it wins"""
+    speeds = {'ultrafast': 8.0, 'superfast': 5.0, 'veryfast': 3.0, 'faster': 1.5, 'fast': 2.5}
+    tried = []
+
+    def fake_calibrate(candidate, frames):
+        tried.append(candidate.video_preset)
+        return speeds[candidate.video_preset]
+
+    monkeypatch.setattr(autotune_module, 'calibrate', fake_calibrate)
+    monkeypatch.setattr(autotune_module, 'calibration_frames', lambda config: [])
+    monkeypatch.setattr(autotune_module.os, 'cpu_count', lambda: 1)
+
+    tuned = autotune(config)
+    assert tuned.video_preset == 'veryfast'
+    assert (tuned.encoder_thread_type, tuned.encoder_threads) == ('slice', 1)
+    # Never tried beyond the first preset that fell behind
+    assert tried == ['ultrafast', 'superfast', 'veryfast', 'faster']
+
+
+def test_autotune_falls_back_to_fastest_preset(config, monkeypatch):
+    """Hardware too slow for any preset still gets the fastest one"""
+    monkeypatch.setattr(autotune_module, 'calibrate', lambda candidate, frames: 0.5)
+    monkeypatch.setattr(autotune_module, 'calibration_frames', lambda config: [])
+    monkeypatch.setattr(autotune_module.os, 'cpu_count', lambda: 4)
+
+    tuned = autotune(config)
+    assert tuned.video_preset == 'ultrafast'
+    assert tuned.encoder_threads == 2
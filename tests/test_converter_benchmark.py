@@ -0,0 +1,30 @@
+import logging
+import pytest
+from benchmarks import converter_benchmark
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.timeout(120)
+@pytest.mark.parametrize('audio', [True, False])
+def test_benchmark_scenario_smoke(tmp_path, audio):
+    """A short file scenario runs through the benchmark's stand-in server and times every rendition"""
+    source_path = str(tmp_path / 'pattern.mp4')
+    converter_benchmark._generate_source(source_path, 320, 180, 2, audio)
+    output_path = tmp_path / 'output'
+    output_path.mkdir()
+
+    scenario = {'resolution': 'smoke', 'audio': audio, 'source': 'file'}
+    result = converter_benchmark.run_scenario(scenario, source_path, str(output_path), 1)
+
+    assert result['video_frames'] == 60
+    assert result['encoding_errors'] == 0
+    assert result['audio_listed'] == audio
+    audio_renditions = [name for name in result['first_segment_seconds'] if name.startswith('audio_')]
+    assert bool(audio_renditions) == audio
+    assert len(result['first_segment_seconds']) > len(audio_renditions)
@@ -4,6 +4,8 @@ import os
 from pathlib import Path
 import pytest
 from unittest.mock import patch, MagicMock, AsyncMock
+from aiohttp.test_utils import TestClient, TestServer
+from prometheus_client import REGISTRY
 from src.server import HLSServer
 from src.config import StreamConfig
 import webbrowser
@@ -85,6 +87,457 @@ async def test_hls_server(tmp_path, mock_webbrowser_open, mock_aiohttp_web, mock
         )
         logger.info("Web browser open verified")
 
+@pytest.fixture
+def ladder_config(tmp_path):
+    return StreamConfig(
+        input_url=TEST_RTSP_URL,
+        output_path=str(tmp_path / "output"),
+        video_bitrates=[2000000, 500000],
+        width=1280,
+        height=720,
+        segment_duration=2,
+    )
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_rendition_playlists(ladder_config):
+    """Each rendition gets its own resolution and segment list"""
+    server = HLSServer(ladder_config)
+    server.add_segment({'id': 1, 'rendition': '2000000', 'duration': 2.0})
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0})
+    server.add_segment({'id': 2, 'rendition': '500000', 'duration': 2.0})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream.m3u8')
+        master = await response.text()
+        assert 'RESOLUTION=1280x720' in master
+        assert 'RESOLUTION=640x360' in master
+
+        response = await client.get('/stream_500000.m3u8')
+        playlist = await response.text()
+        assert '/segment_500000_1.ts' in playlist
+        assert '/segment_500000_2.ts' in playlist
+        assert '2000000' not in playlist
+
+        response = await client.get('/stream_123.m3u8')
+        assert response.status == 404
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_master_playlist_codecs_follow_segments(ladder_config):
+    """CODECS is taken from the segments, left out until known and only lists audio that is there"""
+    ladder_config.enable_audio_renditions = False
+    server = HLSServer(ladder_config)
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream.m3u8')
+        assert 'CODECS' not in await response.text()
+
+        server.add_segment({'id': 1, 'rendition': '2000000', 'duration': 2.0, 'codecs': 'avc1.640028'})
+        server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'codecs': 'avc1.42C01E,mp4a.40.2'})
+        response = await client.get('/stream.m3u8')
+        master = await response.text()
+        assert 'CODECS="avc1.640028"' in master
+        assert 'CODECS="avc1.42C01E,mp4a.40.2"' in master
+        assert master.count('mp4a') == 1
+
+    # With audio renditions a variant lists the codecs of its audio group too
+    ladder_config.enable_audio_renditions = True
+    server = HLSServer(ladder_config)
+    server.set_audio(True)
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'codecs': 'avc1.4D401E'})
+    server.add_segment({'id': 1, 'rendition': 'audio_64000', 'duration': 2.0, 'codecs': 'mp4a.40.2'})
+    master = server.master_playlist.body.decode()
+    assert master.count('CODECS="avc1.4D401E,mp4a.40.2"') == 1
+    assert master.count('CODECS=') == 1
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_audio_renditions_grouped_in_master_playlist(ladder_config):
+    """Video variants are listed once per audio group when the input has audio"""
+    ladder_config.enable_memory_segments = True
+    server = HLSServer(ladder_config)
+    server.add_segment({'id': 1, 'rendition': 'audio_64000', 'duration': 2.0, 'data': memoryview(b'audio 1')})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream.m3u8')
+        master = await response.text()
+        assert 'EXT-X-MEDIA' not in master
+        assert 'AUDIO=' not in master
+
+        server.set_audio(True)
+        response = await client.get('/stream.m3u8')
+        master = await response.text()
+        assert master.count('TYPE=AUDIO') == 2
+        assert 'URI="/stream_audio_128000.m3u8"' in master
+        assert 'BANDWIDTH=2128000' in master
+        assert 'BANDWIDTH=564000' in master
+        assert master.count('/stream_500000.m3u8') == 2
+        assert 'AUDIO="audio_64000"' in master
+
+        response = await client.get('/stream_audio_64000.m3u8')
+        playlist = await response.text()
+        assert '/segment_audio_64000_1.ts' in playlist
+
+        response = await client.get('/segment_audio_64000_1.ts')
+        assert response.status == 200
+        assert await response.read() == b'audio 1'
+
+        server.set_audio(False)
+        response = await client.get('/stream.m3u8')
+        assert 'AUDIO=' not in await response.text()
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_memory_segments_served_from_buffer(ladder_config):
+    """In-memory segments are served from their buffer and evicted with the window"""
+    ladder_config.enable_memory_segments = True
+    ladder_config.playlist_size = 2
+    ladder_config.segment_safety_margin = 1
+    server = HLSServer(ladder_config)
+    for segment_id in range(1, 5):
+        server.add_segment({
+            'id': segment_id,
+            'rendition': '500000',
+            'duration': 2.0,
+            'data': memoryview(f'segment {segment_id}'.encode())
+        })
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/segment_500000_4.ts')
+        assert response.status == 200
+        assert response.content_type == 'video/mp2t'
+        assert await response.read() == b'segment 4'
+
+        response = await client.get('/segment_500000_1.ts')
+        assert response.status == 404
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_segments_served_from_index_with_ranges(ladder_config, tmp_path):
+    """Only indexed segments are served, from files or memory, whole or by byte range"""
+    ladder_config.output_path = str(tmp_path)
+    server = HLSServer(ladder_config)
+    path = tmp_path / 'segment_500000_1.ts'
+    path.write_bytes(b'0123456789')
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'path': path, 'size': 10})
+    server.add_segment({'id': 1, 'rendition': '2000000', 'duration': 2.0, 'data': memoryview(b'abcdefghij')})
+    # Written but never published, e.g. still being muxed
+    (tmp_path / 'segment_500000_2.ts').write_bytes(b'partial')
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/segment_500000_2.ts')
+        assert response.status == 404
+
+        response = await client.get('/segment_500000_1.ts', headers={'Range': 'bytes=2-4'})
+        assert response.status == 206
+        assert await response.read() == b'234'
+        assert response.headers['Content-Range'] == 'bytes 2-4/10'
+
+        response = await client.get('/segment_2000000_1.ts')
+        assert response.headers['Content-Length'] == '10'
+        assert response.headers['Accept-Ranges'] == 'bytes'
+
+        response = await client.get('/segment_2000000_1.ts', headers={'Range': 'bytes=-3'})
+        assert response.status == 206
+        assert await response.read() == b'hij'
+        assert response.headers['Content-Range'] == 'bytes 7-9/10'
+
+        response = await client.get('/segment_2000000_1.ts', headers={'Range': 'bytes=20-'})
+        assert response.status == 416
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_segments_published_without_size_are_measured(ladder_config, tmp_path):
+    """File segments published with only a path are served with the size of their file"""
+    ladder_config.output_path = str(tmp_path)
+    server = HLSServer(ladder_config)
+    path = tmp_path / 'segment_500000_1.ts'
+    path.write_bytes(b'0123456789')
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'path': str(path)})
+    server.add_segment({'id': 2, 'rendition': '500000', 'duration': 2.0, 'path': str(tmp_path / 'gone.ts')})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/segment_500000_1.ts')
+        assert response.status == 200
+        assert await response.read() == b'0123456789'
+
+        response = await client.get('/segment_500000_1.ts', headers={'Range': 'bytes=7-'})
+        assert response.status == 206
+        assert await response.read() == b'789'
+
+        response = await client.get('/segment_500000_2.ts')
+        assert response.status == 404
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_live_window_evicts_and_deletes_files(ladder_config, tmp_path):
+    """Old segments leave the playlist and their files are deleted after the grace period"""
+    ladder_config.output_path = str(tmp_path)
+    ladder_config.playlist_size = 2
+    ladder_config.segment_safety_margin = 1
+    ladder_config.segment_grace_period = 0.1
+    stale = tmp_path / 'segment_500000_99.ts'
+    stale.write_bytes(b'old run')
+
+    server = HLSServer(ladder_config)
+    server._sweep_stale_segments()
+    assert not stale.exists()
+
+    paths = []
+    for segment_id in range(1, 6):
+        path = tmp_path / f'segment_500000_{segment_id}.ts'
+        path.write_bytes(b'segment')
+        paths.append(path)
+        server.add_segment({'id': segment_id, 'rendition': '500000', 'duration': 2.0, 'path': path})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        playlist = await response.text()
+        assert '#EXT-X-MEDIA-SEQUENCE:4' in playlist
+        assert '/segment_500000_3.ts' not in playlist
+
+    # Evicted files survive until the grace period is over
+    assert paths[0].exists()
+    await asyncio.gather(*server._cleanup_tasks)
+    assert [p.exists() for p in paths] == [False, False, True, True, True]
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_playlists_answer_conditional_requests(ladder_config):
+    """Playlists carry a strong ETag that changes only when a segment is added"""
+    server = HLSServer(ladder_config)
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        etag = response.headers['ETag']
+        assert response.status == 200
+
+        response = await client.get('/stream_500000.m3u8', headers={'If-None-Match': etag})
+        assert response.status == 304
+        assert response.headers['ETag'] == etag
+
+        server.add_segment({'id': 2, 'rendition': '500000', 'duration': 2.0})
+        response = await client.get('/stream_500000.m3u8', headers={'If-None-Match': etag})
+        assert response.status == 200
+        assert response.headers['ETag'] != etag
+        assert '/segment_500000_2.ts' in await response.text()
+
+        response = await client.get('/stream.m3u8')
+        master_etag = response.headers['ETag']
+        response = await client.get('/stream.m3u8', headers={'If-None-Match': master_etag})
+        assert response.status == 304
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_caching_headers_per_resource(ladder_config, tmp_path):
+    """Segments are cached as immutable, playlists for half a target duration, misses not at all"""
+    ladder_config.output_path = str(tmp_path)
+    ladder_config.segment_max_age = 600
+    ladder_config.enable_surrogate_keys = True
+    ladder_config.stream_name = 'cam1'
+    server = HLSServer(ladder_config)
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'data': memoryview(b'in memory')})
+    path = tmp_path / 'segment_2000000_1.ts'
+    path.write_bytes(b'on disk')
+    server.add_segment({'id': 1, 'rendition': '2000000', 'duration': 2.0, 'path': path, 'size': 7})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        assert response.headers['Cache-Control'] == 'public, max-age=1'
+        assert response.headers['Surrogate-Key'] == 'cam1 cam1-playlist cam1-500000'
+
+        response = await client.get('/segment_500000_1.ts')
+        assert response.headers['Cache-Control'] == 'public, max-age=600, immutable'
+        etag = response.headers['ETag']
+        response = await client.get('/segment_500000_1.ts', headers={'If-None-Match': etag})
+        assert response.status == 304
+        assert response.headers['Cache-Control'] == 'public, max-age=600, immutable'
+
+        response = await client.get('/segment_2000000_1.ts')
+        assert await response.read() == b'on disk'
+        assert response.headers['Cache-Control'] == 'public, max-age=600, immutable'
+        assert 'ETag' in response.headers and 'Last-Modified' in response.headers
+
+        response = await client.get('/segment_500000_2.ts')
+        assert response.status == 404
+        assert response.headers['Cache-Control'] == 'no-cache'
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+@pytest.mark.parametrize('segment_duration, max_age', [(1, 1), (3, 2), (4, 2)])
+async def test_playlists_stay_cacheable_with_short_segments(ladder_config, segment_duration, max_age):
+    """Playlists are cached for at least a second, even when half a segment rounds down to nothing"""
+    ladder_config.segment_duration = segment_duration
+    server = HLSServer(ladder_config)
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': float(segment_duration)})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        assert response.headers['Cache-Control'] == f'public, max-age={max_age}'
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_low_latency_blocking_reload_and_parts(ladder_config):
+    """Blocking reloads wait for the requested part, which is listed and served"""
+    ladder_config.enable_low_latency = True
+    ladder_config.part_duration = 0.5
+    server = HLSServer(ladder_config)
+
+    def part(segment_id, index):
+        return {'segment_id': segment_id, 'rendition': '500000', 'index': index,
+                'duration': 0.5, 'independent': index == 0, 'data': memoryview(b'part %d' % index)}
+
+    server.add_part(part(1, 0))
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        playlist = await response.text()
+        assert '#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=1.5' in playlist
+        assert '#EXT-X-PART-INF:PART-TARGET=0.5' in playlist
+        assert '#EXT-X-PART:DURATION=0.5,URI="/part_500000_1_0.ts",INDEPENDENT=YES' in playlist
+        assert '#EXT-X-PRELOAD-HINT:TYPE=PART,URI="/part_500000_1_1.ts"' in playlist
+        assert '#EXT-X-RENDITION-REPORT:URI="/stream_2000000.m3u8",LAST-MSN=0' in playlist
+
+        # Both the playlist reload and the hinted part are held until the part exists
+        reload = asyncio.create_task(client.get('/stream_500000.m3u8?_HLS_msn=1&_HLS_part=1'))
+        hinted = asyncio.create_task(client.get('/part_500000_1_1.ts'))
+        await asyncio.sleep(0.2)
+        assert not reload.done() and not hinted.done()
+
+        server.add_part(part(1, 1))
+        response = await reload
+        assert '/part_500000_1_1.ts' in await response.text()
+        assert response.headers['Cache-Control'] == 'public, max-age=6'
+        response = await hinted
+        assert await response.read() == b'part 1'
+
+        server.add_segment({'id': 1, 'rendition': '500000', 'duration': 1.0,
+                            'parts': [part(1, 0), part(1, 1)]})
+        response = await client.get('/stream_500000.m3u8?_HLS_msn=1')
+        playlist = await response.text()
+        assert '/segment_500000_1.ts' in playlist
+        assert '#EXT-X-PRELOAD-HINT:TYPE=PART,URI="/part_500000_2_0.ts"' in playlist
+
+        response = await client.get('/stream_500000.m3u8?_HLS_msn=9')
+        assert response.status == 400
+        response = await client.get('/stream_500000.m3u8?_HLS_part=1')
+        assert response.status == 400
+
+    # Hold back is three part targets, without float noise
+    ladder_config.part_duration = 0.3
+    server = HLSServer(ladder_config)
+    server.add_part(part(1, 0))
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        assert 'PART-HOLD-BACK=0.9\n' in await response.text()
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_fmp4_playlists_map_init_segment(ladder_config, tmp_path):
+    """fMP4 playlists reference the init segment and segments carry MP4 MIME types"""
+    ladder_config.output_path = str(tmp_path)
+    ladder_config.segment_format = 'fmp4'
+    server = HLSServer(ladder_config)
+    path = tmp_path / 'segment_500000_1.m4s'
+    path.write_bytes(b'moof')
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'path': path, 'size': 4,
+                        'init': b'moov'})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        playlist = await response.text()
+        assert '#EXT-X-VERSION:7' in playlist
+        assert '#EXT-X-MAP:URI="/init_500000.mp4"' in playlist
+        assert '/segment_500000_1.m4s' in playlist
+
+        response = await client.get('/init_500000.mp4')
+        assert response.content_type == 'video/mp4'
+        assert await response.read() == b'moov'
+
+        response = await client.get('/segment_500000_1.m4s')
+        assert response.content_type == 'video/mp4'
+        assert await response.read() == b'moof'
+
+        response = await client.get('/init_2000000.mp4')
+        assert response.status == 404
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_discontinuities_are_tagged_and_counted(ladder_config):
+    """Segments after a reconnect are tagged, tags leaving the playlist advance the sequence"""
+    ladder_config.playlist_size = 2
+    server = HLSServer(ladder_config)
+    for segment_id in range(1, 5):
+        server.add_segment({'id': segment_id, 'rendition': '500000', 'duration': 2.0,
+                            'discontinuity': segment_id in (2, 3)})
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/stream_500000.m3u8')
+        playlist = await response.text()
+        assert '#EXT-X-DISCONTINUITY-SEQUENCE:1' in playlist
+        assert '#EXT-X-DISCONTINUITY\n#EXTINF:2,\n/segment_500000_3.ts' in playlist
+        assert playlist.count('#EXT-X-DISCONTINUITY\n') == 1
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_metrics_count_requests_and_bytes(ladder_config):
+    """Served media bytes and request latencies show up on /metrics"""
+    ladder_config.enable_memory_segments = True
+    ladder_config.stream_name = 'metrics_test'
+    server = HLSServer(ladder_config)
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'data': memoryview(b'x' * 100)})
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, dict(stream='metrics_test', **labels)) or 0
+
+    requests_before = sample('hls_request_seconds_count', kind='segment')
+    bytes_before = sample('hls_bytes_out_total', rendition='500000')
+    async with TestClient(TestServer(server.app)) as client:
+        await client.get('/segment_500000_1.ts')
+        await client.get('/segment_500000_1.ts')
+        await client.get('/stream_500000.m3u8')
+
+        response = await client.get('/metrics')
+        assert response.status == 200
+        assert 'hls_request_seconds_bucket' in await response.text()
+
+    assert sample('hls_request_seconds_count', kind='segment') == requests_before + 2
+    assert sample('hls_bytes_out_total', rendition='500000') == bytes_before + 200
+    assert sample('hls_request_seconds_count', kind='playlist') >= 1
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_metrics_count_file_bytes_sent(ladder_config, tmp_path):
+    """File segments count the bytes actually sent, revalidations answered with 304 count none"""
+    ladder_config.output_path = str(tmp_path)
+    ladder_config.stream_name = 'file_metrics_test'
+    server = HLSServer(ladder_config)
+    path = tmp_path / 'segment_500000_1.ts'
+    path.write_bytes(b'x' * 100)
+    server.add_segment({'id': 1, 'rendition': '500000', 'duration': 2.0, 'path': str(path), 'size': 100})
+
+    def sent():
+        labels = {'stream': 'file_metrics_test', 'rendition': '500000'}
+        return REGISTRY.get_sample_value('hls_bytes_out_total', labels) or 0
+
+    async with TestClient(TestServer(server.app)) as client:
+        response = await client.get('/segment_500000_1.ts')
+        assert response.status == 200
+        assert sent() == 100
+
+        response = await client.get('/segment_500000_1.ts', headers={'If-None-Match': response.headers['ETag']})
+        assert response.status == 304
+        response = await client.get('/segment_500000_1.ts',
+                                    headers={'If-Modified-Since': response.headers['Last-Modified']})
+        assert response.status == 304
+        assert sent() == 100
+
+        response = await client.get('/segment_500000_1.ts', headers={'Range': 'bytes=90-'})
+        assert response.status == 206
+        assert sent() == 110
+
 if __name__ == "__main__":
     try:
         asyncio.run(test_hls_server())
@@ -0,0 +1,54 @@
+import logging
+from fractions import Fraction
+import av
+import numpy as np
+import pytest
+from src.converter.motion import MotionDetector
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def _frame(index, moving=False, format='yuv420p', fps=10, width=320, height=240):
+    """Gray frame with sensor noise, and a bright square walking across it when moving"""
+    rng = np.random.default_rng(index)
+    luma = np.clip(128 + rng.normal(0, 3, (height, width)), 0, 255).astype(np.uint8)
+    if moving:
+        x = index * 8 % (width - 40)
+        luma[100:140, x:x + 40] = 250
+    if format == 'yuv420p':
+        image = np.concatenate([luma, np.full((height // 2, width), 128, np.uint8)])
+    else:
+        image = np.repeat(luma[:, :, None], 3, axis=2)
+    frame = av.VideoFrame.from_ndarray(image, format=format)
+    frame.pts = index
+    frame.time_base = Fraction(1, fps)
+    return frame
+
+
+@pytest.mark.parametrize('format', ['yuv420p', 'rgb24'])
+def test_noise_scores_low_and_motion_high(format):
+    """Sensor noise stays below the pixel threshold, a moving object does not"""
+    detector = MotionDetector(threshold=0.005, hold=1.0, static_fps=1)
+    detector.keep(_frame(0, format=format))
+    detector.keep(_frame(1, format=format))
+    assert detector.score < 0.001
+    detector.keep(_frame(2, moving=True, format=format))
+    assert detector.score > 0.01
+
+
+def test_static_scene_is_thinned_out_until_motion():
+    """After the hold time only static_fps frames are kept, motion brings back every frame"""
+    detector = MotionDetector(threshold=0.005, hold=1.0, static_fps=2)
+    kept = [index for index in range(40) if detector.keep(_frame(index, moving=index >= 30))]
+
+    # Moving from 0.0s to 1.0s, then 2 fps until the square shows up at 3.0s
+    assert kept == list(range(11)) + [15, 20, 25] + list(range(30, 40))
+    assert not detector.static
+
+    detector.reset()
+    assert detector.keep(_frame(40))
@@ -0,0 +1,283 @@
+import logging
+import queue
+import threading
+from fractions import Fraction
+import av
+import pytest
+from types import SimpleNamespace
+from src.converter.pipeline import (Pipeline, DemuxStage, DecodeStage, EncodeStage, RealtimeScheduler,
+                                    FrameDecimator)
+from src.converter.probe import is_reference_frame
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+class FakeFrame(str):
+    time_base = Fraction(1, 10)
+
+
+class FakeStream:
+    type = 'video'
+    time_base = Fraction(1, 10)
+
+    def decode(self, packet):
+        if packet is None:
+            return [FakeFrame('flushed')]
+        return [FakeFrame(f"frame_{packet.dts}")]
+
+
+class FakePacket:
+    def __init__(self, stream, dts, size=None):
+        self.stream = stream
+        self.dts = dts
+        self.pts = dts
+        # Flush packets are the empty ones
+        self.size = (0 if dts is None else 1) if size is None else size
+        self.duration = 1
+        self.time_base = Fraction(1, 10)
+
+
+class FakeContainer:
+    def __init__(self, stream, count, error=None, untimed=False, start=0):
+        self.stream = stream
+        self.count = count
+        self.start = start
+        self.error = error
+        self.untimed = untimed
+        self.closed = False
+
+    def demux(self, streams):
+        if self.untimed:
+            # RTSP sends the first packets before timestamps are known
+            yield FakePacket(self.stream, None, size=1)
+        for i in range(self.count):
+            yield FakePacket(self.stream, self.start + i)
+        if self.error:
+            raise self.error
+        # Trailing flush packet as emitted by libav
+        yield FakePacket(self.stream, None)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeWriter:
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def interrupt(self, video_stream, audio_stream):
+        self.frames.append(('interrupt', video_stream))
+
+    def close(self):
+        self.closed = True
+
+
+def _build(container, stream, writers, max_size=2, reopen=None):
+    stop_event = threading.Event()
+    packet_queue = queue.Queue(maxsize=max_size)
+    frame_queues = [queue.Queue(maxsize=max_size) for _ in writers]
+    stages = [
+        DemuxStage(container, [stream], [packet_queue], stop_event, reopen=reopen),
+        DecodeStage([stream], packet_queue, frame_queues, stop_event),
+    ]
+    stages += [EncodeStage(q, w, stop_event, name=f'encode_{i}')
+               for i, (q, w) in enumerate(zip(frame_queues, writers))]
+    return Pipeline(stages, [packet_queue] + frame_queues, stop_event)
+
+
+@pytest.mark.timeout(10)
+def test_pipeline_processes_all_frames_in_order():
+    """All frames pass through bounded queues in order and the writer is closed"""
+    stream = FakeStream()
+    writer = FakeWriter()
+    pipeline = _build(FakeContainer(stream, 50), stream, [writer])
+
+    pipeline.start()
+    pipeline.join()
+
+    assert pipeline.error is None
+    assert writer.frames == [f"frame_{i}" for i in range(50)] + ['flushed']
+    assert writer.closed
+
+
+@pytest.mark.timeout(10)
+def test_packets_without_timestamps_are_decoded():
+    """Only empty flush packets are skipped, packets without timestamps still reach the decoder"""
+    stream = FakeStream()
+    writer = FakeWriter()
+    pipeline = _build(FakeContainer(stream, 3, untimed=True), stream, [writer], reopen=lambda stop_event: None)
+
+    pipeline.start()
+    pipeline.join()
+
+    assert pipeline.error is None
+    assert writer.frames == ['frame_None', 'frame_0', 'frame_1', 'frame_2', 'flushed']
+
+
+@pytest.mark.timeout(10)
+def test_pipeline_stop_unblocks_stages():
+    """Stopping the pipeline releases stages blocked on full queues"""
+    stream = FakeStream()
+    writer = FakeWriter()
+    release = threading.Event()
+    writer.write = lambda frame: release.wait()
+    pipeline = _build(FakeContainer(stream, 1000), stream, [writer])
+
+    pipeline.start()
+    pipeline.stop()
+    release.set()
+    pipeline.join()
+
+    assert writer.closed
+
+
+@pytest.mark.timeout(10)
+def test_pipeline_fans_out_to_every_rendition():
+    """Each decoded frame reaches every rendition writer exactly once"""
+    stream = FakeStream()
+    writers = [FakeWriter() for _ in range(3)]
+    pipeline = _build(FakeContainer(stream, 20), stream, writers)
+
+    pipeline.start()
+    pipeline.join()
+
+    expected = [f"frame_{i}" for i in range(20)] + ['flushed']
+    for writer in writers:
+        assert writer.frames == expected
+        assert writer.closed
+
+
+@pytest.mark.timeout(10)
+def test_demux_reopens_lost_input_with_continued_timestamps():
+    """A lost input is replaced, the writer is interrupted and timestamps keep counting up"""
+    lost_stream, new_stream = FakeStream(), FakeStream()
+    lost = FakeContainer(lost_stream, 5, error=ConnectionResetError("camera gone"))
+    inputs = [(FakeContainer(new_stream, 3), [new_stream])]
+    writer = FakeWriter()
+    # The second reopen finds the pipeline stopping
+    pipeline = _build(lost, lost_stream, [writer], reopen=lambda stop_event: inputs.pop() if inputs else None)
+
+    pipeline.start()
+    pipeline.join()
+
+    assert pipeline.error is None
+    assert lost.closed
+    gap = writer.frames.index(('interrupt', new_stream))
+    assert writer.frames[:gap] == [f"frame_{i}" for i in range(5)] + ['flushed']
+    # The new input resumes where the lost one ended, at 0.5s
+    resumed = [int(frame.split('_')[1]) for frame in writer.frames[gap + 1:-1]]
+    assert resumed[0] >= 5
+    assert resumed == list(range(resumed[0], resumed[0] + 3))
+    assert writer.closed
+
+
+@pytest.mark.timeout(10)
+def test_demux_continues_after_input_with_later_timestamps():
+    """An input whose source timestamps run ahead of the timeline does not push the next one ahead"""
+    first, later, last = FakeStream(), FakeStream(), FakeStream()
+    # The second input starts at 1000s and is rebased to continue after the first one
+    inputs = [(FakeContainer(last, 3), [last]), (FakeContainer(later, 3, start=10000), [later])]
+    writer = FakeWriter()
+    pipeline = _build(FakeContainer(first, 5), first, [writer],
+                      reopen=lambda stop_event: inputs.pop() if inputs else None)
+
+    pipeline.start()
+    pipeline.join()
+
+    assert pipeline.error is None
+    gaps = [i for i, frame in enumerate(writer.frames) if isinstance(frame, tuple)]
+    assert len(gaps) == 2
+    rebased = [int(frame.split('_')[1]) for frame in writer.frames[gaps[0] + 1:gaps[1] - 1]]
+    resumed = [int(frame.split('_')[1]) for frame in writer.frames[gaps[1] + 1:-1]]
+    assert 5 <= rebased[0] < 10
+    # The third input continues after the rebased second one, about 0.8s, not after 1000s
+    assert rebased[-1] < resumed[0] < rebased[-1] + 10
+
+
+class FakeVideoPacket(SimpleNamespace):
+    def __bytes__(self):
+        return self.data
+
+
+# One byte NAL units after a 4 byte length prefix, a reference and a non-reference slice
+REFERENCE_SLICE = b'\x00\x00\x00\x01\x41'
+NON_REFERENCE_SLICE = b'\x00\x00\x00\x01\x01'
+
+
+def _video_packet(index, keyframe=False, data=REFERENCE_SLICE, disposable=False):
+    stream = SimpleNamespace(type='video', codec_context=SimpleNamespace(name='h264'))
+    return FakeVideoPacket(stream=stream, dts=index, pts=index, time_base=Fraction(1, 10),
+                           is_keyframe=keyframe, is_disposable=disposable, data=data)
+
+
+def test_scheduler_drops_non_reference_frames_then_skips_to_keyframe():
+    """Behind the input, non-reference frames go first, then everything up to the next keyframe"""
+    now = [0.0]
+    scheduler = RealtimeScheduler(max_lag=1.0, clock=lambda: now[0])
+    dropped = []
+    # Decoding at half speed, every second of media takes two seconds
+    for index in range(40):
+        now[0] = index * 0.2
+        packet = _video_packet(index, keyframe=index % 10 == 0,
+                               data=NON_REFERENCE_SLICE if index % 2 else REFERENCE_SLICE)
+        if scheduler.should_drop(packet):
+            dropped.append(index)
+
+    assert dropped == [11, 13, 15, 17, 19] + list(range(21, 30)) + list(range(31, 40))
+    assert scheduler.lag == pytest.approx(3.9)
+
+
+def test_scheduler_never_drops_input_read_ahead():
+    """An input read faster than real time re-anchors the lag instead of going negative"""
+    scheduler = RealtimeScheduler(max_lag=1.0, clock=lambda: 0.0)
+    assert not any(scheduler.should_drop(_video_packet(index, disposable=True)) for index in range(100))
+    assert scheduler.lag == 0.0
+
+
+def test_h264_reference_frames_are_told_from_nal_headers():
+    """nal_ref_idc of the first slice decides, in Annex B and length prefixed framing"""
+    # Access unit delimiter followed by a non-reference slice
+    annex_b = _video_packet(0, data=b'\x00\x00\x00\x01\x09\xf0\x00\x00\x01\x01\x9a')
+    assert not is_reference_frame(annex_b)
+    assert not is_reference_frame(_video_packet(0, data=NON_REFERENCE_SLICE + b'\x9a'))
+    assert is_reference_frame(_video_packet(0, data=REFERENCE_SLICE + b'\x9a'))
+    assert not is_reference_frame(_video_packet(0, disposable=True))
+
+
+def _decimated(fps, timestamps):
+    decimator = FrameDecimator(fps)
+    kept = []
+    for pts in timestamps:
+        frame = av.VideoFrame(16, 16, 'yuv420p')
+        frame.pts = pts
+        frame.time_base = Fraction(1, 90000)
+        if decimator.keep(frame):
+            kept.append(pts)
+    return kept
+
+
+@pytest.mark.parametrize('fps, kept', [
+    (10, [0, 3, 6, 9]),
+    (15, [0, 2, 4, 6, 8, 10]),
+    (20, [0, 2, 3, 5, 6, 8, 9, 11]),
+    (30, list(range(12))),
+    (60, list(range(12))),
+])
+def test_decimator_thins_30fps_to_output_rate(fps, kept):
+    """Kept frames follow the output rate and keep their timestamps"""
+    assert _decimated(fps, [i * 3000 for i in range(12)]) == [i * 3000 for i in kept]
+
+
+def test_decimator_restarts_after_gap():
+    """Input gaps and timestamp jitter keep the output on its grid"""
+    timestamps = [0, 3000, 5700, 9000, 900000, 903000, 906300, 909000]
+    assert _decimated(15, timestamps) == [0, 5700, 900000, 906300]
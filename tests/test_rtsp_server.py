@@ -0,0 +1,434 @@
+import asyncio
+import base64
+import logging
+import socket
+import struct
+from types import SimpleNamespace
+import pytest
+from src.config import StreamConfig
+from src.server import RTSPServer
+from src.server import rtsp_server
+from src.server.rtsp_server import (AACPacketizer, H264Packetizer, RTP_PAYLOAD_SIZE, RTSPError, RTSPParser,
+                                    split_nal_units)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SPS = bytes([0x67, 0x42, 0xC0, 0x1E, 0xDA, 0x02, 0x80])
+PPS = bytes([0x68, 0xCE, 0x3C, 0x80])
+IDR = bytes([0x65]) + bytes(range(1, 256)) * 12
+SLICE = bytes([0x41, 0x9A, 0x20, 0x14])
+AUD = bytes([0x09, 0xF0])
+
+
+def _annex_b(*units):
+    return b''.join(b'\x00\x00\x00\x01' + unit for unit in units)
+
+
+def _rtp(packet):
+    """Split an RTP packet into marker, sequence number, timestamp and payload"""
+    first, second, sequence, timestamp, ssrc = struct.unpack('!BBHII', packet[:12])
+    return bool(second & 0x80), sequence, timestamp, packet[12:]
+
+
+def _stream(codec, extradata=None, rate=None, channels=None):
+    codec_context = SimpleNamespace(codec=SimpleNamespace(canonical_name=codec), extradata=extradata)
+    return SimpleNamespace(codec_context=codec_context, rate=rate,
+                           layout=SimpleNamespace(nb_channels=channels))
+
+
+def test_split_nal_units():
+    data = _annex_b(SPS, PPS) + b'\x00\x00\x01' + SLICE + b'\x00'
+    assert split_nal_units(data) == [SPS, PPS, SLICE]
+    prefixed = b''.join(len(unit).to_bytes(4, 'big') + unit for unit in (SPS, SLICE))
+    assert split_nal_units(prefixed, length_size=4) == [SPS, SLICE]
+
+
+def test_h264_keyframes_are_fragmented_with_parameter_sets():
+    """Large NAL units go out as FU-A fragments, keyframes carry SPS and PPS even without them in band"""
+    packetizer = H264Packetizer(extradata=_annex_b(SPS, PPS))
+    packets = [_rtp(packet) for packet in packetizer.packetize(_annex_b(AUD, IDR), 1.0, keyframe=True)]
+
+    assert [payload for _, _, _, payload in packets[:2]] == [SPS, PPS]
+    fragments = [payload for _, _, _, payload in packets[2:]]
+    assert len(fragments) == -(-(len(IDR) - 1) // (RTP_PAYLOAD_SIZE - 2))
+    assert all(len(packet) <= RTP_PAYLOAD_SIZE for packet in fragments)
+    assert all(fragment[0] == 0x60 | 28 for fragment in fragments)
+    assert [fragment[1] & 0xC0 for fragment in fragments] == [0x80] + [0] * (len(fragments) - 2) + [0x40]
+    assert bytes([0x65]) + b''.join(fragment[2:] for fragment in fragments) == IDR
+
+    markers = [marker for marker, _, _, _ in packets]
+    assert markers == [False] * (len(packets) - 1) + [True]
+    sequences = [sequence for _, sequence, _, _ in packets]
+    assert sequences == [(sequences[0] + index) & 0xFFFF for index in range(len(packets))]
+    assert {timestamp for _, _, timestamp, _ in packets} == {(packetizer.timestamp_base + 90000) & 0xFFFFFFFF}
+
+    packets = packetizer.packetize(_annex_b(SLICE), 1.04)
+    assert [_rtp(packet)[3] for packet in packets] == [SLICE]
+
+
+def test_aac_access_units_lose_adts_headers():
+    packetizer = AACPacketizer(44100, 2)
+    assert packetizer.config == bytes([0x12, 0x10])
+    frame = bytes(range(100))
+    adts = bytes([0xFF, 0xF1, 0x50, 0x80, 0x0D, 0x7F, 0xFC])
+    for data in (frame, adts + frame):
+        marker, _, _, payload = _rtp(packetizer.packetize(data, 0.5)[0])
+        assert marker
+        assert payload == struct.pack('!HH', 16, len(frame) << 3) + frame
+
+
+def test_parser_handles_split_and_pipelined_requests():
+    parser = RTSPParser()
+    data = (b'OPTIONS rtsp://host/stream RTSP/1.0\r\nCSeq: 1\r\n\r\n'
+            b'$\x01\x00\x03abc\r\n'
+            b'SET_PARAMETER rtsp://host/stream RTSP/1.0\r\nCSeq: 2\r\nContent-Length: 5\r\n\r\nhello'
+            b'GET_PARAMETER rtsp://host/stream RTSP/1.0\r\nCSeq: 3\r\nSession: abc;timeout=60\r\n\r\n')
+    requests = []
+    for index in range(len(data)):
+        requests += parser.feed(data[index:index + 1])
+    assert [(request.method, request.headers['cseq']) for request in requests] == [
+        ('OPTIONS', '1'), ('SET_PARAMETER', '2'), ('GET_PARAMETER', '3')]
+    assert requests[1].body == b'hello'
+    assert requests[2].headers['session'] == 'abc;timeout=60'
+    assert parser.frames == 1
+    assert not parser.buffer
+
+    requests = RTSPParser().feed(data * 3)
+    assert len(requests) == 9
+
+
+@pytest.mark.parametrize('data, status', [
+    (b'OPTIONS rtsp://host/stream HTTP/1.1\r\nCSeq: 4\r\n\r\n', '505 RTSP Version Not Supported'),
+    (b'OPTIONS\r\nCSeq: 4\r\n\r\n', '400 Bad Request'),
+    (b'OPTIONS rtsp://host/stream RTSP/1.0\r\nCSeq: 4\r\nContent-Length: x\r\n\r\n', '400 Bad Request'),
+    (b'OPTIONS rtsp://host/stream RTSP/1.0\r\nX: ' + b'a' * rtsp_server.MAX_HEAD_SIZE, '400 Bad Request'),
+])
+def test_parser_rejects_bad_requests(data, status):
+    with pytest.raises(RTSPError) as error:
+        RTSPParser().feed(data)
+    assert error.value.status == status
+
+
+class RTSPTestClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.cseq = 0
+
+    async def request(self, method, url, headers=None):
+        self.cseq += 1
+        lines = [f'{method} {url} RTSP/1.0', f'CSeq: {self.cseq}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode()
+        status, *header_lines = head.strip().split('\r\n')
+        response_headers = dict(line.split(': ', 1) for line in header_lines)
+        body = await self.reader.readexactly(int(response_headers.get('Content-Length', 0)))
+        assert response_headers['CSeq'] == str(self.cseq)
+        return status, response_headers, body.decode()
+
+    async def send(self, method, url, headers=None):
+        """Send a request without waiting for the response"""
+        self.cseq += 1
+        lines = [f'{method} {url} RTSP/1.0', f'CSeq: {self.cseq}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+
+    async def interleaved(self):
+        header = await self.reader.readexactly(4)
+        assert header[0] == 0x24
+        return header[1], await self.reader.readexactly(int.from_bytes(header[2:], 'big'))
+
+
+@pytest.fixture
+def config(tmp_path):
+    return StreamConfig(input_url='rtsp://test', output_path=str(tmp_path), rtsp_server_port=0,
+                        rtsp_rtp_port=0, rtsp_client_buffer=4096)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_clients_play_from_the_next_keyframe(config):
+    server = RTSPServer(config)
+    await server.start()
+    try:
+        server.set_source(_stream('h264'), _stream('aac', rate=48000, channels=2))
+        server.send('video', _annex_b(SPS, PPS, IDR), 0.0, True)
+        client = RTSPTestClient(*await asyncio.open_connection('127.0.0.1', server.port))
+        url = f'rtsp://127.0.0.1:{server.port}/stream'
+
+        status, headers, _ = await client.request('OPTIONS', url)
+        assert status == 'RTSP/1.0 200 OK'
+        assert 'PLAY' in headers['Public']
+
+        status, headers, sdp = await client.request('DESCRIBE', url, {'Accept': 'application/sdp'})
+        assert headers['Content-Base'] == url + '/'
+        sets = f'{base64.b64encode(SPS).decode()},{base64.b64encode(PPS).decode()}'
+        assert f'profile-level-id=42C01E;sprop-parameter-sets={sets}' in sdp
+        assert 'a=rtpmap:97 MPEG4-GENERIC/48000/2' in sdp
+        assert 'config=1190' in sdp
+
+        status, headers, _ = await client.request('SETUP', url + '/trackID=0',
+                                                  {'Transport': 'RTP/AVP/TCP;unicast;interleaved=0-1'})
+        assert headers['Transport'] == 'RTP/AVP/TCP;unicast;interleaved=0-1'
+        session = headers['Session']
+        status, _, _ = await client.request('SETUP', url + '/trackID=3',
+                                            {'Transport': 'RTP/AVP/TCP;unicast;interleaved=6-7'})
+        assert status == 'RTSP/1.0 404 Not Found'
+        status, _, _ = await client.request('PLAY', url, {'Session': session})
+        assert status == 'RTSP/1.0 200 OK'
+
+        # Frames before the first keyframe and tracks not set up are not sent
+        server.send('video', _annex_b(SLICE), 0.04, False)
+        server.send('audio', b'\x21' * 10, 0.04, True)
+        server.send('video', _annex_b(SPS, PPS, SLICE), 2.0, True)
+
+        channel, report = await client.interleaved()
+        assert (channel, report[1]) == (1, 200)
+        payloads = []
+        for _ in range(3):
+            channel, packet = await client.interleaved()
+            assert channel == 0
+            payloads.append(_rtp(packet)[3])
+        assert payloads == [SPS, PPS, SLICE]
+        assert server.clients_gauge._value.get() == 1
+    finally:
+        client.writer.close()
+        await server.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_audio_only_clients_play_without_keyframes(config):
+    """Audio starts right away for clients without video, with video only once the video starts"""
+    server = RTSPServer(config)
+    await server.start()
+    clients = []
+    try:
+        server.set_source(_stream('h264', extradata=_annex_b(SPS, PPS)), _stream('aac', rate=48000, channels=2))
+        url = f'rtsp://127.0.0.1:{server.port}/stream'
+        for tracks in ([1], [0, 1]):
+            client = RTSPTestClient(*await asyncio.open_connection('127.0.0.1', server.port))
+            clients.append(client)
+            headers = {}
+            for track in tracks:
+                headers['Transport'] = f'RTP/AVP/TCP;unicast;interleaved={2 * track}-{2 * track + 1}'
+                _, response_headers, _ = await client.request('SETUP', f'{url}/trackID={track}', headers)
+                headers['Session'] = response_headers['Session']
+            status, _, _ = await client.request('PLAY', url, {'Session': headers['Session']})
+            assert status == 'RTSP/1.0 200 OK'
+        audio_only, both = clients
+
+        server.send('video', _annex_b(SLICE), 0.0, False)
+        server.send('audio', b'\x21' * 10, 0.0, False)
+        channel, report = await audio_only.interleaved()
+        assert (channel, report[1]) == (3, 200)
+        channel, packet = await audio_only.interleaved()
+        assert channel == 2 and _rtp(packet)[3].endswith(b'\x21' * 10)
+        assert all(session.waiting == {0, 1} for session in server.sessions.values() if len(session.transports) == 2)
+
+        # The client with video gets its audio from the first keyframe on
+        server.send('video', _annex_b(SPS, PPS, SLICE), 0.04, True)
+        server.send('audio', b'\x22' * 10, 0.04, False)
+        channels = []
+        while 2 not in channels:
+            channel, packet = await both.interleaved()
+            channels.append(channel)
+        assert channels.index(0) < channels.index(2)
+        assert _rtp(packet)[3].endswith(b'\x22' * 10)
+    finally:
+        for client in clients:
+            client.writer.close()
+        await server.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_slow_clients_skip_to_the_next_keyframe(config):
+    """A client that stops reading never holds up sending, it resumes at a keyframe"""
+    server = RTSPServer(config)
+    await server.start()
+    try:
+        server.set_source(_stream('h264', extradata=_annex_b(SPS, PPS)))
+        client = RTSPTestClient(*await asyncio.open_connection('127.0.0.1', server.port))
+        url = f'rtsp://127.0.0.1:{server.port}/stream'
+        await client.request('SETUP', url + '/trackID=0', {'Transport': 'RTP/AVP/TCP;unicast'})
+        await client.request('PLAY', url)
+        session = next(iter(server.sessions.values()))
+        # Small socket buffers fill up quickly once the client stops reading
+        session.connection.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        client.writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.writer.transport.pause_reading()
+
+        server.send('video', _annex_b(IDR), 0.0, True)
+        for index in range(1, 2000):
+            server.send('video', _annex_b(IDR[:1000]), index / 25, False)
+            if session.waiting:
+                break
+        assert session.waiting
+        assert server.dropped_packets._value.get() > 0
+
+        client.writer.transport.resume_reading()
+        for index in range(5):
+            server.send('video', _annex_b(SLICE), 100 + index / 25, False)
+        assert session.waiting
+        await asyncio.sleep(0.2)
+        server.send('video', _annex_b(SPS, PPS, SLICE), 101.0, True)
+        assert not session.waiting
+    finally:
+        client.writer.close()
+        await server.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_sessions_end_with_teardown_or_timeout(config, monkeypatch):
+    """Sessions are found by their id, kept alive by requests and closed by TEARDOWN or the timeout"""
+    monkeypatch.setattr(rtsp_server, 'SWEEP_INTERVAL', 0.05)
+    config.rtsp_session_timeout = 0.5
+    server = RTSPServer(config)
+    await server.start()
+    clients = []
+    try:
+        server.set_source(_stream('h264', extradata=_annex_b(SPS, PPS)))
+        url = f'rtsp://127.0.0.1:{server.port}/stream'
+        sessions = []
+        for _ in range(2):
+            client = RTSPTestClient(*await asyncio.open_connection('127.0.0.1', server.port))
+            clients.append(client)
+            _, headers, _ = await client.request('SETUP', url + '/trackID=0', {'Transport': 'RTP/AVP/TCP;unicast'})
+            session_id, timeout = headers['Session'].split(';')
+            assert timeout == 'timeout=1'
+            sessions.append(session_id)
+            status, _, _ = await client.request('PLAY', url, {'Session': session_id})
+            assert status == 'RTSP/1.0 200 OK'
+        assert len(set(sessions)) == 2 and all(len(session_id) == 16 for session_id in sessions)
+        assert server.clients_gauge._value.get() == 2
+
+        status, _, _ = await clients[0].request('PLAY', url, {'Session': 'unknown'})
+        assert status == 'RTSP/1.0 454 Session Not Found'
+        status, _, _ = await clients[0].request('TEARDOWN', url, {'Session': sessions[0]})
+        assert status == 'RTSP/1.0 200 OK'
+        assert list(server.sessions) == [sessions[1]]
+        assert server.clients_gauge._value.get() == 1
+
+        # Keepalives hold on to the second session past the timeout, until they stop
+        for _ in range(8):
+            await asyncio.sleep(0.1)
+            status, headers, _ = await clients[1].request('GET_PARAMETER', url, {'Session': sessions[1]})
+            assert status == 'RTSP/1.0 200 OK'
+        assert list(server.sessions) == [sessions[1]]
+        await asyncio.sleep(1.0)
+        assert not server.sessions and not server.playing
+        assert server.clients_gauge._value.get() == 0
+        # Idle connections are closed as well
+        assert await clients[1].reader.read() == b''
+    finally:
+        for client in clients:
+            client.writer.close()
+        await server.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+@pytest.mark.parametrize('transport, status', [
+    ('RTP/AVP/TCP;unicast;interleaved=x-y', '400 Bad Request'),
+    ('RTP/AVP/TCP;unicast;interleaved=255-256', '400 Bad Request'),
+    ('RTP/AVP;unicast;client_port=', '400 Bad Request'),
+    ('RTP/AVP;unicast;client_port=70000-70001', '400 Bad Request'),
+    ('RTP/AVP;unicast', '461 Unsupported Transport'),
+    ('RAW/RAW/UDP;unicast;client_port=5000-5001', '461 Unsupported Transport'),
+])
+async def test_malformed_transports_are_answered(config, transport, status):
+    """SETUP with a transport the server cannot use is answered, the connection stays usable"""
+    server = RTSPServer(config)
+    await server.start()
+    try:
+        server.set_source(_stream('h264'))
+        client = RTSPTestClient(*await asyncio.open_connection('127.0.0.1', server.port))
+        url = f'rtsp://127.0.0.1:{server.port}/stream'
+        response, _, _ = await client.request('SETUP', url + '/trackID=0', {'Transport': transport})
+        assert response == f'RTSP/1.0 {status}'
+        assert not server.sessions
+        response, _, _ = await client.request('OPTIONS', url)
+        assert response == 'RTSP/1.0 200 OK'
+    finally:
+        client.writer.close()
+        await server.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_udp_sessions_kept_alive_by_rtcp_reports(config, monkeypatch):
+    """Receiver reports from the RTCP port of a UDP client keep its session alive without requests"""
+    monkeypatch.setattr(rtsp_server, 'SWEEP_INTERVAL', 0.05)
+    config.rtsp_session_timeout = 0.5
+    server = RTSPServer(config)
+    await server.start()
+    loop = asyncio.get_running_loop()
+    reports, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=('127.0.0.1', 0))
+    stranger, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=('127.0.0.1', 0))
+    try:
+        server.set_source(_stream('h264'))
+        client = RTSPTestClient(*await asyncio.open_connection('127.0.0.1', server.port))
+        url = f'rtsp://127.0.0.1:{server.port}/stream'
+        rtcp_port = reports.get_extra_info('sockname')[1]
+        _, headers, _ = await client.request('SETUP', url + '/trackID=0',
+                                             {'Transport': f'RTP/AVP;unicast;client_port={rtcp_port - 1}-{rtcp_port}'})
+        session_id = headers['Session'].split(';')[0]
+        status, _, _ = await client.request('PLAY', url, {'Session': session_id})
+        assert status == 'RTSP/1.0 200 OK'
+        client.writer.close()
+
+        server_rtcp = ('127.0.0.1', server._udp_port(server.rtcp))
+        receiver_report = bytes([0x80, 201, 0, 1]) + b'\x00\x00\x00\x01'
+        for _ in range(10):
+            await asyncio.sleep(0.1)
+            reports.sendto(receiver_report, server_rtcp)
+        assert list(server.sessions) == [session_id]
+
+        # Reports from other ports do not count
+        for _ in range(10):
+            await asyncio.sleep(0.1)
+            stranger.sendto(receiver_report, server_rtcp)
+        assert not server.sessions and not server.rtcp_peers
+    finally:
+        reports.close()
+        stranger.close()
+        await server.stop()
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_pipelined_requests_are_answered_in_order(config):
+    """DESCRIBE waiting for the first keyframe holds back the requests behind it"""
+    server = RTSPServer(config)
+    await server.start()
+    try:
+        server.set_source(_stream('h264'))
+        client = RTSPTestClient(*await asyncio.open_connection('127.0.0.1', server.port))
+        url = f'rtsp://127.0.0.1:{server.port}/stream'
+        await client.send('DESCRIBE', url)
+        await client.send('OPTIONS', url)
+        await asyncio.sleep(0.1)
+        server.send('video', _annex_b(SPS, PPS, IDR), 0.0, True)
+
+        head = (await client.reader.readuntil(b'\r\n\r\n')).decode()
+        assert 'CSeq: 1' in head and 'application/sdp' in head
+        length = int(head.split('Content-Length: ')[1].split('\r\n')[0])
+        await client.reader.readexactly(length)
+        head = (await client.reader.readuntil(b'\r\n\r\n')).decode()
+        assert 'CSeq: 2' in head and 'TEARDOWN' in head
+
+        client.writer.write(b'PLAY rtsp://host/stream RTSP/2.0\r\nCSeq: 3\r\n\r\n')
+        head = (await client.reader.readuntil(b'\r\n\r\n')).decode()
+        assert head.startswith('RTSP/1.0 505 RTSP Version Not Supported') and 'CSeq: 3' in head
+        assert await client.reader.read() == b''
+    finally:
+        client.writer.close()
+        await server.stop()
@@ -0,0 +1,40 @@
+import logging
+from src.server import SegmentStore
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def _segment(rendition, segment_id):
+    return {'id': segment_id, 'rendition': rendition, 'duration': 2.0}
+
+
+def test_store_keeps_segments_per_rendition():
+    """Segments are looked up per rendition and listed oldest first"""
+    store = SegmentStore(['high', 'low'])
+    for segment_id in range(1, 4):
+        store.add(_segment('high', segment_id))
+    store.add(_segment('low', 1))
+
+    assert [s['id'] for s in store.latest('high', 2)] == [2, 3]
+    assert [s['id'] for s in store.latest('low', 5)] == [1]
+    assert store.get('high', 1)['id'] == 1
+    assert store.get('low', 2) is None
+    assert store.get('unknown', 1) is None
+    assert 'high' in store and 'unknown' not in store
+
+
+def test_store_evicts_oldest_segments():
+    """A bounded store drops the oldest segments and reports them"""
+    store = SegmentStore(['high'], max_segments=3)
+    evicted = []
+    for segment_id in range(1, 6):
+        evicted += store.add(_segment('high', segment_id))
+
+    assert [s['id'] for s in evicted] == [1, 2]
+    assert [s['id'] for s in store['high']] == [3, 4, 5]
+    assert store.get('high', 2) is None
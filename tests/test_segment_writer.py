@@ -0,0 +1,454 @@
+import logging
+from fractions import Fraction
+import av
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from src.config import StreamConfig, Rendition
+from src.converter.probe import can_passthrough, h264_codec_string
+from src.converter.segment_writer import (SegmentTimeline, SegmentWriter, RemuxWriter, AudioSegmentWriter,
+                                          AudioGroupWriter)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Test RTSP URL
+TEST_RTSP_URL = "rtsp://example.com/stream"
+
+TIME_BASE = Fraction(1, 90000)
+
+
+class FakeInputStream:
+    time_base = TIME_BASE
+
+
+def _make_frames(count, fps=30, width=320, height=240, start_pts=0):
+    frames = []
+    for i in range(count):
+        image = np.full((height, width, 3), i % 255, dtype=np.uint8)
+        frame = av.VideoFrame.from_ndarray(image, format='rgb24')
+        frame.pts = start_pts + i * 90000 // fps
+        frame.time_base = TIME_BASE
+        frames.append(frame)
+    return frames
+
+
+def _make_audio_frames(count, rate=48000, samples=1024, start_pts=0):
+    """Mono s16 noise, in another format than the encoders take"""
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(count):
+        data = rng.integers(-8000, 8000, (1, samples), dtype=np.int16)
+        frame = av.AudioFrame.from_ndarray(data, format='s16', layout='mono')
+        frame.sample_rate = rate
+        frame.pts = start_pts + i * samples * 90000 // rate
+        frame.time_base = TIME_BASE
+        frames.append(frame)
+    return frames
+
+
+def test_timeline_cuts_on_media_time():
+    """Boundaries follow media time from the first frame, not frame count"""
+    timeline = SegmentTimeline(2)
+
+    assert timeline.is_boundary(10.0)
+    assert not timeline.is_boundary(11.9)
+    assert timeline.is_boundary(12.0)
+    assert not timeline.is_boundary(13.0)
+    # A gap skips whole segments but only cuts once
+    assert timeline.is_boundary(17.5)
+    assert not timeline.is_boundary(17.9)
+
+
+def test_timeline_reanchors_after_backwards_jump():
+    """A camera timestamp reset starts a new segment instead of stalling"""
+    timeline = SegmentTimeline(2)
+
+    assert timeline.is_boundary(100.0)
+    assert timeline.is_boundary(104.0)
+    assert timeline.is_boundary(1.0)
+    assert not timeline.is_boundary(2.0)
+    assert timeline.is_boundary(3.0)
+
+
+@pytest.mark.timeout(30)
+def test_segments_start_on_keyframes_with_media_durations(tmp_path):
+    """Each segment starts with a keyframe and reports its media duration"""
+    config = StreamConfig(
+        input_url=TEST_RTSP_URL,
+        output_path=str(tmp_path),
+        segment_duration=1,
+        keyframe_interval=250,
+        fps=30,
+    )
+    segments = []
+    writer = SegmentWriter(config, Rendition(500000, 160, 120), FakeInputStream(), None,
+                           stats={"processed_video_frames": 0, "encoding_errors": 0},
+                           on_segment=segments.append)
+
+    for frame in _make_frames(75, start_pts=900000):
+        writer.write(frame)
+    writer.close()
+
+    assert [s['duration'] for s in segments] == pytest.approx([1.0, 1.0, 0.5])
+    # Files are renamed into place once complete, with the size the server indexes
+    assert [s['size'] for s in segments] == [s['path'].stat().st_size for s in segments]
+    assert not list(tmp_path.glob('*.tmp'))
+    frame_counts = []
+    for segment in segments:
+        with av.open(str(segment['path'])) as container:
+            frames = list(container.decode(video=0))
+        assert frames[0].key_frame
+        assert frames[0].width == 160
+        frame_counts.append(len(frames))
+    # The encoder lives across segments, so no frame is lost at a boundary
+    assert frame_counts == [30, 30, 15]
+    # Constrained Baseline as configured at the level x264 picked, no audio
+    assert len({s['codecs'] for s in segments}) == 1
+    assert segments[0]['codecs'].startswith('avc1.42C0')
+
+
+@pytest.mark.timeout(30)
+def test_static_scenes_are_encoded_at_lower_bitrate(tmp_path):
+    """While the motion detector reports a static scene, the encoder spends a fraction of the bitrate"""
+    config = StreamConfig(
+        input_url=TEST_RTSP_URL,
+        output_path=str(tmp_path),
+        segment_duration=1,
+        fps=30,
+        enable_motion_adaptive=True,
+        motion_static_bitrate=0.25,
+    )
+    rng = np.random.default_rng(0)
+    sizes = {}
+    for static in (False, True):
+        segments = []
+        writer = SegmentWriter(config, Rendition(500000, 160, 120), FakeInputStream(), None,
+                               stats={"processed_video_frames": 0, "encoding_errors": 0},
+                               on_segment=segments.append, motion=SimpleNamespace(static=static))
+        for i in range(90):
+            image = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+            frame = av.VideoFrame.from_ndarray(image, format='rgb24')
+            frame.pts = i * 3000
+            frame.time_base = TIME_BASE
+            writer.write(frame)
+        writer.close()
+        sizes[static] = sum(s['size'] for s in segments)
+
+    assert sizes[True] < sizes[False] * 0.5
+
+
+@pytest.mark.timeout(30)
+def test_low_latency_parts_concatenate_into_segments(tmp_path):
+    """Parts are published while encoding and together make up their segment"""
+    config = StreamConfig(
+        input_url=TEST_RTSP_URL,
+        output_path=str(tmp_path),
+        segment_duration=1,
+        keyframe_interval=250,
+        fps=30,
+        enable_low_latency=True,
+        part_duration=0.3,
+    )
+    segments = []
+    parts = []
+    writer = SegmentWriter(config, Rendition(500000, 160, 120), FakeInputStream(), None,
+                           stats={"processed_video_frames": 0, "encoding_errors": 0},
+                           on_segment=segments.append, on_part=parts.append)
+
+    for frame in _make_frames(60):
+        writer.write(frame)
+    writer.close()
+
+    assert len(segments) == 2
+    # The last part of each segment is published with the segment
+    assert len(parts) == 2 * 3
+    for segment in segments:
+        durations = [p['duration'] for p in segment['parts']]
+        assert durations == pytest.approx([0.3, 0.3, 0.3, 0.1])
+        assert [p['independent'] for p in segment['parts']] == [True, False, False, False]
+        assert segment['path'].read_bytes() == b''.join(p['data'] for p in segment['parts'])
+        with av.open(str(segment['path'])) as container:
+            frames = list(container.decode(video=0))
+        assert len(frames) == 30
+        assert frames[0].key_frame
+
+
+@pytest.mark.timeout(30)
+def test_fmp4_segments_share_init_segment(tmp_path):
+    """fMP4 segments decode after the shared init segment and keep their media times"""
+    config = StreamConfig(
+        input_url=TEST_RTSP_URL,
+        output_path=str(tmp_path),
+        segment_duration=1,
+        keyframe_interval=250,
+        fps=30,
+        segment_format='fmp4',
+    )
+    segments = []
+    writer = SegmentWriter(config, Rendition(500000, 160, 120), FakeInputStream(), None,
+                           stats={"processed_video_frames": 0, "encoding_errors": 0},
+                           on_segment=segments.append)
+
+    for frame in _make_frames(60, start_pts=900000):
+        writer.write(frame)
+    writer.close()
+
+    assert [s['path'].name for s in segments] == ['segment_500000_1.m4s', 'segment_500000_2.m4s']
+    init = (tmp_path / 'init_500000.mp4').read_bytes()
+    assert all(s['init'] == init for s in segments)
+    for segment, start in zip(segments, [10.0, 11.0]):
+        media = segment['path'].read_bytes()
+        assert media[4:8] == b'moof'
+        combined = tmp_path / 'combined.mp4'
+        combined.write_bytes(init + media)
+        with av.open(str(combined)) as container:
+            frames = list(container.decode(video=0))
+        assert len(frames) == 30
+        assert frames[0].key_frame
+        assert frames[0].time == pytest.approx(start)
+
+
+@pytest.mark.timeout(30)
+def test_interrupt_starts_discontinuity_with_same_encoders(tmp_path):
+    """An input gap closes the segment and the next input continues after a discontinuity"""
+    config = StreamConfig(
+        input_url=TEST_RTSP_URL,
+        output_path=str(tmp_path),
+        segment_duration=1,
+        keyframe_interval=250,
+        fps=30,
+    )
+    segments = []
+    writer = SegmentWriter(config, Rendition(500000, 160, 120), FakeInputStream(), None,
+                           stats={"processed_video_frames": 0, "encoding_errors": 0},
+                           on_segment=segments.append)
+    encoder = writer.video_encoder
+
+    for frame in _make_frames(45):
+        writer.write(frame)
+    writer.interrupt(FakeInputStream(), None)
+    assert [s['duration'] for s in segments] == pytest.approx([1.0, 0.5])
+
+    # Rebased timestamps of the reopened input continue a little after the gap
+    for frame in _make_frames(30, start_pts=180000):
+        writer.write(frame)
+    writer.close()
+
+    assert writer.video_encoder is encoder
+    assert [s['id'] for s in segments] == [1, 2, 3]
+    assert [s.get('discontinuity', False) for s in segments] == [False, False, True]
+    with av.open(str(segments[2]['path'])) as container:
+        frames = list(container.decode(video=0))
+    assert len(frames) == 30
+    assert frames[0].key_frame
+    assert frames[0].time == pytest.approx(2.0)
+
+
+def _write_h264_file(path, count, gop, fps=30, width=160, height=120, profile='baseline', format='mpegts',
+                     preset='ultrafast'):
+    with av.open(str(path), 'w', format=format) as container:
+        stream = container.add_stream('libx264', rate=fps)
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = 'yuv420p'
+        stream.gop_size = gop
+        stream.options = {'preset': preset, 'profile': profile, 'sc_threshold': '0'}
+        for frame in _make_frames(count, fps=fps, width=width, height=height):
+            frame.pict_type = av.video.frame.PictureType.NONE
+            for packet in stream.encode(frame.reformat(format='yuv420p')):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+
+@pytest.mark.timeout(30)
+def test_remux_cuts_on_source_keyframes(tmp_path):
+    """Passthrough segments start on the first source keyframe after each boundary"""
+    source = tmp_path / 'source.ts'
+    _write_h264_file(source, count=90, gop=45)
+    config = StreamConfig(
+        input_url=str(source),
+        output_path=str(tmp_path),
+        segment_duration=1,
+        width=160,
+        height=120,
+    )
+    rendition = Rendition(2000000, 160, 120)
+    segments = []
+
+    with av.open(str(source)) as container:
+        video_stream = container.streams.video[0]
+        assert can_passthrough(config, rendition, video_stream, None)
+        assert not can_passthrough(config, Rendition(2000000, 320, 240), video_stream, None)
+
+        writer = RemuxWriter(config, rendition, video_stream, None,
+                             stats={"processed_video_frames": 0, "encoding_errors": 0},
+                             on_segment=segments.append)
+        for packet in container.demux(video_stream):
+            if packet.dts is not None:
+                writer.write(packet)
+        writer.close()
+
+    # Keyframes every 1.5s push each cut past its 1s boundary
+    assert [s['duration'] for s in segments] == pytest.approx([1.5, 1.5])
+    for segment in segments:
+        with av.open(str(segment['path'])) as container:
+            frames = list(container.decode(video=0))
+        assert len(frames) == 45
+        assert frames[0].key_frame
+
+
+def test_h264_codec_strings_come_from_the_sps():
+    """The avc1 codec string is read from avcC records and from SPS NAL units in either framing"""
+    sps = bytes([0x67, 0x64, 0x00, 0x1f, 0xac])
+    idr = bytes([0x65, 0x88, 0x84])
+    assert h264_codec_string(bytes([1, 0x4d, 0x40, 0x1e, 0xff])) == 'avc1.4D401E'
+    assert h264_codec_string(b'\x00\x00\x00\x01' + sps + b'\x00\x00\x01' + idr) == 'avc1.64001F'
+    length_prefixed = b''.join(len(unit).to_bytes(4, 'big') + unit for unit in (sps, idr))
+    assert h264_codec_string(length_prefixed) == 'avc1.64001F'
+    assert h264_codec_string(b'\x00\x00\x01' + idr) is None
+    assert h264_codec_string(b'') is None
+
+
+@pytest.mark.timeout(30)
+def test_remux_reports_the_source_profile(tmp_path):
+    """Passed through High profile video is not announced as Baseline"""
+    source = tmp_path / 'source.mp4'
+    # ultrafast leaves out the High profile tools, x264 would fall back to Baseline
+    _write_h264_file(source, count=60, gop=30, profile='high', format='mp4', preset='veryfast')
+    config = StreamConfig(input_url=str(source), output_path=str(tmp_path), segment_duration=1,
+                          width=160, height=120)
+    rendition = Rendition(2000000, 160, 120)
+    segments = []
+
+    with av.open(str(source)) as container:
+        video_stream = container.streams.video[0]
+        assert video_stream.codec_context.profile == 'High'
+        level = video_stream.codec_context.level
+        writer = RemuxWriter(config, rendition, video_stream, None,
+                             stats={"processed_video_frames": 0, "encoding_errors": 0},
+                             on_segment=segments.append)
+        for packet in container.demux(video_stream):
+            if packet.dts is not None:
+                writer.write(packet)
+        writer.close()
+
+    assert len(segments) == 2
+    assert {s['codecs'] for s in segments} == {f'avc1.6400{level:02X}'}
+
+
+@pytest.mark.timeout(30)
+def test_remux_without_audio_stays_without_after_interrupt(tmp_path):
+    """A rendition whose audio goes to the audio renditions does not pick it up from a reopened input"""
+    source = tmp_path / 'source.ts'
+    with av.open(str(source), 'w', format='mpegts') as container:
+        video = container.add_stream('libx264', rate=30)
+        video.width, video.height, video.pix_fmt = 160, 120, 'yuv420p'
+        video.gop_size = 30
+        audio = container.add_stream('aac', rate=48000)
+        audio.layout = 'mono'
+        for frame in _make_frames(60):
+            container.mux(video.encode(frame.reformat(format='yuv420p')))
+        resampler = av.AudioResampler(format='fltp', layout='mono', rate=48000)
+        for frame in _make_audio_frames(94):
+            for resampled in resampler.resample(frame):
+                container.mux(audio.encode(resampled))
+        container.mux(video.encode(None))
+        container.mux(audio.encode(None))
+    config = StreamConfig(input_url=str(source), output_path=str(tmp_path), segment_duration=1,
+                          width=160, height=120)
+    segments = []
+
+    with av.open(str(source)) as container:
+        video_stream, audio_stream = container.streams.video[0], container.streams.audio[0]
+        writer = RemuxWriter(config, Rendition(2000000, 160, 120), video_stream, None,
+                             stats={"processed_video_frames": 0, "processed_audio_frames": 0,
+                                    "dropped_frames": 0, "encoding_errors": 0},
+                             on_segment=segments.append)
+        for index, packet in enumerate(container.demux(video_stream, audio_stream)):
+            if index == 40:
+                writer.interrupt(video_stream, audio_stream)
+            if packet.dts is not None:
+                writer.write(packet)
+        writer.close()
+
+    assert len(segments) >= 2
+    for segment in segments:
+        assert segment['codecs'].startswith('avc1.') and 'mp4a' not in segment['codecs']
+        with av.open(str(segment['path'])) as container:
+            assert [s.type for s in container.streams] == ['video']
+
+
+@pytest.mark.timeout(30)
+def test_remux_counts_frames_dropped_before_first_keyframe(tmp_path):
+    """Packets joined mid-GOP cannot start a segment and are counted as dropped"""
+    source = tmp_path / 'source.ts'
+    _write_h264_file(source, count=90, gop=45)
+    config = StreamConfig(input_url=str(source), output_path=str(tmp_path), segment_duration=1,
+                          width=160, height=120)
+    stats = {"processed_video_frames": 0, "dropped_frames": 0, "encoding_errors": 0}
+    segments = []
+
+    with av.open(str(source)) as container:
+        video_stream = container.streams.video[0]
+        writer = RemuxWriter(config, Rendition(2000000, 160, 120), video_stream, None,
+                             stats=stats, on_segment=segments.append)
+        packets = [p for p in container.demux(video_stream) if p.dts is not None]
+        for packet in packets[10:]:
+            writer.write(packet)
+        writer.close()
+
+    assert stats["dropped_frames"] == 35
+    assert stats["processed_video_frames"] == 45
+    assert len(segments) == 1
+
+
+@pytest.mark.timeout(30)
+def test_audio_renditions_share_resampling_and_video_boundaries(tmp_path):
+    """Audio is resampled once for every bitrate and cut where the video segments are"""
+    config = StreamConfig(
+        input_url=TEST_RTSP_URL,
+        output_path=str(tmp_path),
+        segment_duration=1,
+        fps=30,
+        audio_bitrates=[128000, 32000],
+    )
+    stats = {"processed_audio_frames": 0, "encoding_errors": 0}
+    segments = {}
+    writers = [AudioSegmentWriter(config, rendition, stats,
+                                  on_segment=lambda s: segments.setdefault(s['rendition'], []).append(s))
+               for rendition in config.get_audio_renditions()]
+    group = AudioGroupWriter(config, writers, stats)
+    resampled = []
+    resample = group._resample
+    group._resample = lambda frame: resampled.append(frame) or resample(frame)
+
+    video = _make_frames(75, start_pts=900000)
+    audio = _make_audio_frames(118, start_pts=900000)
+    items = sorted(video + audio, key=lambda frame: frame.time)
+    for frame in items:
+        group.write(frame)
+    group.close()
+
+    # Once per input frame plus the flush, whatever the number of bitrates
+    assert len(resampled) == len(audio) + 1
+    assert stats["processed_audio_frames"] == len(audio)
+    assert stats["encoding_errors"] == 0
+    assert set(segments) == {'audio_128000', 'audio_32000'}
+    for rendition_segments in segments.values():
+        assert [s['id'] for s in rendition_segments] == [1, 2, 3]
+        # Cut at the first audio frame past each video boundary, the last one ends with the encoder padding
+        assert [s['duration'] for s in rendition_segments] == pytest.approx([1.0, 1.0, 0.5], abs=2 * 1024 / 44100)
+        with av.open(str(rendition_segments[0]['path'])) as container:
+            assert [s.type for s in container.streams] == ['audio']
+            frames = list(container.decode(audio=0))
+        assert frames[0].sample_rate == 44100
+        assert frames[0].layout.name == 'stereo'
+        assert rendition_segments[0]['codecs'] == 'mp4a.40.2'
+    sizes = {name: sum(s['size'] for s in rendition_segments) for name, rendition_segments in segments.items()}
+    assert sizes['audio_128000'] > sizes['audio_32000']
@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+import time
+from fractions import Fraction
+import av
+import numpy as np
+import pytest
+from src.config import StreamConfig
+from src.converter import StreamProcessor
+from src.converter.pipeline import FilterStage, END_OF_STREAM
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+# Hooks run in spawned processes, so they have to be module level functions
+def invert(image, media_time):
+    np.subtract(255, image, out=image)
+
+
+def brightness(image, media_time):
+    return float(image.mean())
+
+
+def stall(image, media_time):
+    time.sleep(1.0)
+
+
+def _frame(index, value=10, fps=10):
+    frame = av.VideoFrame.from_ndarray(np.full((32, 48, 3), value, np.uint8), format='rgb24')
+    frame.pts = index
+    frame.time_base = Fraction(1, fps)
+    return frame
+
+
+def _run(processor, items, on_drop=None):
+    """Run items through a filter stage, the items it passes on"""
+    input_queue, output_queue = queue.Queue(), queue.Queue()
+    for item in items:
+        input_queue.put(item)
+    input_queue.put(END_OF_STREAM)
+    stage = FilterStage(processor, input_queue, [output_queue], threading.Event(), on_drop=on_drop)
+    stage.start()
+    stage.join(timeout=30)
+    assert not stage.is_alive()
+    assert stage.error is None
+    output = []
+    while (item := output_queue.get_nowait()) is not END_OF_STREAM:
+        output.append(item)
+    return output
+
+
+@pytest.fixture
+def config(tmp_path):
+    return StreamConfig(input_url='rtsp://test', output_path=str(tmp_path), fps=10, processor_workers=2)
+
+
+def test_hooks_change_frames_in_order(config):
+    """Hook changes reach the output, frames and other items keep their order and timestamps"""
+    results = []
+    processor = StreamProcessor(config)
+    processor.add_hook(invert, budget=5.0)
+    processor.add_hook(brightness, budget=5.0, on_result=lambda name, media_time, value:
+                       results.append((name, media_time, value)))
+    items = [_frame(index, value=index) for index in range(6)]
+    items.insert(3, 'audio')
+
+    output = _run(processor, items)
+
+    assert output[3] == 'audio'
+    frames = output[:3] + output[4:]
+    assert [frame.pts for frame in frames] == list(range(6))
+    assert all(frame.time_base == Fraction(1, 10) for frame in frames)
+    assert [int(frame.to_ndarray()[0, 0, 0]) for frame in frames] == [255 - index for index in range(6)]
+    assert sorted(results, key=lambda result: result[1]) == [
+        ('brightness', pytest.approx(index / 10), pytest.approx(255 - index)) for index in range(6)]
+    assert not processor.running
+    assert processor.slots == []
+
+
+def test_hook_processes_ready_after_start_timeout(config, monkeypatch):
+    """Processes that get ready after start gave up on them still run the hooks"""
+    monkeypatch.setattr('src.converter.stream_processor.START_TIMEOUT', 0.0)
+    results = []
+    processor = StreamProcessor(config)
+    processor.add_hook(brightness, budget=10.0, on_result=lambda name, media_time, value: results.append(value))
+
+    started = time.monotonic()
+    output = _run(processor, [_frame(index) for index in range(4)])
+
+    # Results are still collected, no frame waits out its budget
+    assert time.monotonic() - started < 8.0
+    assert len(output) == 4
+    assert results == [pytest.approx(10.0)] * 4
+
+
+@pytest.mark.parametrize('on_overrun', ['pass', 'drop'])
+def test_late_frames_follow_overrun_policy(config, on_overrun):
+    """A hook past its budget does not stall the stage, frames pass as decoded or are dropped"""
+    dropped = []
+    processor = StreamProcessor(config)
+    processor.add_hook(stall, budget=0.05, on_overrun=on_overrun)
+
+    started = time.monotonic()
+    output = _run(processor, [_frame(index) for index in range(8)], on_drop=lambda: dropped.append(1))
+
+    # Both processes stay stuck on their first frames for a second, the rest bypass the hook
+    assert time.monotonic() - started < 5.0
+    if on_overrun == 'pass':
+        assert [frame.pts for frame in output] == list(range(8))
+        assert all(int(frame.to_ndarray()[0, 0, 0]) == 10 for frame in output)
+        assert not dropped
+    else:
+        assert output == []
+        assert len(dropped) == 8
+
+
+def test_add_hook_validates(config):
+    processor = StreamProcessor(config)
+    hook = processor.add_hook(invert)
+    assert hook.budget == pytest.approx(0.1)
+    assert hook.name == 'invert'
+    with pytest.raises(ValueError):
+        processor.add_hook(invert, on_overrun='block')
+    with pytest.raises(ValueError):
+        processor.add_hook(invert, budget=0)
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from fractions import Fraction
+import av
+import numpy as np
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from src.server import StreamSupervisor
+from src.config import StreamConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def crashing_worker(name, config, events, first_segment_id, resumed, log_level):
+    """Worker that publishes one segment, cam1 then crashes while the others keep running"""
+    events.put(('segment', name, {'id': first_segment_id, 'rendition': '500000', 'duration': 1.0}))
+    if name != 'cam1':
+        time.sleep(60)
+
+
+@pytest.fixture
+def streams_config(tmp_path):
+    return StreamConfig(
+        input_url='',
+        input_streams={'cam1': 'rtsp://example.com/1', 'cam2': 'rtsp://example.com/2'},
+        output_path=str(tmp_path),
+        video_bitrates=[500000],
+        segment_duration=1,
+        hls_server_port=0,
+        worker_restart_delay=0.1,
+    )
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_streams_are_served_below_their_name(streams_config):
+    """Worker events end up in the playlists of their own stream"""
+    supervisor = StreamSupervisor(streams_config)
+    supervisor._dispatch(('segment', 'cam1', {'id': 1, 'rendition': '500000', 'duration': 1.0}))
+    stats = dict(supervisor.workers['cam2'].stats, processed_video_frames=30, start_time=time.time() - 1)
+    supervisor._dispatch(('stats', 'cam2', stats))
+
+    async with TestClient(TestServer(supervisor.app)) as client:
+        response = await client.get('/cam1/stream.m3u8')
+        assert '/cam1/stream_500000.m3u8' in await response.text()
+
+        response = await client.get('/cam1/stream_500000.m3u8')
+        assert '/cam1/segment_500000_1.ts' in await response.text()
+
+        response = await client.get('/cam2/stream_500000.m3u8')
+        assert 'segment_500000' not in await response.text()
+
+        response = await client.get('/cam2/stats')
+        assert (await response.json())['processed_video_frames'] == 30
+
+        response = await client.get('/streams')
+        streams = await response.json()
+        assert streams['cam2']['playlist'] == '/cam2/stream.m3u8'
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(30)
+async def test_crashed_worker_is_restarted(streams_config):
+    """A crashing worker is restarted with fresh segment ids, the other stream is untouched"""
+    supervisor = StreamSupervisor(streams_config, worker_target=crashing_worker)
+    await supervisor.start()
+    try:
+        cam1 = supervisor.workers['cam1']
+        cam2 = supervisor.workers['cam2']
+        cam2_pid = cam2.process.pid
+        while cam1.restarts < 2:
+            await asyncio.sleep(0.1)
+        while cam1.server.segments.last_id('500000') < 3:
+            await asyncio.sleep(0.1)
+
+        assert [s['id'] for s in cam1.server.segments['500000']] == [1, 2, 3]
+        assert cam2.alive and cam2.process.pid == cam2_pid
+        assert cam2.restarts == 0
+    finally:
+        await supervisor.stop()
+    assert not cam2.alive
+
+
+def _write_clip(path, seconds=2, fps=25):
+    with av.open(str(path), 'w') as container:
+        stream = container.add_stream('libx264', rate=fps)
+        stream.width, stream.height, stream.pix_fmt = 320, 240, 'yuv420p'
+        for i in range(seconds * fps):
+            image = np.full((240, 320, 3), i * 5 % 255, dtype=np.uint8)
+            frame = av.VideoFrame.from_ndarray(image, format='rgb24')
+            frame.pts, frame.time_base = i, Fraction(1, fps)
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode(None))
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(60)
+async def test_restarted_worker_starts_discontinuity(tmp_path):
+    """A worker restarted after its input ended continues the ids behind a discontinuity"""
+    clip = tmp_path / 'clip.mp4'
+    _write_clip(clip)
+    config = StreamConfig(
+        input_url='',
+        input_streams={'cam1': str(clip)},
+        output_path=str(tmp_path / 'hls'),
+        video_bitrates=[300000],
+        width=320,
+        height=240,
+        fps=25,
+        segment_duration=1,
+        hls_server_port=0,
+        worker_restart_delay=0.1,
+        enable_reconnect=False,
+        max_encode_lag=0,
+        enable_stats=False,
+    )
+    supervisor = StreamSupervisor(config)
+    await supervisor.start()
+    try:
+        cam1 = supervisor.workers['cam1']
+        while cam1.restarts < 1 or cam1.server.segments.last_id('300000') < 3:
+            await asyncio.sleep(0.1)
+
+        segments = cam1.server.segments['300000']
+        assert [s['id'] for s in segments[:3]] == [1, 2, 3]
+        assert not segments[0].get('discontinuity')
+        assert segments[2]['discontinuity']
+        async with TestClient(TestServer(supervisor.app)) as client:
+            response = await client.get('/cam1/stream_300000.m3u8')
+            playlist = await response.text()
+        assert playlist.index('#EXT-X-DISCONTINUITY') < playlist.index('/cam1/segment_300000_3.ts')
+    finally:
+        await supervisor.stop()